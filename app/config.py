@@ -1,7 +1,119 @@
 import os
 
 config = {
+    "uploads_folder": os.path.join(os.getcwd(), "uploads"),
     "csv_upload_folder": os.path.join(os.getcwd(), "uploads/csv"),
     "images_upload_folder": os.path.join(os.getcwd(), "uploads/images"),
     "allowed_images_extensions": {"png", "jpg", "jpeg"},
+    # resized, cropped and converted versions of uploaded images
+    "images_rendition_folder": os.path.join(os.getcwd(), "uploads/images/renditions"),
+    # packed perceptual hash index used by similar image searches; kept out
+    # of the uploads folder, which is served publicly
+    "images_phash_folder": os.getenv(
+        "IMAGES_PHASH_FOLDER", os.path.join(os.getcwd(), "indexes/phash")
+    ),
+    # least recently used renditions are evicted past this many bytes
+    "images_rendition_cache_bytes": int(
+        os.getenv("IMAGES_RENDITION_CACHE_BYTES", 512 * 1024 * 1024)
+    ),
+    # where new csv datasets keep their rows: "mongo" stores one document per
+    # row in db.csv, "arrow" stores memory-mapped Arrow IPC files on disk
+    "csv_storage_backend": os.getenv("CSV_STORAGE_BACKEND", "mongo"),
+    # rows parsed per pandas chunk when ingesting a csv file
+    "csv_chunk_size": int(os.getenv("CSV_CHUNK_SIZE", 50000)),
+    # rows sent per insert_many call while ingesting a chunk
+    "csv_insert_batch_size": int(os.getenv("CSV_INSERT_BATCH_SIZE", 5000)),
+    # columns with more distinct values fall back to an approximate quantile
+    # sketch instead of exact frequency counts in their stored summary
+    "csv_summary_max_distinct": int(os.getenv("CSV_SUMMARY_MAX_DISTINCT", 1000)),
+    # with ?engine=auto, datasets with at least this many rows compute their
+    # statistics inside mongo instead of in pandas
+    "csv_statistics_pushdown_rows": int(
+        os.getenv("CSV_STATISTICS_PUSHDOWN_ROWS", 100000)
+    ),
+    # rows per record batch streamed by the csv export endpoint
+    "csv_export_batch_size": int(os.getenv("CSV_EXPORT_BATCH_SIZE", 5000)),
+    # distinct column lists that may get a shared index on db.csv, below
+    # mongo's limit of 64 indexes per collection
+    "csv_max_column_indexes": int(os.getenv("CSV_MAX_COLUMN_INDEXES", 48)),
+    # rows returned by one page of the csv listing and query endpoints
+    "csv_max_page_size": int(os.getenv("CSV_MAX_PAGE_SIZE", 1000)),
+    # operations accepted by one bulk record request
+    "csv_bulk_max_operations": int(os.getenv("CSV_BULK_MAX_OPERATIONS", 10000)),
+    # background threads per app worker ingesting uploads sent with ?async=true
+    "csv_ingest_workers": int(os.getenv("CSV_INGEST_WORKERS", 2)),
+    # background jobs refresh their heartbeat this often, and are failed as
+    # orphaned once it is older than JOBS_STALE_SECONDS
+    "jobs_heartbeat_seconds": int(os.getenv("JOBS_HEARTBEAT_SECONDS", 30)),
+    "jobs_stale_seconds": int(os.getenv("JOBS_STALE_SECONDS", 120)),
+    # processes decoding images for batch requests, per app worker
+    "images_process_workers": int(
+        os.getenv("IMAGES_PROCESS_WORKERS", os.cpu_count() or 1)
+    ),
+    # threads storing the files of one multi-image upload
+    "images_upload_workers": int(os.getenv("IMAGES_UPLOAD_WORKERS", 4)),
+    # image ids accepted by one batch request
+    "images_batch_max_ids": int(os.getenv("IMAGES_BATCH_MAX_IDS", 500)),
+    # batch jobs run at once per app worker, images each one has in flight,
+    # and images one batch job accepts
+    "images_batch_workers": int(os.getenv("IMAGES_BATCH_WORKERS", 1)),
+    "images_batch_chunk_size": int(os.getenv("IMAGES_BATCH_CHUNK_SIZE", 32)),
+    "images_batch_job_max_images": int(os.getenv("IMAGES_BATCH_JOB_MAX_IMAGES", 10000)),
+    # memory one image may take to decode or segment; jpegs above it are
+    # decoded at a reduced scale and segmentation runs on a smaller level
+    "images_max_decode_bytes": int(
+        os.getenv("IMAGES_MAX_DECODE_BYTES", 1024 * 1024 * 1024)
+    ),
+    # longest side segmented when a segmentation request asks to downscale
+    "images_segmentation_max_side": int(
+        os.getenv("IMAGES_SEGMENTATION_MAX_SIDE", 1024)
+    ),
+    # host:port or unix socket path of one process that loads the nlp
+    # models for every app worker; unset loads them inside each worker
+    "text_model_host": os.getenv("TEXT_MODEL_HOST", "") or None,
+    # models unused for this many seconds are unloaded, 0 keeps them
+    "text_model_idle_seconds": int(os.getenv("TEXT_MODEL_IDLE_SECONDS", 900)),
+    # concurrent sentiment, categorization and summarization calls are
+    # run as one batch of up to this many texts; the shared model host also
+    # waits up to this many milliseconds for more, workers only batch calls
+    # already queued; a size of 1 runs every call on its own
+    "text_batch_max_size": int(os.getenv("TEXT_BATCH_MAX_SIZE", 16)),
+    "text_batch_wait_ms": float(os.getenv("TEXT_BATCH_WAIT_MS", 10)),
+    # persistent tf-idf index behind /text/search, and the most results one
+    # search may ask for
+    "text_index_folder": os.getenv(
+        "TEXT_INDEX_FOLDER", os.path.join(os.getcwd(), "indexes/text")
+    ),
+    "text_search_max_k": int(os.getenv("TEXT_SEARCH_MAX_K", 100)),
+    # texts accepted by one list request to the text endpoints
+    "text_batch_max_texts": int(os.getenv("TEXT_BATCH_MAX_TEXTS", 1000)),
+    # processes spacy splits keyword extraction between, for lists of at
+    # least this many texts
+    "text_pipe_processes": int(os.getenv("TEXT_PIPE_PROCESSES", 2)),
+    "text_pipe_process_min": int(os.getenv("TEXT_PIPE_PROCESS_MIN", 500)),
+    # results of the text endpoints cached in mongo for every worker, for
+    # this many seconds and up to this many entries, least recently used
+    # evicted first
+    "text_cache_enabled": os.getenv("TEXT_CACHE_ENABLED", "true").lower() == "true",
+    "text_cache_ttl_seconds": int(os.getenv("TEXT_CACHE_TTL_SECONDS", 7 * 24 * 3600)),
+    "text_cache_max_entries": int(os.getenv("TEXT_CACHE_MAX_ENTRIES", 100000)),
+    # seconds each worker gathers cache hit and miss counts before adding
+    # them to the shared stats
+    "text_cache_stats_flush_seconds": float(
+        os.getenv("TEXT_CACHE_STATS_FLUSH_SECONDS", 10)
+    ),
+    # let the front server send uploaded files: "x-accel-redirect" (nginx)
+    # or "x-sendfile" (apache, lighttpd); unset sends them from python
+    "static_sendfile": os.getenv("STATIC_SENDFILE", "").lower() or None,
+    # nginx internal location that maps to the uploads folder
+    "static_accel_prefix": os.getenv("STATIC_ACCEL_PREFIX", "/internal-uploads/"),
+    # create/update the declared mongo indexes when the app starts
+    "ensure_indexes_on_startup": os.getenv("ENSURE_INDEXES", "true").lower() == "true",
+    # record operations slower than this in system.profile for the slow
+    # query report, unset leaves the profiler as it is
+    "mongo_profile_slow_ms": (
+        int(os.getenv("MONGO_PROFILE_SLOW_MS"))
+        if os.getenv("MONGO_PROFILE_SLOW_MS")
+        else None
+    ),
 }
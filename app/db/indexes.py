@@ -0,0 +1,71 @@
+from pymongo import ASCENDING, IndexModel
+
+# every index the app manages is named with this prefix; reconciliation
+# never touches indexes created outside the app
+MANAGED_PREFIX = "ff_"
+
+# per-dataset column indexes created through the api
+DATASET_INDEX_PREFIX = "ff_ds_"
+
+INDEXES = {
+    "csv": [
+        # serves every {"csv_id": ...} match and keyset paging by _id
+        IndexModel([("csv_id", ASCENDING), ("_id", ASCENDING)], name="ff_csv_id__id"),
+    ],
+    "csvmetadata": [],
+    "images": [
+        # finds already stored copies of uploaded content, and keeps
+        # concurrent uploads of the same content from both being stored
+        IndexModel(
+            [("content_hash", ASCENDING)],
+            name="ff_content_hash",
+            unique=True,
+            partialFilterExpression={"content_hash": {"$type": "string"}},
+        ),
+        # covers the default listing, which only projects these fields
+        IndexModel(
+            [
+                ("_id", ASCENDING),
+                ("original_name", ASCENDING),
+                ("filename", ASCENDING),
+                ("uploaded_at", ASCENDING),
+                ("width", ASCENDING),
+                ("height", ASCENDING),
+                ("file_size", ASCENDING),
+            ],
+            name="ff_listing",
+        ),
+    ],
+    "text": [],
+    "renditions": [
+        # least recently used first for eviction
+        IndexModel([("last_used_at", ASCENDING)], name="ff_last_used_at"),
+        # renditions of a deleted image
+        IndexModel([("image_id", ASCENDING)], name="ff_image_id"),
+    ],
+    "jobs": [
+        # serves the check for jobs left behind by exited workers
+        IndexModel(
+            [("status", ASCENDING), ("heartbeat_at", ASCENDING)],
+            name="ff_status_heartbeat_at",
+        ),
+        # finds a running job for the same segmentation request
+        IndexModel(
+            [("kind", ASCENDING), ("params.key", ASCENDING)],
+            name="ff_kind_params_key",
+            partialFilterExpression={"params.key": {"$exists": True}},
+        ),
+    ],
+    "nlp_cache": [
+        # mongo removes entries once past their expires_at
+        IndexModel(
+            [("expires_at", ASCENDING)], name="ff_expires_at", expireAfterSeconds=0
+        ),
+        # least recently used first for eviction
+        IndexModel([("last_used_at", ASCENDING)], name="ff_last_used_at"),
+    ],
+    "batch_results": [
+        # pages through the per-image results of a batch job
+        IndexModel([("job_id", ASCENDING), ("_id", ASCENDING)], name="ff_job_id__id"),
+    ],
+}
@@ -26,3 +26,10 @@ class DatabaseError(BaseError):
 
     def __init__(self, message):
         super().__init__(message, 500)
+
+
+class ServiceUnavailableError(BaseError):
+    """Exception raised when a backing service cannot be reached."""
+
+    def __init__(self, message):
+        super().__init__(message, 503)
@@ -1,28 +1,59 @@
-from flask import Flask, send_from_directory, jsonify
-from app.routes.csv_routes import csv_routes
+import threading
+import time
+from flask import Flask, jsonify
+from app.routes.csv_routes import csv_routes, csv_service
 from app.routes.images_routes import images_routes
 from app.routes.text_routes import text_routes
+from app.routes.index_routes import index_routes, index_repository
+from app.routes.static_files import send_upload
 from dotenv import load_dotenv
 from flask_cors import CORS
-import os
 from app.errors import BaseError
+from app.config import config
+from pymongo.errors import PyMongoError
+from werkzeug.exceptions import HTTPException
 
 load_dotenv()
 
 app = Flask(__name__)
 CORS(app)
 
-UPLOAD_FOLDER = os.path.join(os.getcwd(), "uploads")
+UPLOAD_FOLDER = config["uploads_folder"]
 
 app.register_blueprint(csv_routes)
 app.register_blueprint(images_routes)
 app.register_blueprint(text_routes)
+app.register_blueprint(index_routes)
+
+# declare the indexes every query relies on before serving traffic
+try:
+    if config["ensure_indexes_on_startup"]:
+        index_repository.reconcile()
+    if config["mongo_profile_slow_ms"] is not None:
+        index_repository.enable_profiling(config["mongo_profile_slow_ms"])
+except PyMongoError as e:
+    print(f"Could not reconcile MongoDB indexes: {e}")
+
+
+def fail_orphaned_jobs():
+    # ingestion jobs of workers that exited would otherwise stay queued
+    # forever; checked again periodically, since a worker that restarts
+    # quickly starts before the jobs it left behind look stale
+    while True:
+        try:
+            csv_service.fail_orphaned_jobs()
+        except PyMongoError as e:
+            print(f"Could not check for orphaned jobs: {e}")
+        time.sleep(config["jobs_stale_seconds"])
+
+
+threading.Thread(target=fail_orphaned_jobs, name="orphaned-jobs", daemon=True).start()
 
 
 # serve the uploaded files
 @app.route("/uploads/<path:name>", methods=["GET"])
 def serve_file(name):
-    return send_from_directory(UPLOAD_FOLDER, name)
+    return send_upload(UPLOAD_FOLDER, name)
 
 
 @app.route("/")
@@ -32,6 +63,9 @@ def index():
 
 @app.errorhandler(Exception)
 def handle_error(error):
+    # 404s, 405s and unsatisfiable ranges keep their own status
+    if isinstance(error, HTTPException):
+        return error
     print(
         f"An error occurred: {error.message} (Status code: {error.status_code}), stack trace: {error.__traceback__}"
     )
@@ -0,0 +1,117 @@
+import io
+import json
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+from app.errors import ValidationError
+from app.repositories import csv_schema
+
+# format: (mimetype, file extension)
+FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+}
+
+ARROW_TYPES = {
+    csv_schema.INTEGER: pa.int64(),
+    csv_schema.FLOAT: pa.float64(),
+    csv_schema.BOOLEAN: pa.bool_(),
+    csv_schema.STRING: pa.string(),
+}
+
+
+def export_fields(schema: dict, columns: list) -> list:
+    return [("_id", csv_schema.STRING), *((c, schema[c]) for c in columns)]
+
+
+def arrow_schema(fields: list) -> pa.Schema:
+    return pa.schema([(name, ARROW_TYPES[column_type]) for name, column_type in fields])
+
+
+def _fit(value, column_type: str):
+    # records edited after ingest can hold values of another type; those
+    # export as null instead of failing halfway through the stream
+    if value is None:
+        return None
+    if column_type == csv_schema.STRING:
+        return str(value)
+    try:
+        value = csv_schema.coerce(value, column_type, "")
+    except ValidationError:
+        return None
+    if column_type == csv_schema.INTEGER and not isinstance(value, int):
+        return None
+    return value
+
+
+def _array(values: list, column_type: str) -> pa.Array:
+    arrow_type = ARROW_TYPES[column_type]
+    try:
+        return pa.array(values, arrow_type, from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array(
+            [_fit(value, column_type) for value in values], arrow_type, from_pandas=True
+        )
+
+
+def rows_to_batch(rows: list, fields: list) -> pa.RecordBatch:
+    return pa.RecordBatch.from_arrays(
+        [_array([row.get(name) for row in rows], t) for name, t in fields],
+        schema=arrow_schema(fields),
+    )
+
+
+def conform_table(table: pa.Table, fields: list) -> pa.Table:
+    columns = []
+    for name, column_type in fields:
+        arrow_type = ARROW_TYPES[column_type]
+        if name not in table.column_names:
+            columns.append(pa.nulls(table.num_rows, arrow_type))
+            continue
+        try:
+            columns.append(table[name].cast(arrow_type))
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            columns.append(_array(table[name].to_pylist(), column_type))
+    return pa.Table.from_arrays(columns, schema=arrow_schema(fields))
+
+
+def _drain(sink: io.BytesIO) -> bytes:
+    data = sink.getvalue()
+    sink.seek(0)
+    sink.truncate()
+    return data
+
+
+def _encode_csv(batches, schema: pa.Schema):
+    sink = io.BytesIO()
+    with pa_csv.CSVWriter(sink, schema) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+            yield _drain(sink)
+    yield _drain(sink)
+
+
+def _encode_ndjson(batches, schema: pa.Schema):
+    for batch in batches:
+        yield "".join(
+            json.dumps(row, default=str) + "\n" for row in batch.to_pylist()
+        ).encode()
+
+
+def _encode_arrow(batches, schema: pa.Schema):
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+            yield _drain(sink)
+    yield _drain(sink)
+
+
+_ENCODERS = {"csv": _encode_csv, "ndjson": _encode_ndjson, "arrow": _encode_arrow}
+
+
+def encode(export_format: str, batches, fields: list):
+    """Yields the encoded dataset one record batch at a time."""
+    for data in _ENCODERS[export_format](batches, arrow_schema(fields)):
+        if data:
+            yield data
@@ -0,0 +1,196 @@
+import math
+import re
+from bson import ObjectId
+import pyarrow.compute as pc
+from app.errors import ValidationError
+from app.repositories import csv_schema
+
+COMPARISONS = {
+    "eq": "$eq",
+    "ne": "$ne",
+    "lt": "$lt",
+    "lte": "$lte",
+    "gt": "$gt",
+    "gte": "$gte",
+}
+OPERATORS = (*COMPARISONS, "in", "nin", "between", "startswith", "is_null")
+
+MAX_CONDITIONS = 100
+
+
+def parse_filter(node: dict, schema: dict) -> dict:
+    """Validates a filter tree and coerces its values to the column types.
+
+    A node is {"and": [...]}, {"or": [...]}, {"not": node} or a condition
+    {"column": name, "op": operator, "value": value}.
+    """
+    count = [0]
+
+    def parse(node):
+        if not isinstance(node, dict):
+            raise ValidationError("Filter nodes must be objects")
+
+        for combinator in ("and", "or"):
+            if combinator in node:
+                children = node[combinator]
+                if not isinstance(children, list) or not children:
+                    raise ValidationError(f"'{combinator}' expects a non-empty list")
+                return {combinator: [parse(child) for child in children]}
+
+        if "not" in node:
+            return {"not": parse(node["not"])}
+
+        count[0] += 1
+        if count[0] > MAX_CONDITIONS:
+            raise ValidationError(f"Filters are limited to {MAX_CONDITIONS} conditions")
+
+        column, op, value = node.get("column"), node.get("op", "eq"), node.get("value")
+        if column not in schema:
+            raise ValidationError(f"Unknown column: {column}")
+        if op not in OPERATORS:
+            raise ValidationError(f"Invalid operator: {op}")
+
+        column_type = schema[column]
+        if op in ("in", "nin"):
+            if not isinstance(value, list):
+                raise ValidationError(f"'{op}' expects a list of values")
+            value = [csv_schema.coerce(v, column_type, column) for v in value]
+        elif op == "between":
+            if not isinstance(value, list) or len(value) != 2:
+                raise ValidationError("'between' expects [low, high]")
+            value = [csv_schema.coerce(v, column_type, column) for v in value]
+        elif op == "startswith":
+            if column_type != csv_schema.STRING:
+                raise ValidationError("'startswith' only applies to string columns")
+            value = str(value)
+        elif op == "is_null":
+            value = value is None or bool(value)
+        else:
+            value = csv_schema.coerce(value, column_type, column)
+
+        return {"column": column, "op": op, "value": value}
+
+    return parse(node)
+
+
+def parse_sort(sort: list, schema: dict) -> list:
+    keys = []
+    for key in sort or []:
+        if isinstance(key, str):
+            key = {"column": key}
+        column = key.get("column")
+        direction = key.get("direction", "asc")
+        if column not in schema:
+            raise ValidationError(f"Unknown sort column: {column}")
+        if direction not in ("asc", "desc"):
+            raise ValidationError("Sort direction must be 'asc' or 'desc'")
+        keys.append((column, direction))
+    return keys
+
+
+def keyset_filter(sort: list, values: list, last_id: str) -> dict:
+    # rows strictly after the cursor in (sort columns..., _id) order
+    keys = [*sort, ("_id", "asc")]
+    # NaN matches no mongo range, so a NaN cursor value pages like a null
+    values = [
+        None if isinstance(value, float) and math.isnan(value) else value
+        for value in [*values, last_id]
+    ]
+    branches = []
+
+    for i, ((column, direction), value) in enumerate(zip(keys, values)):
+        equal = [
+            (
+                {"column": c, "op": "is_null", "value": True}
+                if v is None
+                else {"column": c, "op": "eq", "value": v}
+            )
+            for (c, _), v in zip(keys[:i], values[:i])
+        ]
+        # nulls sort first ascending and last descending, like mongo
+        if value is None:
+            if direction == "desc":
+                continue
+            after = {"column": column, "op": "is_null", "value": False}
+        elif direction == "asc":
+            after = {"column": column, "op": "gt", "value": value}
+        else:
+            after = {
+                "or": [
+                    {"column": column, "op": "lt", "value": value},
+                    {"column": column, "op": "is_null", "value": True},
+                ]
+            }
+        branches.append({"and": [*equal, after]})
+
+    # the trailing _id key always contributes a branch
+    return {"or": branches}
+
+
+def compile_mongo(node: dict) -> dict:
+    if "and" in node:
+        return {"$and": [compile_mongo(child) for child in node["and"]]}
+    if "or" in node:
+        return {"$or": [compile_mongo(child) for child in node["or"]]}
+    if "not" in node:
+        return {"$nor": [compile_mongo(node["not"])]}
+
+    column, op, value = node["column"], node["op"], node["value"]
+    if column == "_id":
+        value = (
+            [ObjectId(v) for v in value] if isinstance(value, list) else ObjectId(value)
+        )
+
+    if op in COMPARISONS:
+        return {column: {COMPARISONS[op]: value}}
+    if op in ("in", "nin"):
+        return {column: {f"${op}": value}}
+    if op == "between":
+        return {column: {"$gte": value[0], "$lte": value[1]}}
+    if op == "startswith":
+        # an anchored prefix regex can use an index on the column
+        return {column: {"$regex": f"^{re.escape(value)}"}}
+    if value:
+        return {column: None}
+    return {column: {"$ne": None}}
+
+
+def compile_arrow(node: dict) -> pc.Expression:
+    if "and" in node:
+        expression = pc.scalar(True)
+        for child in node["and"]:
+            expression = expression & compile_arrow(child)
+        return expression
+    if "or" in node:
+        expression = pc.scalar(False)
+        for child in node["or"]:
+            expression = expression | compile_arrow(child)
+        return expression
+    if "not" in node:
+        # like mongo's $nor, rows the condition is null for are kept
+        condition = compile_arrow(node["not"])
+        return ~(condition & condition.is_valid())
+
+    field, op, value = pc.field(node["column"]), node["op"], node["value"]
+    if op == "eq":
+        return field == value
+    if op == "ne":
+        # mongo's $ne matches missing values too
+        return (field != value) | field.is_null()
+    if op == "lt":
+        return field < value
+    if op == "lte":
+        return field <= value
+    if op == "gt":
+        return field > value
+    if op == "gte":
+        return field >= value
+    if op == "in":
+        return field.isin(value)
+    if op == "nin":
+        return ~field.isin(value)
+    if op == "between":
+        return (field >= value[0]) & (field <= value[1])
+    if op == "startswith":
+        return pc.starts_with(field, pattern=value)
+    return field.is_null() if value else field.is_valid()
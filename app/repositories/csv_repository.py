@@ -1,119 +1,408 @@
 from bson import ObjectId
+import hashlib
+import json
 import pandas as pd
 import os
+import time
 from werkzeug.utils import secure_filename
 from datetime import datetime
+from typing import Callable
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
 from pymongo.database import Database
-from app.errors import DatabaseError, ValidationError, NotFoundError
+from pymongo.errors import OperationFailure
+from app.db.indexes import DATASET_INDEX_PREFIX
+from app.errors import ValidationError, NotFoundError
+from app.repositories import csv_export, csv_query, csv_schema, csv_summaries
+from app.repositories.csv_storage import create_csv_storages, get_storage
+from app.repositories.pagination import decode_cursor, encode_cursor, keyset_page
+
+# dataset status; datasets uploaded before ingestion jobs existed are ready
+PROCESSING = "processing"
+READY = "ready"
+FAILED = "failed"
 
 
 class CsvRepository:
-    def __init__(self, db: Database) -> None:
+    def __init__(
+        self,
+        db: Database,
+        data_folder: str = None,
+        storage_backend: str = "mongo",
+        chunk_size: int = 50000,
+        insert_batch_size: int = 5000,
+        summary_max_distinct: int = 1000,
+        pushdown_min_rows: int = 100000,
+        export_batch_size: int = 5000,
+        max_column_indexes: int = 48,
+    ) -> None:
         if db is None:
             raise ValueError("db cannot be None")
         self.db = db
+        self.chunk_size = chunk_size
+        self.summary_max_distinct = summary_max_distinct
+        self.pushdown_min_rows = pushdown_min_rows
+        self.export_batch_size = export_batch_size
+        self.max_column_indexes = max_column_indexes
+        self.storages = create_csv_storages(
+            db,
+            data_folder or os.getcwd(),
+            insert_batch_size=insert_batch_size,
+            part_size=chunk_size,
+        )
+        self.storage_backend = get_storage(self.storages, storage_backend).name
+
+    def _storage_for(self, csv_id: str, writable: bool = False):
+        metadata = self.db.csvmetadata.find_one(
+            {"_id": ObjectId(csv_id)}, {"storage": 1, "status": 1}
+        )
+        if metadata is None:
+            raise NotFoundError("CSV data not found")
+
+        # the rows and summaries are still being written while ingestion
+        # runs, so changes made meanwhile would be lost or left behind
+        if writable and metadata.get("status") == PROCESSING:
+            raise ValidationError("CSV data is still being processed")
+
+        # datasets uploaded before storage backends existed live in db.csv
+        return get_storage(self.storages, metadata.get("storage", "mongo"))
 
-    def upload_csv(self, file: object, upload_folder: str) -> dict:
+    def create_csv_upload(
+        self, file: object, upload_folder: str, storage_backend: str = None
+    ) -> str:
+        storage = get_storage(self.storages, storage_backend or self.storage_backend)
+
+        csv_metadata_id = ObjectId()
         filename = secure_filename(file.filename)
-        filepath = os.path.join(upload_folder, filename)
+        # the id prefix keeps a later upload with the same name from
+        # replacing a file that is still waiting to be ingested
+        filepath = os.path.join(upload_folder, f"{csv_metadata_id}_{filename}")
         file.save(filepath)
 
-        csv_metadata_id = ObjectId()
         csv_metadata = {
             "_id": csv_metadata_id,
             "filename": filename,
             "filepath": filepath,
             "uploaded_at": datetime.now(),
+            "storage": storage.name,
+            "status": PROCESSING,
+            "row_count": 0,
         }
 
         self.db.csvmetadata.insert_one(csv_metadata)
+        return str(csv_metadata_id)
+
+    def ingest_csv(
+        self, csv_id: str, chunk_size: int = None, progress: Callable = None
+    ) -> dict:
+        metadata = self.db.csvmetadata.find_one(
+            {"_id": ObjectId(csv_id)}, {"storage": 1, "filepath": 1}
+        )
+        if metadata is None:
+            raise NotFoundError("CSV data not found")
 
-        csv_data = pd.read_csv(filepath)
-        rows = csv_data.to_dict(orient="records")
+        storage = get_storage(self.storages, metadata["storage"])
+        try:
+            ingest = self._ingest_csv_file(
+                storage,
+                ObjectId(csv_id),
+                metadata["filepath"],
+                chunk_size or self.chunk_size,
+                progress,
+            )
+        except Exception as e:
+            # partially stored rows are removed so a failed dataset is empty
+            storage.delete_dataset(ObjectId(csv_id))
+            self.mark_csv_failed([csv_id], getattr(e, "message", str(e)))
+            raise
+
+        summaries = ingest.pop("summaries")
+        schema = ingest.pop("schema")
+
+        self.db.csvmetadata.update_one(
+            {"_id": ObjectId(csv_id)},
+            {
+                "$set": {
+                    "status": READY,
+                    "row_count": ingest["rows"],
+                    "ingest": ingest,
+                    "columns": csv_schema.to_document(schema),
+                    **csv_summaries.to_document(summaries),
+                }
+            },
+        )
 
-        # insert the csv id into the csv data
-        for row in rows:
-            row["csv_id"] = csv_metadata_id
+        return ingest
 
-        self.db.csv.insert_many(rows)
+    def mark_csv_failed(self, csv_ids: list, error: str) -> None:
+        self.db.csvmetadata.update_many(
+            {"_id": {"$in": [ObjectId(csv_id) for csv_id in csv_ids]}},
+            {"$set": {"status": FAILED, "error": error}},
+        )
 
-        return {"message": "CSV data uploaded successfully"}
+    def upload_csv(
+        self,
+        file: object,
+        upload_folder: str,
+        chunk_size: int = None,
+        storage_backend: str = None,
+    ) -> dict:
+        csv_id = self.create_csv_upload(file, upload_folder, storage_backend)
+        ingest = self.ingest_csv(csv_id, chunk_size)
 
-    def get_csv(self, page: int = 1, page_size: int = 10):
-        skip = (page - 1) * page_size
-        limit = page_size
+        return {
+            "message": "CSV data uploaded successfully",
+            "_id": csv_id,
+            **ingest,
+        }
 
-        csv_data = self.db.csvmetadata.aggregate(
-            [
-                {"$skip": skip},
-                {"$limit": limit},
-                {"$addFields": {"_id": {"$toString": "$_id"}}},
-            ]
+    def _ingest_csv_file(
+        self,
+        storage,
+        csv_metadata_id: ObjectId,
+        filepath: str,
+        chunk_size: int,
+        progress: Callable = None,
+    ) -> dict:
+        # parse and store the file chunk by chunk so memory stays bounded by
+        # chunk_size regardless of the file size
+        rows = 0
+        summaries = None
+        schema = None
+        started = time.perf_counter()
+        total_bytes = os.path.getsize(filepath)
+
+        try:
+            with open(filepath, "rb") as f:
+                for chunk in pd.read_csv(f, chunksize=chunk_size):
+                    summaries = csv_summaries.merge_frame(
+                        summaries, chunk, self.summary_max_distinct
+                    )
+                    schema = csv_schema.merge_schema(schema, chunk)
+                    storage.write_chunk(csv_metadata_id, chunk)
+                    rows += len(chunk)
+
+                    if progress is not None:
+                        elapsed = time.perf_counter() - started
+                        progress(
+                            {
+                                "rows": rows,
+                                # the parser reads ahead, so this is approximate
+                                "bytes_read": min(f.tell(), total_bytes),
+                                "total_bytes": total_bytes,
+                                "elapsed_seconds": round(elapsed, 3),
+                                "rows_per_second": (
+                                    round(rows / elapsed, 1) if elapsed > 0 else None
+                                ),
+                            }
+                        )
+        except pd.errors.EmptyDataError:
+            raise ValidationError("CSV file is empty")
+
+        elapsed = time.perf_counter() - started
+
+        return {
+            "rows": rows,
+            "summaries": summaries or {},
+            "schema": schema or {},
+            "chunk_size": chunk_size,
+            "elapsed_seconds": round(elapsed, 3),
+            "rows_per_second": round(rows / elapsed, 1) if elapsed > 0 else None,
+        }
+
+    def get_csv(self, page_size: int = 10, after: str = None, page: int = None):
+        query = {}
+        if after is not None:
+            query["_id"] = {"$gt": ObjectId(after)}
+
+        cursor = self.db.csvmetadata.find(
+            query, {"summaries": 0, "summary_columns": 0}
+        ).sort("_id", 1)
+        if after is None and page:
+            cursor = cursor.skip((page - 1) * page_size)
+
+        csv_data, next_cursor = keyset_page(
+            list(cursor.limit(page_size + 1)), page_size
         )
+        for row in csv_data:
+            row["_id"] = str(row["_id"])
 
-        total = self.db.csvmetadata.count_documents({})
+        # the collection count comes from its metadata instead of a scan
+        total = self.db.csvmetadata.estimated_document_count()
 
-        return {"data": list(csv_data), "total": total}
+        return {"data": csv_data, "total": total, "next": next_cursor}
 
     def get_csv_by_id(self, csv_id: str) -> dict:
-        csv_data = self.db.csvmetadata.aggregate(
-            [
-                {"$match": {"_id": ObjectId(csv_id)}},
-                {"$addFields": {"_id": {"$toString": "$_id"}}},
-            ],
+        csv_data = self.db.csvmetadata.find_one(
+            {"_id": ObjectId(csv_id)}, {"summaries": 0, "summary_columns": 0}
         )
 
         if not csv_data:
             raise NotFoundError("CSV data not found")
 
-        return {"data": list(csv_data)[0]}
+        return {"data": {**csv_data, "_id": str(csv_data["_id"])}}
 
     def get_csv_data_by_id(
-        self, csv_id: str, page: int = 1, page_size: int = 10
+        self, csv_id: str, page_size: int = 10, after: str = None, page: int = None
     ) -> dict:
-        skip = (page - 1) * page_size
-        limit = page_size
+        storage = self._storage_for(csv_id)
+        rows = storage.get_page(ObjectId(csv_id), page_size, after, page)
+        csv_data, next_cursor = keyset_page(rows, page_size)
 
-        csv_data = self.db.csv.aggregate(
-            [
-                {
-                    "$match": {"csv_id": ObjectId(csv_id)},
-                },
-                {
-                    "$addFields": {"_id": {"$toString": "$_id"}},
-                },
-                {"$project": {"csv_id": 0}},
-                {
-                    "$skip": skip,
-                },
-                {
-                    "$limit": limit,
-                },
-            ]
+        metadata = self.db.csvmetadata.find_one(
+            {"_id": ObjectId(csv_id)}, {"row_count": 1}
         )
 
-        total = self.db.csv.count_documents({"csv_id": ObjectId(csv_id)})
+        return {
+            "data": csv_data,
+            "total": metadata.get("row_count", 0),
+            "next": next_cursor,
+        }
 
-        return {"data": list(csv_data), "total": total}
+    def query_csv(
+        self,
+        column: str,
+        value: str,
+        page_size: int = 10,
+        after: str = None,
+        page: int = None,
+        with_total: bool = False,
+    ) -> dict:
+        query = {column: value}
+        page_query = dict(query)
+        if after is not None:
+            page_query["_id"] = {"$gt": ObjectId(after)}
 
-    def retrieve_csv_data_as_dataframe(self, csv_id: str) -> pd.DataFrame:
-        csv_data = self.db.csv.aggregate(
-            [
-                {
-                    "$match": {"csv_id": ObjectId(csv_id)},
-                },
+        cursor = self.db.csv.find(page_query).sort("_id", 1)
+        if after is None and page:
+            cursor = cursor.skip((page - 1) * page_size)
+
+        csv_data, next_cursor = keyset_page(
+            list(cursor.limit(page_size + 1)), page_size
+        )
+        for row in csv_data:
+            row["_id"] = str(row["_id"])
+            row["csv_id"] = str(row["csv_id"]) if "csv_id" in row else None
+
+        # counting every match is a full scan of the match, so it is opt-in
+        total = self.db.csv.count_documents(query) if with_total else None
+
+        return {"data": csv_data, "total": total, "next": next_cursor}
+
+    def _schema_for(self, storage, csv_id: str) -> dict:
+        metadata = self.db.csvmetadata.find_one(
+            {"_id": ObjectId(csv_id)}, {"columns": 1}
+        )
+        if metadata is None:
+            raise NotFoundError("CSV not found")
+        if "columns" in metadata:
+            return csv_schema.from_document(metadata["columns"])
+
+        # datasets ingested before schemas were captured infer theirs from
+        # their first chunk of rows
+        first_chunk = next(storage.iter_frames(ObjectId(csv_id), self.chunk_size), None)
+        schema = csv_schema.infer_schema(
+            first_chunk if first_chunk is not None else pd.DataFrame()
+        )
+        self.db.csvmetadata.update_one(
+            {"_id": ObjectId(csv_id)},
+            {"$set": {"columns": csv_schema.to_document(schema)}},
+        )
+        return schema
+
+    def query_dataset(
+        self,
+        csv_id: str,
+        conditions: dict = None,
+        columns: list = None,
+        sort: list = None,
+        page_size: int = 10,
+        after: str = None,
+        with_total: bool = False,
+    ) -> dict:
+        storage = self._storage_for(csv_id)
+        schema = self._schema_for(storage, csv_id)
+
+        for column in columns or []:
+            if column not in schema:
+                raise ValidationError(f"Unknown column: {column}")
+
+        conditions = csv_query.parse_filter(conditions, schema) if conditions else None
+        sort = csv_query.parse_sort(sort, schema)
+
+        after_conditions = None
+        if after:
+            cursor = decode_cursor(after)
+            values = cursor.get("values", [])
+            if len(values) != len(sort):
+                raise ValidationError("Cursor does not match the sort order")
+            after_conditions = csv_query.keyset_filter(sort, values, cursor["id"])
+
+        rows, total = storage.query(
+            ObjectId(csv_id),
+            conditions,
+            columns,
+            sort,
+            page_size + 1,
+            after_conditions,
+            with_total,
+        )
+
+        next_cursor = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            next_cursor = encode_cursor(
                 {
-                    "$addFields": {"_id": {"$toString": "$_id"}},
-                },
-                {"$project": {"csv_id": 0}},
-            ]
+                    "id": rows[-1]["_id"],
+                    "values": [rows[-1].get(column) for column, _ in sort],
+                }
+            )
+
+        if columns:
+            # sort columns are fetched for the cursor but only requested
+            # columns are returned
+            rows = [{c: row.get(c) for c in ["_id", *columns]} for row in rows]
+
+        return {"data": rows, "total": total, "next": next_cursor}
+
+    def export_csv_data(
+        self, csv_id: str, export_format: str, columns: list = None
+    ) -> dict:
+        storage = self._storage_for(csv_id)
+        schema = self._schema_for(storage, csv_id)
+
+        for column in columns or []:
+            if column not in schema:
+                raise ValidationError(f"Unknown column: {column}")
+
+        metadata = self.db.csvmetadata.find_one(
+            {"_id": ObjectId(csv_id)}, {"filename": 1}
         )
+        mimetype, extension = csv_export.FORMATS[export_format]
+        fields = csv_export.export_fields(schema, columns or list(schema))
 
-        if not csv_data:
+        # nothing is read until the response iterates the chunks
+        batches = storage.export_batches(
+            ObjectId(csv_id), fields, self.export_batch_size
+        )
+
+        return {
+            "filename": f"{os.path.splitext(metadata['filename'])[0]}.{extension}",
+            "mimetype": mimetype,
+            "chunks": csv_export.encode(export_format, batches, fields),
+        }
+
+    def retrieve_csv_data_as_dataframe(
+        self, csv_id: str, columns: list = None
+    ) -> pd.DataFrame:
+        storage = self._storage_for(csv_id)
+        data = storage.read_frame(
+            ObjectId(csv_id), ["_id", *columns] if columns else None
+        )
+
+        if data.empty:
             return None
 
-        data = pd.DataFrame(list(csv_data)).drop(columns=["_id"])
-        return data if not data.empty else None
+        return data.set_index("_id") if "_id" in data.columns else data
 
     def calculate_statstics(self, data: pd.DataFrame) -> dict:
         statistics = {
@@ -146,24 +435,354 @@ class CsvRepository:
         outliers = series[(series < lower_bound) | (series > upper_bound)]
         return outliers.astype(object).to_dict()
 
-    def get_csv_statistics(self, csv_id: str) -> dict:
-        data = self.retrieve_csv_data_as_dataframe(csv_id)
+    def get_csv_statistics(self, csv_id: str, engine: str = "summary") -> dict:
+        storage = self._storage_for(csv_id)
+        metadata = self.db.csvmetadata.find_one(
+            {"_id": ObjectId(csv_id)}, {"summaries": 1, "row_count": 1}
+        )
+
+        if "summaries" not in metadata:
+            metadata["summaries"] = self._rebuild_summaries(storage, csv_id)
+
+        if engine == "summary":
+            return self._statistics_from_summaries(
+                storage, csv_id, metadata["summaries"]
+            )
+
+        columns = [csv_summaries.decode_key(key) for key in metadata["summaries"]]
+        can_push_down = hasattr(storage, "compute_statistics")
+
+        if engine == "auto":
+            # small datasets are cheaper to pull into pandas than to run
+            # several aggregations for
+            large = metadata.get("row_count", 0) >= self.pushdown_min_rows
+            engine = "mongo" if can_push_down and large else "pandas"
+
+        if engine == "mongo":
+            if not can_push_down:
+                raise ValidationError(
+                    f"Statistics push-down is not available for {storage.name} storage"
+                )
+            return self._statistics_from_columns(
+                storage, csv_id, storage.compute_statistics(ObjectId(csv_id), columns)
+            )
+
+        data = self.retrieve_csv_data_as_dataframe(csv_id, columns) if columns else None
         if data is None:
-            return {"message": "CSV data not found"}, 404
+            return self._statistics_from_columns(storage, csv_id, {})
+
+        return self.calculate_statstics(data)
+
+    def _statistics_from_summaries(self, storage, csv_id: str, summaries: dict) -> dict:
+        column_statistics = {}
+        approximate = []
 
-        statistics = self.calculate_statstics(data)
+        for key, summary in summaries.items():
+            column = csv_summaries.decode_key(key)
+            statistics = csv_summaries.column_statistics(summary)
+            if statistics is None:
+                continue
+
+            column_statistics[column] = statistics
+            if not statistics["exact"]:
+                approximate.append(column)
+
+        return {
+            **self._statistics_from_columns(storage, csv_id, column_statistics),
+            "approximate": approximate,
+        }
+
+    def _statistics_from_columns(
+        self, storage, csv_id: str, column_statistics: dict
+    ) -> dict:
+        statistics = {
+            "mean": {},
+            "median": {},
+            "mode": {},
+            "quartiles": {},
+            "outliers": {},
+        }
+
+        for column, values in column_statistics.items():
+            statistics["mean"][column] = values["mean"]
+            statistics["median"][column] = values["median"]
+            statistics["mode"][column] = values["mode"]
+            statistics["quartiles"][column] = values["quartiles"]
+
+        # the outliers of every column are read in a single pass
+        statistics["outliers"] = storage.find_outliers(
+            ObjectId(csv_id),
+            {
+                column: csv_summaries.outlier_bounds(values["quartiles"])
+                for column, values in column_statistics.items()
+            },
+        )
 
         return statistics
 
+    def _rebuild_summaries(self, storage, csv_id: str) -> dict:
+        # datasets ingested before summaries existed are summarized once by
+        # streaming their rows in chunks, then kept up to date incrementally
+        summaries = None
+        rows = 0
+
+        for chunk in storage.iter_frames(ObjectId(csv_id), self.chunk_size):
+            summaries = csv_summaries.merge_frame(
+                summaries, chunk, self.summary_max_distinct
+            )
+            rows += len(chunk)
+
+        document = csv_summaries.to_document(summaries or {})
+        self.db.csvmetadata.update_one(
+            {"_id": ObjectId(csv_id)}, {"$set": {**document, "row_count": rows}}
+        )
+        return document["summaries"]
+
+    def _update_summaries(
+        self, csv_id: ObjectId, added: list = (), removed: list = ()
+    ) -> None:
+        if csv_id is None:
+            return
+
+        while True:
+            metadata = self.db.csvmetadata.find_one(
+                {"_id": csv_id}, {"summary_columns": 1}
+            )
+            if metadata is None:
+                return
+
+            inc = {"row_count": len(added) - len(removed)}
+            changes = [(row, 1) for row in added] + [(row, -1) for row in removed]
+
+            columns = metadata.get("summary_columns", {})
+            for key, tracks_freq in columns.items():
+                column = csv_summaries.decode_key(key)
+                for row, sign in changes:
+                    value = row.get(column)
+                    if csv_summaries.is_summary_value(value):
+                        csv_summaries.value_delta(
+                            inc, f"summaries.{key}", value, sign, tracks_freq
+                        )
+
+            # the update only applies while every frequency count it adds
+            # to is still kept; one dropped meanwhile is a null that $inc
+            # cannot add to, so the changes are recomputed without it
+            tracked = [key for key, tracks_freq in columns.items() if tracks_freq]
+            updated = self.db.csvmetadata.find_one_and_update(
+                {"_id": csv_id, **{f"summary_columns.{key}": True for key in tracked}},
+                {"$inc": inc},
+                {f"summaries.{key}.freq": 1 for key in tracked} or {"_id": 1},
+                return_document=ReturnDocument.AFTER,
+            )
+            if updated is not None:
+                break
+
+        self._trim_frequencies(csv_id, updated.get("summaries", {}))
+
+    def _trim_frequencies(self, csv_id: ObjectId, summaries: dict) -> None:
+        # record changes keep the same bound on exact counts as ingestion:
+        # past summary_max_distinct values a column falls back to its
+        # sketch, and values no row holds any more are removed
+        operations = []
+        for key, summary in summaries.items():
+            freq = summary.get("freq") or {}
+            path = f"summaries.{key}.freq"
+            if sum(count > 0 for count in freq.values()) > self.summary_max_distinct:
+                operations.append(
+                    UpdateOne(
+                        {"_id": csv_id, f"summary_columns.{key}": True},
+                        {"$set": {f"summary_columns.{key}": False, path: None}},
+                    )
+                )
+                continue
+            for value, count in freq.items():
+                if count <= 0:
+                    # unless another change counted the value again meanwhile
+                    operations.append(
+                        UpdateOne(
+                            {"_id": csv_id, f"{path}.{value}": {"$lte": 0}},
+                            {"$unset": {f"{path}.{value}": ""}},
+                        )
+                    )
+
+        if operations:
+            self.db.csvmetadata.bulk_write(operations, ordered=False)
+
+    def insert_csv_record(self, csv_id: str, row: dict) -> dict:
+        storage = self._storage_for(csv_id, writable=True)
+        row = csv_schema.coerce_row(row, self._schema_for(storage, csv_id))
+
+        row = storage.insert_record(ObjectId(csv_id), row)
+        self._update_summaries(ObjectId(csv_id), added=[row])
+
+        return {
+            "message": "CSV data inserted successfully",
+            "_id": str(row["_id"]),
+        }
+
+    def update_csv_record(
+        self, record_id: str, updated_row: dict, csv_id: str = None
+    ) -> dict:
+        # without a csv_id only records stored in db.csv can be found
+        storage = (
+            self._storage_for(csv_id, writable=True)
+            if csv_id
+            else self.storages["mongo"]
+        )
+
+        # values are checked against the dataset's column types on either
+        # backend
+        dataset_id = csv_id
+        if dataset_id is None:
+            record = self.db.csv.find_one({"_id": ObjectId(record_id)}, {"csv_id": 1})
+            if record is None:
+                raise NotFoundError("Record not found")
+            dataset_id = record.get("csv_id")
+        if dataset_id is not None:
+            updated_row = csv_schema.coerce_row(
+                updated_row, self._schema_for(storage, str(dataset_id))
+            )
+
+        previous = storage.update_record(
+            ObjectId(csv_id) if csv_id else None, record_id, updated_row
+        )
+        if previous is None:
+            raise NotFoundError("Record not found")
+
+        self._update_summaries(
+            ObjectId(csv_id) if csv_id else previous.get("csv_id"),
+            added=[{**previous, **updated_row}],
+            removed=[previous],
+        )
+        return {"message": "CSV data updated successfully"}
+
+    def bulk_write_csv_records(self, csv_id: str, operations: list) -> list:
+        storage = self._storage_for(csv_id, writable=True)
+        schema = self._schema_for(storage, csv_id)
+
+        # rows with values of the wrong type are reported in place
+        invalid, valid = [], []
+        for operation in operations:
+            if "row" not in operation:
+                valid.append(operation)
+                continue
+            try:
+                row = csv_schema.coerce_row(operation["row"], schema)
+            except ValidationError as e:
+                invalid.append(
+                    {
+                        "index": operation["index"],
+                        "status": "invalid",
+                        "error": e.message,
+                    }
+                )
+                continue
+            valid.append({**operation, "row": row})
+
+        results, added, removed = [], [], []
+        if valid:
+            results, added, removed = storage.bulk_write(ObjectId(csv_id), valid)
+            # one $inc keeps row_count and the summaries in step with the batch
+            self._update_summaries(ObjectId(csv_id), added=added, removed=removed)
+
+        return results + invalid
+
     def delete_csv_file(self, csv_id: str) -> dict:
-        self.db.csvmetadata.delete_one({"_id": ObjectId(csv_id)})
-        self.db.csv.delete_many({"csv_id": ObjectId(csv_id)})
+        storage = self._storage_for(csv_id, writable=True)
+        metadata = self.db.csvmetadata.find_one_and_delete({"_id": ObjectId(csv_id)})
+        storage.delete_dataset(ObjectId(csv_id))
+
+        for index in metadata.get("indexes", []):
+            self._release_index(index["name"])
+
         return {"message": "CSV data deleted successfully"}
 
-    def delete_csv_record(self, record_id: str) -> dict:
-        self.db.csv.delete_one(
-            {
-                "_id": ObjectId(record_id),
-            }
+    def _release_index(self, name: str) -> None:
+        # column indexes are shared by every dataset indexed on the same
+        # columns, and dropped once no dataset uses them
+        if self.db.csvmetadata.count_documents({"indexes.name": name}, limit=1):
+            return
+        try:
+            self.db.csv.drop_index(name)
+        except OperationFailure:
+            # already dropped
+            pass
+
+    def create_dataset_index(self, csv_id: str, columns: list) -> dict:
+        storage = self._storage_for(csv_id)
+        if storage.name != "mongo":
+            raise ValidationError(
+                "Column indexes are only available for datasets stored in mongo"
+            )
+
+        # one index per column list, led by csv_id so it serves every
+        # dataset's matches; per-dataset indexes would soon reach mongo's
+        # limit of 64 indexes per collection
+        # named by a hash of the column list, which joined names could not
+        # tell apart from other lists, e.g. ["a_b"] and ["a", "b"]
+        key = json.dumps(columns, separators=(",", ":"))
+        name = f"{DATASET_INDEX_PREFIX}{hashlib.sha256(key.encode()).hexdigest()[:24]}"
+        existing = self.db.csv.index_information()
+        if name not in existing:
+            column_indexes = [i for i in existing if i.startswith(DATASET_INDEX_PREFIX)]
+            if len(column_indexes) >= self.max_column_indexes:
+                raise ValidationError(
+                    f"Column indexes are limited to {self.max_column_indexes} "
+                    "column lists; reuse an existing one or drop one first"
+                )
+
+        # recorded first, so a dataset releasing the same index meanwhile
+        # sees it is still in use
+        self.db.csvmetadata.update_one(
+            {"_id": ObjectId(csv_id)},
+            {"$addToSet": {"indexes": {"name": name, "columns": columns}}},
+        )
+        try:
+            self.db.csv.create_index(
+                [("csv_id", ASCENDING)] + [(column, ASCENDING) for column in columns],
+                name=name,
+            )
+        except OperationFailure as e:
+            self.db.csvmetadata.update_one(
+                {"_id": ObjectId(csv_id)},
+                {"$pull": {"indexes": {"name": name}}},
+            )
+            raise ValidationError(f"Could not create the index: {e}")
+
+        return {"message": "Index created successfully", "name": name}
+
+    def get_dataset_indexes(self, csv_id: str) -> dict:
+        metadata = self.db.csvmetadata.find_one(
+            {"_id": ObjectId(csv_id)}, {"indexes": 1}
+        )
+        if metadata is None:
+            raise NotFoundError("CSV data not found")
+
+        return {"data": metadata.get("indexes", [])}
+
+    def drop_dataset_index(self, csv_id: str, name: str) -> dict:
+        result = self.db.csvmetadata.update_one(
+            {"_id": ObjectId(csv_id), "indexes.name": name},
+            {"$pull": {"indexes": {"name": name}}},
+        )
+        if result.matched_count == 0:
+            raise NotFoundError("Index not found")
+
+        self._release_index(name)
+        return {"message": "Index deleted successfully"}
+
+    def delete_csv_record(self, record_id: str, csv_id: str = None) -> dict:
+        storage = (
+            self._storage_for(csv_id, writable=True)
+            if csv_id
+            else self.storages["mongo"]
+        )
+
+        deleted = storage.delete_record(ObjectId(csv_id) if csv_id else None, record_id)
+        if deleted is None:
+            raise NotFoundError("Record not found")
+
+        self._update_summaries(
+            ObjectId(csv_id) if csv_id else deleted.get("csv_id"), removed=[deleted]
         )
         return {"message": "Record deleted successfully"}
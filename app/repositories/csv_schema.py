@@ -0,0 +1,105 @@
+import math
+import pandas as pd
+from app.errors import ValidationError
+
+INTEGER = "integer"
+FLOAT = "float"
+BOOLEAN = "boolean"
+STRING = "string"
+
+
+def _column_type(series: pd.Series) -> str:
+    if pd.api.types.is_bool_dtype(series):
+        return BOOLEAN
+    if pd.api.types.is_integer_dtype(series):
+        return INTEGER
+    if pd.api.types.is_float_dtype(series):
+        return FLOAT
+    return STRING
+
+
+def infer_schema(data: pd.DataFrame) -> dict:
+    return {
+        column: _column_type(data[column])
+        for column in data.columns
+        if column not in ("_id", "csv_id")
+    }
+
+
+def _merge_type(a: str, b: str) -> str:
+    if a == b:
+        return a
+    if {a, b} == {INTEGER, FLOAT}:
+        return FLOAT
+    return STRING
+
+
+def merge_schema(schema: dict, data: pd.DataFrame) -> dict:
+    chunk = infer_schema(data)
+    if schema is None:
+        return chunk
+
+    return {
+        column: _merge_type(schema[column], chunk.get(column, schema[column]))
+        for column in schema
+    }
+
+
+def to_document(schema: dict) -> list:
+    # a list keeps the csv column order and allows any column name
+    return [
+        {"name": column, "type": column_type} for column, column_type in schema.items()
+    ]
+
+
+def from_document(columns: list) -> dict:
+    return {column["name"]: column["type"] for column in columns}
+
+
+def coerce(value, column_type: str, column: str):
+    if value is None:
+        return None
+
+    try:
+        if column_type == BOOLEAN:
+            if isinstance(value, str):
+                if value.lower() not in ("true", "false", "1", "0"):
+                    raise ValueError(value)
+                return value.lower() in ("true", "1")
+            return bool(value)
+
+        if column_type in (INTEGER, FLOAT):
+            if isinstance(value, bool):
+                raise ValueError(value)
+            if isinstance(value, int):
+                return value
+            if isinstance(value, str) and value.strip().lstrip("+-").isdigit():
+                return int(value)
+            number = float(value)
+            if math.isnan(number):
+                raise ValueError(value)
+            # integral values stay ints so they compare exactly with int64
+            if number.is_integer() and abs(number) < 2**53:
+                return int(number)
+            return number
+
+        return str(value)
+    except (TypeError, ValueError):
+        raise ValidationError(
+            f"Invalid value for {column_type} column {column}: {value}"
+        )
+
+
+def coerce_row(row: dict, schema: dict) -> dict:
+    """Coerces the values of a written row to the dataset's column types;
+    columns the schema does not know are kept as they are.
+    """
+    coerced = {}
+    for column, value in row.items():
+        # missing cells are stored as null
+        if isinstance(value, float) and math.isnan(value):
+            value = None
+        if column in schema:
+            value = coerce(value, schema[column], column)
+        coerced[column] = value
+    return coerced
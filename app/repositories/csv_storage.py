@@ -0,0 +1,773 @@
+import fcntl
+import math
+import os
+import shutil
+from contextlib import contextmanager
+from bson import ObjectId
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from pymongo import DeleteOne, InsertOne, ReturnDocument, UpdateOne
+from pymongo.database import Database
+from pymongo.errors import BulkWriteError
+from app.errors import DatabaseError, ValidationError
+from app.repositories import csv_export, csv_query, csv_summaries
+
+BULK_STATUSES = {"insert": "inserted", "update": "updated", "delete": "deleted"}
+
+
+def _null_nan(row: dict) -> dict:
+    # missing cells are stored as null, which both backends sort first and
+    # match with is_null; mongo keeps NaN as a value that no range matches
+    return {
+        column: None if isinstance(value, float) and math.isnan(value) else value
+        for column, value in row.items()
+    }
+
+
+class MongoCsvStorage:
+    """Stores every csv row as its own document in db.csv."""
+
+    name = "mongo"
+
+    def __init__(self, db: Database, insert_batch_size: int = 5000) -> None:
+        self.db = db
+        self.insert_batch_size = insert_batch_size
+
+    def write_chunk(self, csv_id: ObjectId, chunk: pd.DataFrame) -> None:
+        # insert the csv id into the csv data
+        chunk = chunk.assign(csv_id=csv_id)
+        records = chunk.astype(object).where(chunk.notna(), None).to_dict("records")
+
+        try:
+            for start in range(0, len(records), self.insert_batch_size):
+                self.db.csv.insert_many(
+                    records[start : start + self.insert_batch_size],
+                    ordered=False,
+                )
+        except BulkWriteError as e:
+            raise DatabaseError(f"Failed to insert CSV data: {e.details}")
+
+    def get_page(
+        self, csv_id: ObjectId, page_size: int, after: str = None, page: int = None
+    ) -> list:
+        query = {"csv_id": csv_id}
+        if after is not None:
+            query["_id"] = {"$gt": ObjectId(after)}
+
+        cursor = self.db.csv.find(query, {"csv_id": 0}).sort("_id", 1)
+        if after is None and page:
+            # page numbers are still accepted but cost a skip over every
+            # earlier row
+            cursor = cursor.skip((page - 1) * page_size)
+
+        rows = list(cursor.limit(page_size + 1))
+        for row in rows:
+            row["_id"] = str(row["_id"])
+        return rows
+
+    def query(
+        self,
+        csv_id: ObjectId,
+        conditions: dict,
+        columns: list,
+        sort: list,
+        limit: int,
+        after: dict = None,
+        with_total: bool = False,
+    ) -> tuple:
+        # csv_id comes first so the compound and per-dataset indexes apply
+        query = {"csv_id": csv_id}
+        if conditions:
+            query["$and"] = [csv_query.compile_mongo(conditions)]
+
+        page_query = dict(query)
+        if after:
+            page_query["$and"] = [
+                *query.get("$and", []),
+                csv_query.compile_mongo(after),
+            ]
+
+        projection = {"csv_id": 0}
+        if columns:
+            projection = {column: 1 for column in [*columns, *(c for c, _ in sort)]}
+
+        cursor = (
+            self.db.csv.find(page_query, projection)
+            .sort([(c, 1 if d == "asc" else -1) for c, d in sort] + [("_id", 1)])
+            .limit(limit)
+        )
+
+        rows = list(cursor)
+        for row in rows:
+            row["_id"] = str(row["_id"])
+
+        total = self.db.csv.count_documents(query) if with_total else None
+        return rows, total
+
+    def iter_frames(self, csv_id: ObjectId, chunk_size: int, columns: list = None):
+        projection = {"csv_id": 0}
+        if columns:
+            projection = {column: 1 for column in columns}
+
+        cursor = self.db.csv.find({"csv_id": csv_id}, projection, batch_size=chunk_size)
+
+        batch = []
+        for row in cursor:
+            row["_id"] = str(row["_id"])
+            batch.append(row)
+            if len(batch) == chunk_size:
+                yield pd.DataFrame(batch)
+                batch = []
+
+        if batch:
+            yield pd.DataFrame(batch)
+
+    def read_frame(self, csv_id: ObjectId, columns: list = None) -> pd.DataFrame:
+        frames = list(self.iter_frames(csv_id, 100000, columns))
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+    def export_batches(self, csv_id: ObjectId, fields: list, batch_size: int):
+        # the cursor fetches batch_size rows at a time in _id order, so only
+        # one batch is held in memory however large the dataset is
+        cursor = self.db.csv.find(
+            {"csv_id": csv_id},
+            {name: 1 for name, _ in fields},
+            batch_size=batch_size,
+        ).sort("_id", 1)
+
+        rows = []
+        for row in cursor:
+            row["_id"] = str(row["_id"])
+            rows.append(row)
+            if len(rows) == batch_size:
+                yield csv_export.rows_to_batch(rows, fields)
+                rows = []
+
+        if rows:
+            yield csv_export.rows_to_batch(rows, fields)
+
+    def find_outliers(self, csv_id: ObjectId, bounds: dict) -> dict:
+        """Values outside (lower, upper) bounds per column, by row id, all
+        found with one query.
+        """
+        if not bounds:
+            return {}
+
+        # the infinite guards keep NaN and non-numeric values out of both
+        # ranges
+        branches = []
+        for column, (lower_bound, upper_bound) in bounds.items():
+            branches.append({column: {"$gte": float("-inf"), "$lt": lower_bound}})
+            branches.append({column: {"$gt": upper_bound, "$lte": float("inf")}})
+
+        outliers = {column: {} for column in bounds}
+        for row in self.db.csv.find(
+            {"csv_id": csv_id, "$or": branches}, {column: 1 for column in bounds}
+        ):
+            # a row matched by one column may hold ordinary values in others
+            for column, (lower_bound, upper_bound) in bounds.items():
+                value = row.get(column)
+                if csv_summaries.is_summary_value(value) and not (
+                    lower_bound <= value <= upper_bound
+                ):
+                    outliers[column][str(row["_id"])] = value
+        return outliers
+
+    def compute_statistics(self, csv_id: ObjectId, columns: list) -> dict:
+        # one pass for counts and sums, then per-column sorted rank lookups
+        # and a value count, so only a few documents leave the server
+        group = {"_id": None}
+        for i, column in enumerate(columns):
+            valid = {
+                "$and": [
+                    {"$isNumber": f"${column}"},
+                    {"$gte": [f"${column}", float("-inf")]},
+                ]
+            }
+            group[f"n{i}"] = {"$sum": {"$cond": [valid, 1, 0]}}
+            group[f"s{i}"] = {"$sum": {"$cond": [valid, f"${column}", 0]}}
+
+        totals = next(
+            self.db.csv.aggregate(
+                [{"$match": {"csv_id": csv_id}}, {"$group": group}],
+                allowDiskUse=True,
+            ),
+            None,
+        )
+
+        statistics = {}
+        for i, column in enumerate(columns):
+            count = totals[f"n{i}"] if totals else 0
+            if not count:
+                continue
+
+            quartiles = self._quartiles(csv_id, column, count)
+            statistics[column] = {
+                "mean": totals[f"s{i}"] / count,
+                "median": quartiles[0.5],
+                "mode": self._mode(csv_id, column),
+                "quartiles": quartiles,
+            }
+
+        return statistics
+
+    def _numeric_match(self, csv_id: ObjectId, column: str) -> dict:
+        # comparing with -inf matches numbers only and leaves NaN out
+        return {"$match": {"csv_id": csv_id, column: {"$gte": float("-inf")}}}
+
+    def _quartiles(self, csv_id: ObjectId, column: str, count: int) -> dict:
+        # $percentile only offers an approximate method, so the exact values
+        # around each rank are fetched and interpolated the way pandas does
+        positions = {
+            q: csv_summaries.quantile_position(count, q)
+            for q in csv_summaries.QUARTILES
+        }
+        facets = {
+            f"q{i}": [{"$skip": lower}, {"$limit": 2}]
+            for i, (lower, _, _) in enumerate(positions.values())
+        }
+
+        result = next(
+            self.db.csv.aggregate(
+                [
+                    self._numeric_match(csv_id, column),
+                    {"$sort": {column: 1}},
+                    {"$project": {"_id": 0, "value": f"${column}"}},
+                    {"$facet": facets},
+                ],
+                allowDiskUse=True,
+            )
+        )
+
+        quartiles = {}
+        for i, (q, (lower, upper, t)) in enumerate(positions.items()):
+            values = [row["value"] for row in result[f"q{i}"]]
+            quartiles[q] = float(csv_summaries.lerp(values[0], values[-1], t))
+        return quartiles
+
+    def _mode(self, csv_id: ObjectId, column: str) -> float:
+        # ties resolve to the smallest value, like pandas' mode().iloc[0]
+        result = next(
+            self.db.csv.aggregate(
+                [
+                    self._numeric_match(csv_id, column),
+                    {"$group": {"_id": f"${column}", "count": {"$sum": 1}}},
+                    {"$sort": {"count": -1, "_id": 1}},
+                    {"$limit": 1},
+                ],
+                allowDiskUse=True,
+            )
+        )
+        return float(result["_id"])
+
+    def insert_record(self, csv_id: ObjectId, row: dict) -> dict:
+        row = {**_null_nan(row), "csv_id": csv_id}
+        self.db.csv.insert_one(row)
+        return row
+
+    def update_record(self, csv_id: ObjectId, record_id: str, updated_row: dict):
+        query = {"_id": ObjectId(record_id)}
+        if csv_id is not None:
+            query["csv_id"] = csv_id
+
+        return self.db.csv.find_one_and_update(
+            query,
+            {"$set": _null_nan(updated_row)},
+            return_document=ReturnDocument.BEFORE,
+        )
+
+    def delete_record(self, csv_id: ObjectId, record_id: str):
+        query = {"_id": ObjectId(record_id)}
+        if csv_id is not None:
+            query["csv_id"] = csv_id
+
+        return self.db.csv.find_one_and_delete(query)
+
+    def bulk_write(self, csv_id: ObjectId, operations: list) -> tuple:
+        # the previous rows are read in one query so the summaries can be
+        # adjusted for every update and delete in the batch
+        ids = [ObjectId(o["_id"]) for o in operations if o["op"] != "insert"]
+        previous = {}
+        if ids:
+            previous = {
+                row["_id"]: row
+                for row in self.db.csv.find({"csv_id": csv_id, "_id": {"$in": ids}})
+            }
+
+        results = []
+        pending = []
+        for operation in operations:
+            result = {"index": operation["index"], "op": operation["op"]}
+            results.append(result)
+
+            if operation["op"] == "insert":
+                row = {
+                    "_id": ObjectId(),
+                    **_null_nan(operation["row"]),
+                    "csv_id": csv_id,
+                }
+                result["_id"] = str(row["_id"])
+                pending.append((result, InsertOne(row), [row], []))
+                continue
+
+            result["_id"] = operation["_id"]
+            old = previous.get(ObjectId(operation["_id"]))
+            if old is None:
+                result["status"] = "not_found"
+                continue
+
+            query = {"_id": old["_id"], "csv_id": csv_id}
+            if operation["op"] == "update":
+                row = _null_nan(operation["row"])
+                pending.append(
+                    (
+                        result,
+                        UpdateOne(query, {"$set": row}),
+                        [{**old, **row}],
+                        [old],
+                    )
+                )
+            else:
+                pending.append((result, DeleteOne(query), [], [old]))
+
+        failed = {}
+        if pending:
+            try:
+                self.db.csv.bulk_write([p[1] for p in pending], ordered=False)
+            except BulkWriteError as e:
+                # unordered writes carry on past failures, which are reported
+                # by their position in the request list
+                failed = {
+                    error["index"]: error["errmsg"]
+                    for error in e.details.get("writeErrors", [])
+                }
+
+        added, removed = [], []
+        for i, (result, _, rows_added, rows_removed) in enumerate(pending):
+            if i in failed:
+                result.update(status="failed", error=failed[i])
+                continue
+            result["status"] = BULK_STATUSES[result["op"]]
+            added.extend(rows_added)
+            removed.extend(rows_removed)
+
+        return results, added, removed
+
+    def delete_dataset(self, csv_id: ObjectId) -> None:
+        self.db.csv.delete_many({"csv_id": csv_id})
+
+
+class ArrowCsvStorage:
+    """Stores each dataset as uncompressed Arrow IPC part files on disk.
+
+    Reads memory-map the part files, so selecting columns does not copy or
+    decode the data. Mongo only keeps the dataset metadata.
+    """
+
+    name = "arrow"
+
+    def __init__(self, folder: str, part_size: int = 50000) -> None:
+        self.folder = folder
+        self.part_size = part_size
+
+    def _dataset_folder(self, csv_id: ObjectId) -> str:
+        return os.path.join(self.folder, "datasets", str(csv_id))
+
+    def _parts(self, csv_id: ObjectId) -> list:
+        folder = self._dataset_folder(csv_id)
+        if not os.path.isdir(folder):
+            return []
+        return sorted(
+            os.path.join(folder, name)
+            for name in os.listdir(folder)
+            if name.endswith(".arrow")
+        )
+
+    @contextmanager
+    def _lock(self, csv_id: ObjectId):
+        folder = self._dataset_folder(csv_id)
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_part(self, path: str, columns: list = None) -> pa.Table:
+        with pa.memory_map(path, "r") as source:
+            table = pa.ipc.open_file(source).read_all()
+        if columns:
+            table = table.select([c for c in columns if c in table.column_names])
+        return table
+
+    def _write_part(self, path: str, table: pa.Table) -> None:
+        tmp_path = f"{path}.tmp"
+        with pa.OSFile(tmp_path, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        # readers that still map the old file keep a valid view of it
+        os.replace(tmp_path, path)
+
+    def _next_part_path(self, csv_id: ObjectId) -> str:
+        parts = self._parts(csv_id)
+        index = int(os.path.basename(parts[-1])[5:10]) + 1 if parts else 0
+        return os.path.join(self._dataset_folder(csv_id), f"part-{index:05d}.arrow")
+
+    def _to_table(self, frame: pd.DataFrame) -> pa.Table:
+        return pa.Table.from_pandas(frame, preserve_index=False)
+
+    def _new_ids(self, csv_id: ObjectId, count: int) -> list:
+        # ids always increase in storage order so they can serve as keyset
+        # cursors, and the last issued id is kept so ids of deleted rows are
+        # never handed out again; callers must hold the dataset lock
+        base = int(str(ObjectId()), 16)
+        last_id_path = os.path.join(self._dataset_folder(csv_id), ".last_id")
+        if os.path.exists(last_id_path):
+            with open(last_id_path) as f:
+                base = max(base, int(f.read(), 16) + 1)
+        parts = self._parts(csv_id)
+        if parts:
+            ids = self._read_part(parts[-1], ["_id"])["_id"]
+            if len(ids):
+                base = max(base, int(ids[-1].as_py(), 16) + 1)
+
+        with open(last_id_path, "w") as f:
+            f.write(format(base + count - 1, "024x"))
+        return [format(base + i, "024x") for i in range(count)]
+
+    def write_chunk(self, csv_id: ObjectId, chunk: pd.DataFrame) -> None:
+        with self._lock(csv_id):
+            chunk = chunk.copy()
+            chunk.insert(0, "_id", self._new_ids(csv_id, len(chunk)))
+            self._write_part(self._next_part_path(csv_id), self._to_table(chunk))
+
+    def _read_table(self, csv_id: ObjectId, columns: list = None) -> pa.Table:
+        tables = [self._read_part(path, columns) for path in self._parts(csv_id)]
+        if not tables:
+            return pa.table({})
+        return pa.concat_tables(tables, promote_options="permissive")
+
+    def get_page(
+        self, csv_id: ObjectId, page_size: int, after: str = None, page: int = None
+    ) -> list:
+        offset = (page - 1) * page_size if after is None and page else 0
+        rows = []
+
+        for path in self._parts(csv_id):
+            if len(rows) > page_size:
+                break
+            table = self._read_part(path)
+            if after is not None:
+                # ids are increasing across parts, so whole parts before the
+                # cursor are skipped by looking at their last id only
+                ids = table["_id"]
+                if not table.num_rows or ids[-1].as_py() <= after:
+                    continue
+                table = table.slice(pc.sum(pc.less_equal(ids, after)).as_py() or 0)
+            if offset >= table.num_rows:
+                offset -= table.num_rows
+                continue
+            rows.extend(table.slice(offset, page_size + 1 - len(rows)).to_pylist())
+            offset = 0
+
+        return rows
+
+    def iter_frames(self, csv_id: ObjectId, chunk_size: int, columns: list = None):
+        for path in self._parts(csv_id):
+            table = self._read_part(path, columns)
+            for start in range(0, table.num_rows, chunk_size):
+                yield table.slice(start, chunk_size).to_pandas()
+
+    def read_frame(self, csv_id: ObjectId, columns: list = None) -> pd.DataFrame:
+        return self._read_table(csv_id, columns).to_pandas()
+
+    def export_batches(self, csv_id: ObjectId, fields: list, batch_size: int):
+        names = [name for name, _ in fields]
+        for path in self._parts(csv_id):
+            table = csv_export.conform_table(self._read_part(path, names), fields)
+            yield from table.to_batches(max_chunksize=batch_size)
+
+    def query(
+        self,
+        csv_id: ObjectId,
+        conditions: dict,
+        columns: list,
+        sort: list,
+        limit: int,
+        after: dict = None,
+        with_total: bool = False,
+    ) -> tuple:
+        expression = csv_query.compile_arrow(conditions) if conditions else None
+        after_expression = csv_query.compile_arrow(after) if after else None
+        selected = None
+        if columns:
+            selected = list(dict.fromkeys(["_id", *columns, *(c for c, _ in sort)]))
+
+        tables = []
+        rows_found = 0
+        total = 0
+        for path in self._parts(csv_id):
+            table = self._read_part(path)
+            if expression is not None:
+                table = table.filter(expression)
+            total += table.num_rows
+            if after_expression is not None:
+                table = table.filter(after_expression)
+            if selected:
+                table = table.select([c for c in selected if c in table.column_names])
+            tables.append(table)
+            rows_found += table.num_rows
+            # without a sort the parts are already in _id order
+            if not sort and not with_total and rows_found >= limit:
+                break
+
+        if not tables:
+            return [], 0 if with_total else None
+
+        table = pa.concat_tables(tables, promote_options="permissive")
+        if sort:
+            # a validity key per column puts nulls first ascending and last
+            # descending, matching mongo's ordering and the keyset cursor
+            sort_keys = []
+            for i, (column, direction) in enumerate(sort):
+                order = "ascending" if direction == "asc" else "descending"
+                table = table.append_column(f"__valid_{i}", pc.is_valid(table[column]))
+                sort_keys += [(f"__valid_{i}", order), (column, order)]
+            indices = pc.sort_indices(
+                table, sort_keys=sort_keys + [("_id", "ascending")]
+            )
+            table = table.take(indices.slice(0, limit)).drop_columns(
+                [f"__valid_{i}" for i in range(len(sort))]
+            )
+
+        return table.slice(0, limit).to_pylist(), total if with_total else None
+
+    def find_outliers(self, csv_id: ObjectId, bounds: dict) -> dict:
+        outliers = {column: {} for column in bounds}
+        if not bounds:
+            return outliers
+
+        for path in self._parts(csv_id):
+            table = self._read_part(path, ["_id", *bounds])
+            for column, (lower_bound, upper_bound) in bounds.items():
+                if column not in table.column_names:
+                    continue
+                values = table[column]
+                mask = pc.or_(
+                    pc.less(values, lower_bound), pc.greater(values, upper_bound)
+                )
+                matches = table.filter(pc.fill_null(mask, False))
+                outliers[column].update(
+                    zip(matches["_id"].to_pylist(), matches[column].to_pylist())
+                )
+        return outliers
+
+    def _find_part(self, csv_id: ObjectId, record_id: str):
+        for path in self._parts(csv_id):
+            ids = self._read_part(path, ["_id"])["_id"]
+            positions = pc.indices_nonzero(pc.equal(ids, record_id))
+            if len(positions):
+                return path, positions[0].as_py()
+        return None, None
+
+    def insert_record(self, csv_id: ObjectId, row: dict) -> dict:
+        with self._lock(csv_id):
+            row = {"_id": self._new_ids(csv_id, 1)[0], **_null_nan(row)}
+            parts = self._parts(csv_id)
+            new_rows = pa.Table.from_pylist([row])
+            # small inserts are appended to the last part until it is full
+            if parts and self._read_part(parts[-1], ["_id"]).num_rows < self.part_size:
+                path = parts[-1]
+                try:
+                    table = pa.concat_tables(
+                        [self._read_part(path), new_rows],
+                        promote_options="permissive",
+                    )
+                except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+                    raise ValidationError(f"Record does not match the schema: {e}")
+            else:
+                path, table = self._next_part_path(csv_id), new_rows
+            self._write_part(path, table)
+
+        return row
+
+    def _apply_update(
+        self, table: pa.Table, mask: pa.Array, updated_row: dict
+    ) -> pa.Table:
+        for column, value in _null_nan(updated_row).items():
+            if column not in table.column_names:
+                field_type = pa.array([value]).type
+                table = table.append_column(
+                    column, pa.nulls(table.num_rows, field_type)
+                )
+            field_type = table.schema.field(column).type
+            try:
+                values = pc.replace_with_mask(
+                    table[column].combine_chunks(),
+                    mask,
+                    pa.array([value], type=field_type),
+                )
+            except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError):
+                raise ValidationError(
+                    f"Invalid value for column {column}, expected {field_type}"
+                )
+            table = table.set_column(table.column_names.index(column), column, values)
+        return table
+
+    def update_record(self, csv_id: ObjectId, record_id: str, updated_row: dict):
+        with self._lock(csv_id):
+            path, position = self._find_part(csv_id, record_id)
+            if path is None:
+                return None
+
+            table = self._read_part(path)
+            previous = table.slice(position, 1).to_pylist()[0]
+            mask = pc.equal(table["_id"], record_id).combine_chunks()
+            self._write_part(path, self._apply_update(table, mask, updated_row))
+
+        return previous
+
+    def delete_record(self, csv_id: ObjectId, record_id: str):
+        with self._lock(csv_id):
+            path, position = self._find_part(csv_id, record_id)
+            if path is None:
+                return None
+
+            table = self._read_part(path)
+            previous = table.slice(position, 1).to_pylist()[0]
+            remaining = pa.concat_tables(
+                [table.slice(0, position), table.slice(position + 1)]
+            )
+            if remaining.num_rows:
+                self._write_part(path, remaining)
+            else:
+                os.remove(path)
+
+        return previous
+
+    def _bulk_changes(self, csv_id: ObjectId, changes: dict, results: dict) -> tuple:
+        added, removed = [], []
+        if not changes:
+            return added, removed
+
+        targets = pa.array(list(changes), pa.string())
+        for path in self._parts(csv_id):
+            table = self._read_part(path)
+            touched = table["_id"].filter(pc.is_in(table["_id"], targets))
+            if not len(touched):
+                continue
+
+            for record_id in touched.to_pylist():
+                operation = changes.pop(record_id)
+                result = results[operation["index"]]
+                mask = pc.equal(table["_id"], record_id).combine_chunks()
+                old = table.filter(mask).to_pylist()[0]
+
+                if operation["op"] == "delete":
+                    table = table.filter(pc.invert(mask))
+                else:
+                    try:
+                        table = self._apply_update(table, mask, operation["row"])
+                    except ValidationError as e:
+                        result.update(status="failed", error=e.message)
+                        continue
+                    added.append({**old, **operation["row"]})
+                removed.append(old)
+                result["status"] = BULK_STATUSES[operation["op"]]
+
+            if table.num_rows:
+                self._write_part(path, table)
+            else:
+                os.remove(path)
+
+        return added, removed
+
+    def _bulk_inserts(self, csv_id: ObjectId, inserts: list, results: dict) -> list:
+        if not inserts:
+            return []
+
+        parts = self._parts(csv_id)
+        last = self._read_part(parts[-1]) if parts else None
+        # starting from the last part's schema rejects rows that could not be
+        # stored next to the existing ones
+        table = last.slice(0, 0) if last is not None else None
+        added = []
+
+        for operation, record_id in zip(inserts, self._new_ids(csv_id, len(inserts))):
+            result = results[operation["index"]]
+            row = {"_id": record_id, **_null_nan(operation["row"])}
+            rows = pa.Table.from_pylist([row])
+            try:
+                table = (
+                    rows
+                    if table is None
+                    else pa.concat_tables([table, rows], promote_options="permissive")
+                )
+            except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+                result.update(
+                    status="failed", error=f"Record does not match the schema: {e}"
+                )
+                continue
+            result.update(status="inserted", _id=record_id)
+            added.append(row)
+
+        if not added:
+            return added
+
+        table = table.combine_chunks()
+        if last is not None and last.num_rows + table.num_rows <= self.part_size:
+            merged = pa.concat_tables([last, table], promote_options="permissive")
+            self._write_part(parts[-1], merged.combine_chunks())
+        else:
+            for start in range(0, table.num_rows, self.part_size):
+                self._write_part(
+                    self._next_part_path(csv_id), table.slice(start, self.part_size)
+                )
+
+        return added
+
+    def bulk_write(self, csv_id: ObjectId, operations: list) -> tuple:
+        results = {}
+        for operation in operations:
+            results[operation["index"]] = {
+                "index": operation["index"],
+                "op": operation["op"],
+                "status": "not_found",
+            }
+            if operation["op"] != "insert":
+                results[operation["index"]]["_id"] = operation["_id"]
+
+        with self._lock(csv_id):
+            # every part is rewritten at most once for the whole batch
+            added, removed = self._bulk_changes(
+                csv_id,
+                {o["_id"]: o for o in operations if o["op"] != "insert"},
+                results,
+            )
+            added += self._bulk_inserts(
+                csv_id, [o for o in operations if o["op"] == "insert"], results
+            )
+
+        return list(results.values()), added, removed
+
+    def delete_dataset(self, csv_id: ObjectId) -> None:
+        shutil.rmtree(self._dataset_folder(csv_id), ignore_errors=True)
+
+
+def create_csv_storages(db: Database, folder: str, **options) -> dict:
+    return {
+        MongoCsvStorage.name: MongoCsvStorage(
+            db, insert_batch_size=options.get("insert_batch_size", 5000)
+        ),
+        ArrowCsvStorage.name: ArrowCsvStorage(
+            folder, part_size=options.get("part_size", 50000)
+        ),
+    }
+
+
+def get_storage(storages: dict, name: str):
+    if name not in storages:
+        raise ValidationError(f"Unknown CSV storage backend: {name}")
+    return storages[name]
@@ -0,0 +1,234 @@
+import math
+import numpy as np
+import pandas as pd
+
+# relative accuracy of the quantile sketch used once a column has too many
+# distinct values to keep exact frequency counts
+RELATIVE_ACCURACY = 0.01
+_GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+_LOG_GAMMA = math.log(_GAMMA)
+
+QUARTILES = (0.25, 0.5, 0.75)
+
+
+def encode_key(value: str) -> str:
+    # mongo field names cannot contain "." or start with "$"
+    return str(value).replace(".", "．").replace("$", "＄")
+
+
+def decode_key(key: str) -> str:
+    return key.replace("．", ".").replace("＄", "$")
+
+
+def _encode_value(value: float) -> str:
+    value = float(value)
+    if value == 0:
+        value = 0.0
+    return encode_key(repr(value))
+
+
+def _decode_value(key: str) -> float:
+    return float(decode_key(key))
+
+
+def is_summary_value(value) -> bool:
+    if isinstance(value, bool) or not isinstance(value, (int, float, np.number)):
+        return False
+    return not math.isnan(value)
+
+
+def _is_numeric_column(series: pd.Series) -> bool:
+    return (
+        pd.api.types.is_integer_dtype(series) or pd.api.types.is_float_dtype(series)
+    ) and not pd.api.types.is_bool_dtype(series)
+
+
+def _bucket_index(value: float) -> int:
+    return int(math.ceil(math.log(value) / _LOG_GAMMA))
+
+
+def _bucket_value(index: int) -> float:
+    return 2 * _GAMMA**index / (_GAMMA + 1)
+
+
+def _buckets(values: np.ndarray) -> dict:
+    if not values.size:
+        return {}
+    indexes = np.ceil(np.log(values) / _LOG_GAMMA).astype(np.int64)
+    keys, counts = np.unique(indexes, return_counts=True)
+    return {str(k): int(c) for k, c in zip(keys, counts)}
+
+
+def summarize_values(values: np.ndarray, max_distinct: int) -> dict:
+    unique, counts = np.unique(values, return_counts=True)
+    finite = values[np.isfinite(values)]
+
+    return {
+        "count": int(values.size),
+        "sum": float(values.sum()),
+        "sketch": {
+            "zero": int((finite == 0).sum()),
+            "pos": _buckets(finite[finite > 0]),
+            "neg": _buckets(-finite[finite < 0]),
+        },
+        "freq": (
+            {_encode_value(v): int(c) for v, c in zip(unique, counts)}
+            if len(unique) <= max_distinct
+            else None
+        ),
+    }
+
+
+def summarize_frame(data: pd.DataFrame, max_distinct: int) -> dict:
+    summaries = {}
+    for column in data.columns:
+        if column in ("_id", "csv_id") or not _is_numeric_column(data[column]):
+            continue
+        values = data[column].dropna().to_numpy(dtype="float64")
+        summaries[column] = summarize_values(values, max_distinct)
+    return summaries
+
+
+def _merge_counts(a: dict, b: dict) -> dict:
+    merged = dict(a)
+    for key, count in b.items():
+        merged[key] = merged.get(key, 0) + count
+    return merged
+
+
+def merge_summary(a: dict, b: dict, max_distinct: int) -> dict:
+    freq = None
+    if a["freq"] is not None and b["freq"] is not None:
+        freq = _merge_counts(a["freq"], b["freq"])
+        if len(freq) > max_distinct:
+            freq = None
+
+    return {
+        "count": a["count"] + b["count"],
+        "sum": a["sum"] + b["sum"],
+        "sketch": {
+            "zero": a["sketch"]["zero"] + b["sketch"]["zero"],
+            "pos": _merge_counts(a["sketch"]["pos"], b["sketch"]["pos"]),
+            "neg": _merge_counts(a["sketch"]["neg"], b["sketch"]["neg"]),
+        },
+        "freq": freq,
+    }
+
+
+def merge_frame(summaries: dict, data: pd.DataFrame, max_distinct: int) -> dict:
+    chunk = summarize_frame(data, max_distinct)
+    if summaries is None:
+        return chunk
+
+    # a column only stays summarized while every chunk parsed it as numeric
+    return {
+        column: merge_summary(summary, chunk[column], max_distinct)
+        for column, summary in summaries.items()
+        if column in chunk
+    }
+
+
+def to_document(summaries: dict) -> dict:
+    return {
+        "summaries": {encode_key(c): s for c, s in summaries.items()},
+        "summary_columns": {
+            encode_key(c): s["freq"] is not None for c, s in summaries.items()
+        },
+    }
+
+
+def value_delta(inc: dict, path: str, value, sign: int, tracks_freq: bool) -> None:
+    value = float(value)
+    inc[f"{path}.count"] = inc.get(f"{path}.count", 0) + sign
+    inc[f"{path}.sum"] = inc.get(f"{path}.sum", 0) + sign * value
+
+    if math.isfinite(value):
+        if value > 0:
+            bucket = f"{path}.sketch.pos.{_bucket_index(value)}"
+        elif value < 0:
+            bucket = f"{path}.sketch.neg.{_bucket_index(-value)}"
+        else:
+            bucket = f"{path}.sketch.zero"
+        inc[bucket] = inc.get(bucket, 0) + sign
+
+    if tracks_freq:
+        key = f"{path}.freq.{_encode_value(value)}"
+        inc[key] = inc.get(key, 0) + sign
+
+
+def quantile_position(n: int, q: float) -> tuple:
+    # same virtual index as numpy's default "linear" method used by pandas
+    virtual = n * q + (1 - q) - 1
+    lower = math.floor(virtual)
+    return lower, min(lower + 1, n - 1), virtual - lower
+
+
+def lerp(a: float, b: float, t: float) -> float:
+    # numpy's _lerp, so interpolated quantiles match pandas bit for bit
+    diff = b - a
+    if t >= 0.5:
+        return b - diff * (1 - t)
+    return a + diff * t
+
+
+def _exact_quantile(values: np.ndarray, cumulative: np.ndarray, q: float) -> float:
+    lower, upper, t = quantile_position(int(cumulative[-1]), q)
+    a = values[np.searchsorted(cumulative, lower, side="right")]
+    b = values[np.searchsorted(cumulative, upper, side="right")]
+    return float(lerp(a, b, t))
+
+
+def _sketch_items(sketch: dict) -> list:
+    items = [(-_bucket_value(int(i)), c) for i, c in sketch["neg"].items()]
+    items.append((0.0, sketch["zero"]))
+    items.extend((_bucket_value(int(i)), c) for i, c in sketch["pos"].items())
+    return sorted((v, c) for v, c in items if c > 0)
+
+
+def _sketch_quantile(items: list, n: int, q: float) -> float:
+    rank = q * (n - 1)
+    seen = 0
+    for value, count in items:
+        seen += count
+        if seen > rank:
+            return value
+    return items[-1][0]
+
+
+def column_statistics(summary: dict) -> dict:
+    n = summary["count"]
+    if n <= 0:
+        return None
+
+    statistics = {"mean": summary["sum"] / n}
+
+    freq = summary.get("freq")
+    if freq is not None:
+        items = sorted((_decode_value(k), c) for k, c in freq.items() if c > 0)
+    else:
+        items = _sketch_items(summary["sketch"])
+
+    if not items:
+        return None
+
+    values = np.array([v for v, _ in items])
+    counts = np.array([c for _, c in items])
+
+    if freq is not None:
+        cumulative = np.cumsum(counts)
+        quartiles = {q: _exact_quantile(values, cumulative, q) for q in QUARTILES}
+    else:
+        total = int(counts.sum())
+        quartiles = {q: _sketch_quantile(items, total, q) for q in QUARTILES}
+
+    # ties resolve to the smallest value, like pandas' mode().iloc[0]
+    statistics["mode"] = float(values[int(np.argmax(counts))])
+    statistics["median"] = quartiles[0.5]
+    statistics["quartiles"] = quartiles
+    statistics["exact"] = freq is not None
+    return statistics
+
+
+def outlier_bounds(quartiles: dict) -> tuple:
+    iqr = quartiles[0.75] - quartiles[0.25]
+    return quartiles[0.25] - 1.5 * iqr, quartiles[0.75] + 1.5 * iqr
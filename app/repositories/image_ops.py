@@ -0,0 +1,257 @@
+import hashlib
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import numpy as np
+from PIL import Image
+from skimage.segmentation import felzenszwalb
+from app.errors import ValidationError
+
+# functions here run in worker processes, so they only take and return
+# plain picklable values
+
+HISTOGRAM_BINS = 256
+CHANNELS = ("R", "G", "B")
+
+PERCEPTUAL_HASHES = ("ahash", "dhash", "phash")
+
+# pixels converted and counted at a time when building a histogram
+HISTOGRAM_STRIP_PIXELS = 1 << 20
+
+# peak memory of felzenszwalb per pixel of its input, measured on rgb
+# images with scikit-image 0.24
+SEGMENTATION_BYTES_PER_PIXEL = 320
+
+# leading bytes of each accepted image type: file extension
+MAGIC_BYTES = {b"\x89PNG\r\n\x1a\n": "png", b"\xff\xd8\xff": "jpg"}
+
+
+def sniff_image_type(header: bytes) -> str:
+    for magic, file_ext in MAGIC_BYTES.items():
+        if header.startswith(magic):
+            return file_ext
+    return None
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def decoded_bytes(size: tuple, mode: str) -> int:
+    return size[0] * size[1] * Image.getmodebands(mode)
+
+
+def check_decoded_size(size: tuple, mode: str, max_bytes: int) -> None:
+    if max_bytes and decoded_bytes(size, mode) > max_bytes:
+        raise ValidationError(
+            f"Image is too large: {size[0]}x{size[1]} {mode} pixels need more "
+            f"than the {max_bytes} bytes allowed per image"
+        )
+
+
+def draft_within(img: Image.Image, max_bytes: int) -> None:
+    """Has jpegs decode at the largest 1/2, 1/4 or 1/8 scale whose pixels
+    fit in max_bytes, and refuses images that do not fit at all.
+    """
+    if max_bytes:
+        factor = 1
+        while factor < 8 and decoded_bytes(img.size, img.mode) > max_bytes * factor**2:
+            factor *= 2
+        if factor > 1:
+            width, height = img.size
+            img.draft(img.mode, (math.ceil(width / factor), math.ceil(height / factor)))
+    check_decoded_size(img.size, img.mode, max_bytes)
+
+
+def histogram_counts(path: str, max_bytes: int = None) -> np.ndarray:
+    # one bincount per channel, shape (3, 256); jpegs too large to decode
+    # whole are counted at a reduced scale and their counts scaled back up
+    # to the full image's pixel count
+    counts = np.zeros((3, HISTOGRAM_BINS), np.int64)
+    with Image.open(path) as img:
+        width, height = img.size
+        draft_within(img, max_bytes)
+        # draft_within bounds the decode; strips bound the rgb copy and the
+        # bincount temporaries
+        rows = max(1, HISTOGRAM_STRIP_PIXELS // img.width)
+        for top in range(0, img.height, rows):
+            strip = img.crop((0, top, img.width, min(top + rows, img.height)))
+            pixels = np.asarray(strip.convert("RGB")).reshape(-1, 3)
+            for c in range(3):
+                counts[c] += np.bincount(pixels[:, c], minlength=HISTOGRAM_BINS)
+        scale = (width * height) / (img.width * img.height)
+    if scale != 1:
+        counts = np.rint(counts * scale).astype(np.int64)
+    return counts
+
+
+def bin_histogram(counts: np.ndarray, bins: int, normalize: bool) -> dict:
+    counts = np.asarray(counts).reshape(3, bins, -1).sum(axis=2)
+    values = counts / counts[0].sum() if normalize and counts[0].sum() else counts
+    return {channel: values[i].tolist() for i, channel in enumerate(CHANNELS)}
+
+
+def _pack_bits(bits: np.ndarray) -> str:
+    return np.packbits(bits.reshape(-1)).tobytes().hex()
+
+
+def perceptual_hashes(path: str, max_bytes: int = None) -> dict:
+    """64-bit average, difference and dct hashes as hex strings; similar
+    looking images differ in few bits.
+    """
+    with Image.open(path) as img:
+        # the hashes only need a thumbnail, which jpeg decodes at 1/8 scale
+        img.draft("L", (64, 64))
+        check_decoded_size(img.size, img.mode, max_bytes)
+        gray = img.convert("L")
+        small = np.asarray(gray.resize((32, 32), Image.LANCZOS), dtype=np.float32)
+        tiny = np.asarray(gray.resize((9, 8), Image.LANCZOS), dtype=np.float32)
+
+    average = small.reshape(8, 4, 8, 4).mean(axis=(1, 3))
+    dct = cv2.dct(small)[:8, :8]
+    return {
+        "ahash": _pack_bits(average > average.mean()),
+        "dhash": _pack_bits(tiny[:, 1:] > tiny[:, :-1]),
+        # the dc term is the mean brightness and is left out of the median
+        "phash": _pack_bits(dct > np.median(dct.reshape(-1)[1:])),
+    }
+
+
+def create_process_pool(max_workers: int) -> ProcessPoolExecutor:
+    # spawned workers do not inherit the app's threads, locks or mongo
+    # client the way forked ones would
+    return ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+def segment(path: str, mask_path: str, params: dict, max_bytes: int = None) -> dict:
+    started = time.perf_counter()
+    try:
+        img = Image.open(path)
+    except OSError:
+        raise ValueError("Error loading image")
+
+    with img:
+        width, height = img.size
+        factor = 1.0
+        max_side = params.get("max_side")
+        if max_side and max(height, width) > max_side:
+            factor = max_side / max(height, width)
+        # images that would take more than max_bytes to segment are
+        # segmented on a smaller level of their pyramid
+        if max_bytes:
+            max_pixels = max_bytes / SEGMENTATION_BYTES_PER_PIXEL
+            factor = min(factor, math.sqrt(max_pixels / (width * height)))
+
+        downscaled = factor < 1
+        size = (max(1, round(width * factor)), max(1, round(height * factor)))
+        if downscaled:
+            # jpegs decode straight to the pyramid level at or above it
+            img.draft("RGB", size)
+        check_decoded_size(img.size, "RGB", max_bytes)
+        img_rgb = np.asarray(img.convert("RGB"))
+
+    scale, sigma, min_size = params["scale"], params["sigma"], params["min_size"]
+    if downscaled:
+        # felzenszwalb is superlinear in the pixel count, so segmenting a
+        # smaller copy and upsampling the labels is much faster; the
+        # parameters are in pixels and shrink with the image
+        img_rgb = cv2.resize(img_rgb, size, interpolation=cv2.INTER_AREA)
+        scale *= factor * factor
+        sigma *= factor
+        min_size = max(1, round(min_size * factor * factor))
+
+    segments = felzenszwalb(img_rgb, scale=scale, sigma=sigma, min_size=min_size)
+
+    # Convert the segmentation result to an 8-bit image
+    mask = (segments * (255 / max(segments.max(), 1))).astype(np.uint8)
+    if downscaled and not (max_bytes and width * height > max_bytes):
+        # nearest neighbour keeps the labels as they are; masks larger
+        # than the limit stay at the size they were segmented at
+        mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_NEAREST)
+
+    tmp_path = f"{mask_path}.{os.getpid()}.tmp.png"
+    cv2.imwrite(tmp_path, mask)
+    os.replace(tmp_path, mask_path)
+
+    return {
+        "segments": int(segments.max()) + 1,
+        "width": width,
+        "height": height,
+        "downscaled": downscaled,
+        "mask_width": mask.shape[1],
+        "mask_height": mask.shape[0],
+        "elapsed_seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+def plan_pipeline(width: int, height: int, operations: list) -> dict:
+    """Folds resize, crop and convert steps into one source box, one output
+    size and one format, so the image is resampled and encoded only once.
+    """
+    left, top, right, bottom = 0.0, 0.0, float(width), float(height)
+    size = (width, height)
+    image_format = None
+
+    for operation in operations:
+        if operation["op"] == "resize":
+            size = (operation["width"], operation["height"])
+        elif operation["op"] == "crop":
+            box = [operation[k] for k in ("left", "top", "right", "bottom")]
+            if box[2] > size[0] or box[3] > size[1]:
+                raise ValidationError("Crop box is outside the image")
+            # crop coordinates are in the current output size
+            scale_x = (right - left) / size[0]
+            scale_y = (bottom - top) / size[1]
+            left, top, right, bottom = (
+                left + box[0] * scale_x,
+                top + box[1] * scale_y,
+                left + box[2] * scale_x,
+                top + box[3] * scale_y,
+            )
+            size = (box[2] - box[0], box[3] - box[1])
+        elif operation["op"] == "convert":
+            image_format = operation["format"]
+
+    return {
+        "box": [round(v, 6) for v in (left, top, right, bottom)],
+        "size": list(size),
+        "format": image_format,
+    }
+
+
+def apply_pipeline(img: Image.Image, plan: dict, max_bytes: int = None) -> Image.Image:
+    left, top, right, bottom = plan["box"]
+    size = tuple(plan["size"])
+    width, height = img.size
+    check_decoded_size(size, img.mode, max_bytes)
+
+    # jpeg can decode straight to 1/2, 1/4 or 1/8 scale when the output is
+    # that much smaller; other formats ignore the draft
+    img.draft(
+        img.mode,
+        (
+            math.ceil(width * size[0] / (right - left)),
+            math.ceil(height * size[1] / (bottom - top)),
+        ),
+    )
+    # pillow decodes every pixel before cropping, so the source counts
+    # against the limit at the scale it decodes at
+    check_decoded_size(img.size, img.mode, max_bytes)
+    scale_x, scale_y = img.size[0] / width, img.size[1] / height
+    box = (left * scale_x, top * scale_y, right * scale_x, bottom * scale_y)
+
+    if size == (box[2] - box[0], box[3] - box[1]) and all(
+        float(v).is_integer() for v in box
+    ):
+        # nothing to resample
+        return img.crop(tuple(int(v) for v in box))
+    return img.resize(size, Image.LANCZOS, box=box)
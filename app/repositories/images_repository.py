@@ -1,38 +1,111 @@
-from flask import jsonify
+import functools
+import hashlib
+import json
 import os
 from bson import ObjectId
 from werkzeug.utils import secure_filename
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from PIL import Image
+from PIL import Image, ImageFile
 import numpy as np
-import cv2
-from skimage.segmentation import felzenszwalb
-from skimage import io
 from app.errors import DatabaseError, ValidationError, NotFoundError
+from app.repositories import image_ops
+from app.repositories.job_repository import (
+    FAILED,
+    QUEUED,
+    RUNNING,
+    SUCCEEDED,
+    JobRepository,
+)
+from app.repositories.pagination import keyset_page
+from app.repositories.phash_index import PerceptualHashIndex
+from app.repositories.rendition_repository import EXTENSIONS, RenditionRepository
 from pymongo.database import Database
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+SEGMENTATION_JOB = "image_segmentation"
+BATCH_JOB = "image_batch"
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# mongo's error code for a write that violates a unique index
+DUPLICATE_KEY = 11000
+
+# requested format: pillow format name
+IMAGE_FORMATS = {"png": "PNG", "jpg": "JPEG", "jpeg": "JPEG"}
+
+# fields held by the listing index, so listing only these never reads
+# the image documents
+LISTING_FIELDS = (
+    "original_name",
+    "filename",
+    "uploaded_at",
+    "width",
+    "height",
+    "file_size",
+)
+# derived data stored outside the image documents, read only when asked for
+HEAVY_FIELDS = ("color_histogram",)
+IMAGE_FIELDS = (
+    *LISTING_FIELDS,
+    "file_path",
+    "content_hash",
+    "perceptual_hash",
+    "segmentation_mask",
+    *HEAVY_FIELDS,
+)
 
 
 class ImagesRepository:
-    def __init__(self, db: Database, upload_folder: str):
+    def __init__(
+        self,
+        db: Database,
+        upload_folder: str,
+        rendition_repository: RenditionRepository,
+        job_repository: JobRepository = None,
+        process_workers: int = None,
+        upload_workers: int = 4,
+        allowed_extensions: set = None,
+        batch_workers: int = 1,
+        batch_chunk_size: int = 32,
+        phash_index: PerceptualHashIndex = None,
+        max_decode_bytes: int = None,
+    ):
         if db is None:
             raise ValueError("db cannot be None")
         if upload_folder is None:
             raise ValueError("upload_folder cannot be None")
+        if rendition_repository is None:
+            raise ValueError("rendition_repository cannot be None")
         self.db = db
         self.upload_folder = upload_folder
+        self.rendition_repository = rendition_repository
+        self.job_repository = job_repository or JobRepository(db)
+        self.process_workers = process_workers
+        self.upload_workers = upload_workers
+        self.allowed_extensions = allowed_extensions or {"png", "jpg", "jpeg"}
+        self.batch_workers = batch_workers
+        self.batch_chunk_size = batch_chunk_size
+        self.max_decode_bytes = max_decode_bytes
+        self.phash_index = phash_index or PerceptualHashIndex(
+            os.path.join(os.getcwd(), "indexes/phash")
+        )
+        self._pool = None
+        self._batch_executor = None
 
-    def _generate_filepath(self, file, image_id) -> str:
-        file_ext = secure_filename(file.filename).split(".")[-1].lower()
+    def _generate_filepath(self, image_id, file_ext) -> str:
         return os.path.join(self.upload_folder, f"{str(image_id)}.{file_ext}")
 
-    def _get_image_dimensions(self, filepath) -> tuple:
-        with Image.open(filepath) as img:
-            width, height = img.size
-        file_size = os.path.getsize(filepath)
-        return width, height, file_size
-
     def _create_image_metadata(
-        self, image_id, original_name, filepath, width, height, file_size
+        self,
+        image_id,
+        original_name,
+        filepath,
+        width,
+        height,
+        file_size,
+        content_hash=None,
+        perceptual_hash=None,
     ) -> dict:
         return {
             "_id": image_id,
@@ -40,154 +113,868 @@ class ImagesRepository:
             "file_path": filepath,
             "filename": os.path.basename(filepath),
             "uploaded_at": datetime.now(),
-            "color_histogram": None,
+            # counts are in db.histograms under this content hash
+            "histogram_id": None,
             "segmentation_mask": None,
             "width": width,
             "height": height,
             "file_size": file_size,
+            "content_hash": content_hash,
+            "perceptual_hash": perceptual_hash,
         }
 
-    def _save_image_file(self, file) -> dict:
+    def _stream_image_file(self, file) -> dict:
+        # one pass over the upload writes it to disk, hashes it and feeds
+        # the header to a parser for the dimensions
         image_id = ObjectId()
-        filepath = self._generate_filepath(file, image_id)
-
-        file.save(filepath)
-        width, height, file_size = self._get_image_dimensions(filepath)
-
-        image_metadata = self._create_image_metadata(
-            image_id, file.filename, filepath, width, height, file_size
-        )
+        tmp_path = os.path.join(self.upload_folder, f"{image_id}.upload")
+        digest = hashlib.sha256()
+        parser = ImageFile.Parser()
+        file_ext = None
+        file_size = 0
+
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in iter(lambda: file.stream.read(UPLOAD_CHUNK_SIZE), b""):
+                    if file_ext is None:
+                        file_ext = image_ops.sniff_image_type(chunk)
+                        if file_ext not in self.allowed_extensions:
+                            raise ValidationError(
+                                f"Invalid file type: {secure_filename(file.filename)}"
+                            )
+                    if parser.image is None:
+                        parser.feed(chunk)
+                    digest.update(chunk)
+                    f.write(chunk)
+                    file_size += len(chunk)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+        if parser.image is None:
+            os.remove(tmp_path)
+            raise ValidationError(
+                f"Invalid image file: {secure_filename(file.filename)}"
+            )
+
+        width, height = parser.image.size
+        try:
+            perceptual_hash = image_ops.perceptual_hashes(
+                tmp_path, self.max_decode_bytes
+            )
+        except Exception:
+            # a file whose pixels cannot be decoded is still stored as it
+            # was before, it just never shows up in similarity searches
+            perceptual_hash = None
 
-        self.db.images.insert_one(image_metadata)
-        return {**image_metadata, "_id": str(image_id)}
+        return {
+            "tmp_path": tmp_path,
+            "metadata": self._create_image_metadata(
+                image_id,
+                file.filename,
+                self._generate_filepath(image_id, file_ext),
+                width,
+                height,
+                file_size,
+                digest.hexdigest(),
+                perceptual_hash,
+            ),
+        }
 
     def upload_images(self, files):
+        # several files are streamed at once; reading the upload and writing
+        # to disk release the GIL
+        if len(files) > 1:
+            with ThreadPoolExecutor(
+                max_workers=min(len(files), self.upload_workers)
+            ) as executor:
+                futures = [executor.submit(self._stream_image_file, f) for f in files]
+            stored, errors = [], []
+            for future in futures:
+                try:
+                    stored.append(future.result())
+                except Exception as e:
+                    errors.append(e)
+        else:
+            stored, errors = [], []
+            try:
+                stored.append(self._stream_image_file(files[0]))
+            except Exception as e:
+                errors.append(e)
+
+        if errors:
+            # the batch is stored all or nothing
+            for upload in stored:
+                os.remove(upload["tmp_path"])
+            raise errors[0]
+
+        # duplicate content returns the image that is already stored
+        hashes = [upload["metadata"]["content_hash"] for upload in stored]
+        existing = {}
+        for image in self.db.images.find(
+            {"content_hash": {"$in": hashes}}, {"color_histogram": 0}
+        ).sort("_id", 1):
+            existing.setdefault(image["content_hash"], image)
+
+        new_images = []
         saved_files = []
-        for file in files:
-            saved_files.append(self._save_image_file(file))
+        for upload in stored:
+            metadata = upload["metadata"]
+            duplicate = existing.get(metadata["content_hash"])
+            if duplicate is not None:
+                os.remove(upload["tmp_path"])
+                saved_files.append(
+                    {**duplicate, "_id": str(duplicate["_id"]), "duplicate": True}
+                )
+                continue
+
+            os.replace(upload["tmp_path"], metadata["file_path"])
+            existing[metadata["content_hash"]] = metadata
+            new_images.append(metadata)
+            saved_files.append(
+                {**metadata, "_id": str(metadata["_id"]), "duplicate": False}
+            )
+
+        if new_images:
+            duplicates = self._insert_images(new_images)
+            saved_files = [duplicates.get(saved["_id"], saved) for saved in saved_files]
+            self.phash_index.add(
+                [
+                    (image["_id"], image["perceptual_hash"])
+                    for image in new_images
+                    if image["perceptual_hash"] and str(image["_id"]) not in duplicates
+                ]
+            )
 
         return saved_files
 
-    def get_image_by_id(self, image_id):
-        image = self.db.images.aggregate(
-            [
-                {"$match": {"_id": ObjectId(image_id)}},
-                {"$addFields": {"_id": {"$toString": "$_id"}}},
-            ]
-        )
+    def _insert_images(self, images: list) -> dict:
+        """Inserts new images; those whose content a concurrent upload stored
+        first are returned as that image, by the id they were given.
+        """
+        try:
+            self.db.images.insert_many(images, ordered=False)
+            return {}
+        except BulkWriteError as e:
+            errors = e.details["writeErrors"]
+            if any(error["code"] != DUPLICATE_KEY for error in errors):
+                raise
+
+        duplicates = {}
+        for error in errors:
+            image = images[error["index"]]
+            os.remove(image["file_path"])
+            existing = self.db.images.find_one(
+                {"content_hash": image["content_hash"]}, {"color_histogram": 0}
+            )
+            duplicates[str(image["_id"])] = {
+                **existing,
+                "_id": str(existing["_id"]),
+                "duplicate": True,
+            }
+        return duplicates
+
+    def _projection(self, fields) -> dict:
+        projection = {field: 1 for field in fields if field not in HEAVY_FIELDS}
+        if "color_histogram" in fields:
+            # images histogrammed before it moved out of line still embed it
+            projection.update(histogram_id=1, color_histogram=1)
+        return projection
+
+    def _present(self, images: list, fields) -> list:
+        histograms = {}
+        if "color_histogram" in fields:
+            ids = {
+                image["histogram_id"] for image in images if image.get("histogram_id")
+            }
+            histograms = {
+                doc["_id"]: image_ops.bin_histogram(doc["counts"], 256, False)
+                for doc in self.db.histograms.find({"_id": {"$in": list(ids)}})
+            }
+
+        for image in images:
+            image["_id"] = str(image["_id"])
+            histogram_id = image.pop("histogram_id", None)
+            if "color_histogram" in fields:
+                image["color_histogram"] = histograms.get(
+                    histogram_id, image.get("color_histogram")
+                )
+        return images
+
+    def get_images(self, page_size=10, after=None, page=None, fields=LISTING_FIELDS):
+        query = {}
+        if after is not None:
+            query["_id"] = {"$gt": ObjectId(after)}
+
+        def find(hint=None):
+            cursor = self.db.images.find(query, self._projection(fields)).sort("_id", 1)
+            if hint:
+                cursor = cursor.hint(hint)
+            if after is None and page:
+                cursor = cursor.skip((page - 1) * page_size)
+            return list(cursor.limit(page_size + 1))
+
+        if set(fields) <= set(LISTING_FIELDS):
+            # answered from the listing index alone
+            try:
+                rows = find("ff_listing")
+            except OperationFailure:
+                # the index has not been created
+                rows = find()
+        else:
+            rows = find()
+
+        data, next_cursor = keyset_page(rows, page_size)
+        total = self.db.images.estimated_document_count()
+        return {
+            "data": self._present(data, fields),
+            "total": total,
+            "next": next_cursor,
+        }
+
+    def get_image_by_id(self, image_id, fields=None):
+        # without fields, every stored field but the heavy ones
+        projection = self._projection(fields) if fields else {"color_histogram": 0}
+        image = self.db.images.find_one({"_id": ObjectId(image_id)}, projection)
 
         if not image:
             raise NotFoundError("Image not found")
 
-        return list(image)[0]
+        if fields:
+            return self._present([image], fields)[0]
+        return {**image, "_id": str(image["_id"])}
 
     def delete_image(self, image_id):
         result = self.db.images.delete_one({"_id": ObjectId(image_id)})
         if result.deleted_count == 0:
             raise NotFoundError("Image not found")
+        self.rendition_repository.purge(image_id)
+        self.phash_index.remove(image_id)
         return {"message": "Image deleted successfully"}
 
-    def generate_image_histogram(self, image_id):
-        image = self.get_image_by_id(image_id)
-        histogram_data = self._calculate_histogram(image["file_path"])
+    def _map(self, fn, args: list) -> list:
+        # returns (result, error) per argument; batches go to the process
+        # pool so decoding uses every core
+        futures = None
+        if len(args) > 1:
+            futures = [self._get_pool().submit(fn, arg) for arg in args]
+
+        results = []
+        for i, arg in enumerate(args):
+            try:
+                result = fn(arg) if futures is None else futures[i].result()
+                results.append((result, None))
+            except Exception as e:
+                results.append((None, str(e)))
+        return results
+
+    def _content_hashes(self, images: list) -> dict:
+        missing = [image for image in images if not image.get("content_hash")]
+        hashes = self._map(image_ops.file_hash, [i["file_path"] for i in missing])
+
+        for image, (content_hash, _) in zip(missing, hashes):
+            if content_hash:
+                image["content_hash"] = content_hash
+                # copies uploaded before duplicates were detected keep using
+                # the hash without storing it
+                try:
+                    self.db.images.update_one(
+                        {"_id": ObjectId(image["_id"])},
+                        {"$set": {"content_hash": content_hash}},
+                    )
+                except DuplicateKeyError:
+                    pass
 
-        self.db.images.update_one(
-            {"_id": ObjectId(image_id)},
-            {"$set": {"color_histogram": histogram_data}},
-        )
-
-        return histogram_data
-
-    def _calculate_histogram(self, image_path: str) -> dict:
-        with Image.open(image_path) as img:
-            img = img.convert("RGB")
-            histogram = img.histogram()
+        return {
+            image["_id"]: image["content_hash"]
+            for image in images
+            if image.get("content_hash")
+        }
 
-            # Divide histogram into R, G, and B channels
-            return {
-                "R": histogram[0:256],
-                "G": histogram[256:512],
-                "B": histogram[512:768],
-            }
+    def _histogram_counts(self, images: list) -> dict:
+        # histograms are cached by file content, so repeated requests and
+        # copies of the same file are only decoded once
+        hashes = self._content_hashes(images)
+        cached = {
+            doc["_id"]: np.array(doc["counts"])
+            for doc in self.db.histograms.find(
+                {"_id": {"$in": list(set(hashes.values()))}}
+            )
+        }
 
-    def generate_segmentation_mask(self, image_id):
+        missing = {}
+        for image in images:
+            content_hash = hashes.get(image["_id"])
+            if content_hash and content_hash not in cached:
+                missing.setdefault(content_hash, image["file_path"])
+
+        errors = {}
+        computed = self._map(
+            functools.partial(
+                image_ops.histogram_counts, max_bytes=self.max_decode_bytes
+            ),
+            list(missing.values()),
+        )
+        for content_hash, (counts, error) in zip(missing, computed):
+            if error:
+                errors[content_hash] = error
+                continue
+            cached[content_hash] = counts
+            self.db.histograms.replace_one(
+                {"_id": content_hash},
+                {"_id": content_hash, "counts": counts.tolist()},
+                upsert=True,
+            )
+
+        results = {}
+        for image in images:
+            content_hash = hashes.get(image["_id"])
+            if content_hash in cached:
+                results[image["_id"]] = cached[content_hash]
+            else:
+                results[image["_id"]] = errors.get(content_hash, "Error loading image")
+        return results
+
+    def _link_histograms(self, images: list) -> None:
+        # images point at their counts in db.histograms instead of embedding
+        # them; embedded histograms of older images are dropped on the way
+        for image in images:
+            if image.get("histogram_id") != image["content_hash"]:
+                self.db.images.update_one(
+                    {"_id": ObjectId(image["_id"])},
+                    {
+                        "$set": {"histogram_id": image["content_hash"]},
+                        "$unset": {"color_histogram": ""},
+                    },
+                )
+
+    def generate_image_histogram(self, image_id, bins=256, normalize=False):
         image = self.get_image_by_id(image_id)
-        if not image:
-            raise NotFoundError("Image not found")
-
-        image_path = image["file_path"]
-
-        img = cv2.imread(image_path)
-        if img is None:
-            return jsonify({"message": "Error loading image"}), 500
+        counts = self._histogram_counts([image])[image["_id"]]
+        if isinstance(counts, str):
+            raise ValidationError(f"Error loading image: {counts}")
+
+        self._link_histograms([image])
+
+        return image_ops.bin_histogram(counts, bins, normalize)
+
+    def generate_image_histograms(self, image_ids, bins=256, normalize=False):
+        images = [
+            {**image, "_id": str(image["_id"])}
+            for image in self.db.images.find(
+                {"_id": {"$in": [ObjectId(i) for i in image_ids]}},
+                {"file_path": 1, "content_hash": 1},
+            )
+        ]
+        counts = self._histogram_counts(images)
+
+        results = {}
+        for image_id in image_ids:
+            if image_id not in counts:
+                results[image_id] = {"error": "Image not found"}
+            elif isinstance(counts[image_id], str):
+                results[image_id] = {"error": counts[image_id]}
+            else:
+                results[image_id] = {
+                    "histogram": image_ops.bin_histogram(
+                        counts[image_id], bins, normalize
+                    )
+                }
+        return {"data": results}
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = image_ops.create_process_pool(self.process_workers)
+        return self._pool
+
+    def _perceptual_hashes(self, images: list) -> dict:
+        # images stored before hashing existed are hashed on first use
+        missing = [image for image in images if not image.get("perceptual_hash")]
+        computed = self._map(
+            functools.partial(
+                image_ops.perceptual_hashes, max_bytes=self.max_decode_bytes
+            ),
+            [image["file_path"] for image in missing],
+        )
 
-        # Apply Felzenszwalb segmentation
+        indexed = []
+        for image, (hashes, _) in zip(missing, computed):
+            if hashes is None:
+                continue
+            image["perceptual_hash"] = hashes
+            # only the request that stores the hashes adds them to the index
+            if self.db.images.update_one(
+                {"_id": ObjectId(image["_id"]), "perceptual_hash": None},
+                {"$set": {"perceptual_hash": hashes}},
+            ).modified_count:
+                indexed.append((image["_id"], hashes))
+        if indexed:
+            self.phash_index.add(indexed)
 
-        # Convert image to RGB
-        img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        segments = felzenszwalb(img_rgb, scale=100, sigma=0.5, min_size=50)
+        return {
+            image["_id"]: image["perceptual_hash"]
+            for image in images
+            if image.get("perceptual_hash")
+        }
 
-        # Convert the segmentation result to an 8-bit image
-        mask = (segments * (255 / segments.max())).astype(np.uint8)
+    def find_similar_images(self, image_id, kind="phash", k=10, max_distance=10):
+        image = self.get_image_by_id(image_id)
+        hashes = self._perceptual_hashes([image]).get(image["_id"])
+        if hashes is None:
+            raise ValidationError("Error loading image")
 
-        mask_filename = f"{image_id}_segmentation_mask.png"
-        mask_path = os.path.join(self.upload_folder, mask_filename)
-        io.imsave(mask_path, mask)
+        neighbours = self.phash_index.nearest(
+            kind, hashes[kind], k, max_distance, exclude=image["_id"]
+        )
+        images = {
+            str(doc["_id"]): doc
+            for doc in self.db.images.find(
+                {"_id": {"$in": [ObjectId(i) for i, _ in neighbours]}},
+                {
+                    "original_name": 1,
+                    "filename": 1,
+                    "width": 1,
+                    "height": 1,
+                    "file_size": 1,
+                    "uploaded_at": 1,
+                },
+            )
+        }
 
-        self.db.images.update_one(
-            {"_id": ObjectId(image_id)},
-            {"$set": {"segmentation_mask": mask_filename}},
+        data = [
+            {**images[neighbour_id], "_id": neighbour_id, "distance": distance}
+            for neighbour_id, distance in neighbours
+            if neighbour_id in images
+        ]
+        return {"data": data, "hash": kind, "value": hashes[kind]}
+
+    def _link_segmentation(self, image_ids, segmentation) -> None:
+        self.db.images.update_many(
+            {"_id": {"$in": [ObjectId(i) for i in image_ids]}},
+            {"$set": {"segmentation_mask": segmentation["mask"]}},
         )
 
+    def _segmentation_result(self, segmentation) -> dict:
         return {
             "message": "Segmentation mask generated successfully",
-            "mask": mask_filename,
+            "status": "succeeded",
+            "mask": segmentation["mask"],
+            "params": segmentation["params"],
+            **segmentation["result"],
         }
 
-    def resize_image(self, image_id, width, height):
+    def _segmentation_key(self, content_hash, params) -> str:
+        # masks are cached by file content and parameters
+        return hashlib.sha256(
+            json.dumps(
+                {"content_hash": content_hash, **params},
+                sort_keys=True,
+                separators=(",", ":"),
+            ).encode()
+        ).hexdigest()
+
+    def _cached_segmentation(self, key) -> dict:
+        segmentation = self.db.segmentations.find_one({"_id": key})
+        if segmentation is not None and os.path.exists(
+            os.path.join(self.upload_folder, segmentation["mask"])
+        ):
+            return segmentation
+        return None
+
+    def _store_segmentation(self, key, mask, params, result) -> dict:
+        segmentation = {"_id": key, "mask": mask, "params": params, "result": result}
+        self.db.segmentations.replace_one({"_id": key}, segmentation, upsert=True)
+        return segmentation
+
+    def generate_segmentation_mask(self, image_id, params):
         image = self.get_image_by_id(image_id)
-        if not image:
-            raise NotFoundError("Image not found")
+        content_hash = self._content_hashes([image]).get(image["_id"])
+        if content_hash is None:
+            raise ValidationError("Error loading image")
+
+        key = self._segmentation_key(content_hash, params)
+        segmentation = self._cached_segmentation(key)
+        if segmentation is not None:
+            self._link_segmentation([image_id], segmentation)
+            return self._segmentation_result(segmentation)
+
+        # an identical request that is still running is joined rather than
+        # segmenting the same image twice; the joining image gets the mask
+        # when the job finishes
+        job = self.db.jobs.find_one_and_update(
+            {
+                "kind": SEGMENTATION_JOB,
+                "params.key": key,
+                "status": {"$in": [QUEUED, RUNNING]},
+            },
+            {"$addToSet": {"params.image_ids": image_id}},
+            {"_id": 1},
+        )
+        if job is not None:
+            job_id = str(job["_id"])
+        else:
+            job_id = self.job_repository.create_job(
+                SEGMENTATION_JOB,
+                {"image_id": image_id, "image_ids": [image_id], "key": key, **params},
+            )
+            mask = f"segmentation_{key}.png"
+            future = self._get_pool().submit(
+                image_ops.segment,
+                image["file_path"],
+                os.path.join(self.upload_folder, mask),
+                params,
+                self.max_decode_bytes,
+            )
+            future.add_done_callback(
+                lambda future: self._finish_segmentation(
+                    future, job_id, key, mask, params
+                )
+            )
+
+        return {"message": "Segmentation queued", "status": "queued", "job_id": job_id}
+
+    def _finish_segmentation(self, future, job_id, key, mask, params):
+        try:
+            result = future.result()
+        except Exception as e:
+            self.job_repository.fail_job(job_id, str(e))
+            return
+
+        segmentation = self._store_segmentation(key, mask, params, result)
+        self.job_repository.finish_job(job_id, self._segmentation_result(segmentation))
+
+        # images can only join while the job runs, so the list is complete
+        # once it has finished
+        job = self.db.jobs.find_one({"_id": ObjectId(job_id)}, {"params": 1})
+        image_ids = job["params"].get("image_ids", [job["params"]["image_id"]])
+        self._link_segmentation(image_ids, segmentation)
+
+    def get_job(self, job_id):
+        return self.job_repository.get_job(job_id)
+
+    def _batch_query(self, image_filter: dict) -> dict:
+        query = {}
+        bounds = {
+            "uploaded_at": ("uploaded_after", "uploaded_before"),
+            "width": ("min_width", "max_width"),
+            "height": ("min_height", "max_height"),
+        }
+        for field, (low, high) in bounds.items():
+            condition = {}
+            if image_filter.get(low) is not None:
+                condition["$gte"] = image_filter[low]
+            if image_filter.get(high) is not None:
+                condition["$lte"] = image_filter[high]
+            if condition:
+                query[field] = condition
+
+        # e.g. images that have no histogram yet
+        for field in image_filter.get("missing", []):
+            if field == "color_histogram":
+                query["histogram_id"] = None
+            query[field] = None
+        return query
+
+    def queue_image_batch(self, image_ids, image_filter, operations, max_images):
+        if image_ids is not None:
+            ids = [ObjectId(image_id) for image_id in image_ids]
+        else:
+            # the matching ids are fixed when the batch is queued, so images
+            # uploaded while it runs are not picked up halfway through
+            ids = [
+                image["_id"]
+                for image in self.db.images.find(
+                    self._batch_query(image_filter), {"_id": 1}
+                )
+                .sort("_id", 1)
+                .limit(max_images + 1)
+            ]
+            if len(ids) > max_images:
+                raise ValidationError(
+                    f"The filter matches more than {max_images} images"
+                )
+
+        job_id = self.job_repository.create_job(
+            BATCH_JOB,
+            {"filter": image_filter, "operations": operations, "total": len(ids)},
+        )
 
-        image_path = image["file_path"]
-        img = Image.open(image_path)
+        if self._batch_executor is None:
+            self._batch_executor = ThreadPoolExecutor(
+                max_workers=self.batch_workers, thread_name_prefix="image-batch"
+            )
+        self._batch_executor.submit(self._run_image_batch, job_id, ids, operations)
 
-        # resize the image
-        resized_img = img.resize((width, height), Image.ANTIALIAS)
+        return {
+            "message": "Batch queued",
+            "status": "queued",
+            "job_id": job_id,
+            "total": len(ids),
+        }
 
-        # save the resized image
-        resized_img.save(image_path)
+    def _run_image_batch(self, job_id, ids, operations):
+        try:
+            self.job_repository.start_job(job_id)
+            progress = {"total": len(ids), "processed": 0, "succeeded": 0, "failed": 0}
+            self.job_repository.update_progress(job_id, progress)
+
+            # one chunk of images is in flight at a time, which bounds the
+            # memory and pool queue a batch of thousands of images can use
+            for start in range(0, len(ids), self.batch_chunk_size):
+                items = self._process_batch_chunk(
+                    job_id, ids[start : start + self.batch_chunk_size], operations
+                )
+                self.db.batch_results.insert_many(items, ordered=False)
+
+                failed = sum(item["status"] == FAILED for item in items)
+                progress["processed"] += len(items)
+                progress["succeeded"] += len(items) - failed
+                progress["failed"] += failed
+                self.job_repository.update_progress(job_id, progress)
+
+            self.job_repository.finish_job(job_id, progress)
+        except Exception as e:
+            self.job_repository.fail_job(job_id, str(e))
+
+    def _process_batch_chunk(self, job_id, ids, operations) -> list:
+        images = {
+            str(image["_id"]): {**image, "_id": str(image["_id"])}
+            for image in self.db.images.find(
+                {"_id": {"$in": ids}},
+                {
+                    "file_path": 1,
+                    "content_hash": 1,
+                    "histogram_id": 1,
+                    "perceptual_hash": 1,
+                },
+            )
+        }
+        found = list(images.values())
+
+        results = {image_id: [] for image_id in images}
+        for operation in operations:
+            if operation["op"] == "histogram":
+                outcome = self._batch_histograms(
+                    found, operation["bins"], operation["normalize"]
+                )
+            elif operation["op"] == "segmentation":
+                outcome = self._batch_segmentations(found, operation["params"])
+            elif operation["op"] == "phash":
+                outcome = self._batch_perceptual_hashes(found)
+            else:
+                outcome = self._batch_pipelines(found, operation["operations"])
+
+            for image_id, result in outcome.items():
+                results[image_id].append({"op": operation["op"], **result})
+
+        items = []
+        for image_id in map(str, ids):
+            item = {"job_id": ObjectId(job_id), "image_id": image_id}
+            if image_id not in results:
+                item.update(status=FAILED, error="Image not found", results=[])
+            else:
+                failed = any("error" in result for result in results[image_id])
+                item.update(
+                    status=FAILED if failed else SUCCEEDED, results=results[image_id]
+                )
+            items.append(item)
+        return items
+
+    def _batch_histograms(self, images, bins, normalize) -> dict:
+        counts = self._histogram_counts(images)
+
+        results, linked = {}, []
+        for image in images:
+            image_counts = counts[image["_id"]]
+            if isinstance(image_counts, str):
+                results[image["_id"]] = {"error": image_counts}
+                continue
+
+            linked.append(image)
+            results[image["_id"]] = {
+                "histogram": image_ops.bin_histogram(image_counts, bins, normalize)
+            }
+        self._link_histograms(linked)
+        return results
+
+    def _batch_segmentations(self, images, params) -> dict:
+        hashes = self._content_hashes(images)
+        keys = {
+            image_id: self._segmentation_key(content_hash, params)
+            for image_id, content_hash in hashes.items()
+        }
 
-        return {"message": "Image resized successfully"}
+        # every distinct mask of the chunk is segmented at once on the pool
+        segmentations, pending = {}, {}
+        for image in images:
+            key = keys.get(image["_id"])
+            if key is None or key in segmentations or key in pending:
+                continue
+            segmentation = self._cached_segmentation(key)
+            if segmentation is not None:
+                segmentations[key] = segmentation
+                continue
+            mask = f"segmentation_{key}.png"
+            pending[key] = (
+                mask,
+                self._get_pool().submit(
+                    image_ops.segment,
+                    image["file_path"],
+                    os.path.join(self.upload_folder, mask),
+                    params,
+                    self.max_decode_bytes,
+                ),
+            )
+
+        errors = {}
+        for key, (mask, future) in pending.items():
+            try:
+                segmentations[key] = self._store_segmentation(
+                    key, mask, params, future.result()
+                )
+            except Exception as e:
+                errors[key] = str(e)
+
+        results = {}
+        for image in images:
+            key = keys.get(image["_id"])
+            if key not in segmentations:
+                results[image["_id"]] = {
+                    "error": errors.get(key, "Error loading image")
+                }
+                continue
+            segmentation = segmentations[key]
+            self.db.images.update_one(
+                {"_id": ObjectId(image["_id"])},
+                {"$set": {"segmentation_mask": segmentation["mask"]}},
+            )
+            results[image["_id"]] = {
+                "mask": segmentation["mask"],
+                **segmentation["result"],
+            }
+        return results
 
-    def crop_image(self, image_id, left, top, right, bottom):
-        image = self.get_image_by_id(image_id)
-        if not image:
-            raise NotFoundError("Image not found")
+    def _batch_perceptual_hashes(self, images) -> dict:
+        hashes = self._perceptual_hashes(images)
+        return {
+            image["_id"]: (
+                {"perceptual_hash": hashes[image["_id"]]}
+                if image["_id"] in hashes
+                else {"error": "Error loading image"}
+            )
+            for image in images
+        }
 
-        image_path = image["file_path"]
-        img = Image.open(image_path)
+    def _batch_pipelines(self, images, operations) -> dict:
+        # resampling and encoding in pillow release the GIL
+        def render(image_id):
+            try:
+                return {"rendition": self.run_pipeline(image_id, operations)}
+            except Exception as e:
+                return {"error": str(e)}
+
+        image_ids = [image["_id"] for image in images]
+        if not image_ids:
+            return {}
+        with ThreadPoolExecutor(
+            max_workers=min(len(image_ids), self.process_workers or os.cpu_count())
+        ) as executor:
+            return dict(zip(image_ids, executor.map(render, image_ids)))
+
+    def get_batch_results(self, job_id, page_size=100, after=None, status=None):
+        self.job_repository.get_job(job_id)
+
+        query = {"job_id": ObjectId(job_id)}
+        if after is not None:
+            query["_id"] = {"$gt": ObjectId(after)}
+        if status is not None:
+            query["status"] = status
+
+        cursor = (
+            self.db.batch_results.find(query, {"job_id": 0})
+            .sort("_id", 1)
+            .limit(page_size + 1)
+        )
+        data, next_cursor = keyset_page(list(cursor), page_size)
+        for item in data:
+            item["_id"] = str(item["_id"])
 
-        # crop the image
-        cropped_img = img.crop((left, top, right, bottom))
+        return {"data": data, "next": next_cursor}
 
-        # save the cropped image
-        cropped_img.save(image_path)
+    def _render(self, image_id, operation, transform, image_format=None):
+        # the original file is never modified; each operation produces a
+        # rendition that is reused by later requests for the same operation
+        image = self.get_image_by_id(image_id)
+        rendition = self.rendition_repository.get(image_id, operation)
+        cached = rendition is not None
+
+        if not cached:
+            with Image.open(image["file_path"]) as img:
+                image_format = image_format or img.format
+                if image_format not in EXTENSIONS:
+                    image_format = "PNG"
+                rendered = transform(img)
+                if image_format == "JPEG" and rendered.mode not in ("RGB", "L"):
+                    rendered = rendered.convert("RGB")
+                rendition = self.rendition_repository.put(
+                    image_id, operation, rendered, image_format
+                )
 
-        return {"message": "Image cropped successfully"}
+        return {
+            "filename": rendition["filename"],
+            "url": f"/images/renditions/{rendition['filename']}",
+            "size": rendition["size"],
+            "cached": cached,
+        }
 
-    def convert_image(self, image_id, format):
+    def run_pipeline(self, image_id, operations):
         image = self.get_image_by_id(image_id)
-        if not image:
-            raise NotFoundError("Image not found")
+        width, height = image.get("width"), image.get("height")
+        if width is None or height is None:
+            with Image.open(image["file_path"]) as img:
+                width, height = img.size
+
+        # equivalent pipelines plan to the same operation and share a
+        # rendition
+        plan = image_ops.plan_pipeline(width, height, operations)
+        return self._render(
+            image_id,
+            {"op": "pipeline", **plan},
+            lambda img: image_ops.apply_pipeline(img, plan, self.max_decode_bytes),
+            plan["format"],
+        )
+
+    def pipeline_image(self, image_id, operations):
+        rendition = self.run_pipeline(image_id, operations)
+
+        return {"message": "Image processed successfully", "rendition": rendition}
 
-        image_path = image["file_path"]
-        img = Image.open(image_path)
+    def resize_image(self, image_id, width, height):
+        rendition = self.run_pipeline(
+            image_id, [{"op": "resize", "width": width, "height": height}]
+        )
 
-        # convert the image
-        converted_img = img.convert(format)
+        return {"message": "Image resized successfully", "rendition": rendition}
 
-        # save the converted image
-        converted_img.save(image_path)
+    def crop_image(self, image_id, left, top, right, bottom):
+        rendition = self.run_pipeline(
+            image_id,
+            [
+                {
+                    "op": "crop",
+                    "left": left,
+                    "top": top,
+                    "right": right,
+                    "bottom": bottom,
+                }
+            ],
+        )
+
+        return {"message": "Image cropped successfully", "rendition": rendition}
+
+    def convert_image(self, image_id, format):
+        rendition = self.run_pipeline(
+            image_id, [{"op": "convert", "format": IMAGE_FORMATS[format]}]
+        )
 
-        return {"message": "Image converted successfully"}
+        return {"message": "Image converted successfully", "rendition": rendition}
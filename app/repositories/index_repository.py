@@ -0,0 +1,173 @@
+from pymongo.database import Database
+from pymongo.errors import OperationFailure
+from app.db.indexes import INDEXES, MANAGED_PREFIX, DATASET_INDEX_PREFIX
+
+
+# operators an index answers like an equality match
+EQUALITY_OPERATORS = ("$eq", "$in")
+
+# index options that change what an index holds or does; an index whose
+# options differ from its declaration is rebuilt
+INDEX_OPTIONS = ("unique", "sparse", "partialFilterExpression", "expireAfterSeconds")
+
+
+def _options(index: dict) -> dict:
+    return {key: index[key] for key in INDEX_OPTIONS if key in index}
+
+
+class IndexRepository:
+    def __init__(self, db: Database, indexes: dict = None) -> None:
+        if db is None:
+            raise ValueError("db cannot be None")
+        self.db = db
+        self.indexes = indexes if indexes is not None else INDEXES
+
+    def _is_managed(self, name: str) -> bool:
+        return name.startswith(MANAGED_PREFIX) and not name.startswith(
+            DATASET_INDEX_PREFIX
+        )
+
+    def reconcile(self) -> dict:
+        report = {"created": [], "dropped": [], "unchanged": []}
+
+        for collection_name, models in self.indexes.items():
+            collection = self.db[collection_name]
+            existing = collection.index_information()
+            declared = {model.document["name"]: model for model in models}
+
+            # drop managed indexes that are no longer declared or whose keys
+            # or options changed, so they are rebuilt below
+            stale = set()
+            for name, info in existing.items():
+                model = declared.get(name)
+                if not self._is_managed(name):
+                    continue
+                if (
+                    model is None
+                    or list(model.document["key"].items()) != list(info["key"])
+                    or _options(model.document) != _options(info)
+                ):
+                    collection.drop_index(name)
+                    stale.add(name)
+                    report["dropped"].append(f"{collection_name}.{name}")
+
+            missing = [
+                model
+                for name, model in declared.items()
+                if name not in existing or name in stale
+            ]
+            if missing:
+                collection.create_indexes(missing)
+
+            for name, model in declared.items():
+                status = "created" if model in missing else "unchanged"
+                report[status].append(f"{collection_name}.{name}")
+
+        return report
+
+    def get_indexes(self) -> dict:
+        return {
+            collection_name: [
+                {
+                    "name": name,
+                    "key": dict(info["key"]),
+                    "managed": self._is_managed(name),
+                }
+                for name, info in self.db[collection_name].index_information().items()
+            ]
+            for collection_name in self.indexes
+        }
+
+    def enable_profiling(self, slow_ms: int) -> None:
+        # level 1 records operations slower than slow_ms in system.profile
+        self.db.command("profile", 1, slowms=slow_ms)
+
+    def _query_shape(self, command: dict) -> tuple:
+        sort = {}
+        if "filter" in command:
+            query = command["filter"]
+            sort = command.get("sort") or {}
+        elif command.get("pipeline") and "$match" in command["pipeline"][0]:
+            query = command["pipeline"][0]["$match"]
+            sort = next(
+                (stage["$sort"] for stage in command["pipeline"] if "$sort" in stage),
+                {},
+            )
+        elif "q" in command:
+            query = command["q"]
+        else:
+            query = {}
+
+        # an index serves a query best with its equality fields first, then
+        # the sort, then the range fields
+        equality, ranges = [], []
+        for field, condition in query.items():
+            if field.startswith("$"):
+                continue
+            is_range = isinstance(condition, dict) and any(
+                op.startswith("$") and op not in EQUALITY_OPERATORS for op in condition
+            )
+            (ranges if is_range else equality).append(field)
+
+        suggested = [[field, 1] for field in equality]
+        for field, direction in sort.items():
+            if field not in equality:
+                suggested.append([field, direction])
+        fields = {field for field, _ in suggested}
+        suggested += [[field, 1] for field in ranges if field not in fields]
+
+        shape = sorted(field for field in query if not field.startswith("$"))
+        return shape, suggested
+
+    def slow_query_report(self, limit: int = 1000) -> dict:
+        try:
+            status = self.db.command("profile", -1)
+        except OperationFailure as e:
+            return {"profiling": None, "message": str(e), "shapes": []}
+
+        entries = (
+            self.db.system.profile.find(
+                {"planSummary": {"$regex": "^COLLSCAN"}},
+                {
+                    "ns": 1,
+                    "command": 1,
+                    "millis": 1,
+                    "docsExamined": 1,
+                    "planSummary": 1,
+                },
+            )
+            .sort("ts", -1)
+            .limit(limit)
+        )
+
+        shapes = {}
+        for entry in entries:
+            collection_name = entry["ns"].split(".", 1)[-1]
+            shape, suggested = self._query_shape(entry.get("command", {}))
+            key = (collection_name, tuple(shape), str(suggested))
+
+            summary = shapes.setdefault(
+                key,
+                {
+                    "collection": collection_name,
+                    "shape": shape,
+                    "suggested_index": suggested,
+                    "count": 0,
+                    "total_millis": 0,
+                    "max_millis": 0,
+                    "docs_examined": 0,
+                },
+            )
+            summary["count"] += 1
+            summary["total_millis"] += entry.get("millis", 0)
+            summary["max_millis"] = max(summary["max_millis"], entry.get("millis", 0))
+            summary["docs_examined"] += entry.get("docsExamined", 0)
+
+        report = sorted(shapes.values(), key=lambda s: s["total_millis"], reverse=True)
+        for summary in report:
+            summary["avg_millis"] = summary.pop("total_millis") / summary["count"]
+
+        return {
+            "profiling": {"level": status.get("was"), "slow_ms": status.get("slowms")},
+            "shapes": report,
+        }
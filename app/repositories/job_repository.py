@@ -0,0 +1,186 @@
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo.database import Database
+from pymongo.errors import PyMongoError
+from app.errors import NotFoundError
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+
+class JobRepository:
+    """Tracks background jobs run by the local worker pools in db.jobs.
+
+    The process running a job refreshes its heartbeat_at every
+    heartbeat_seconds; a queued or running job whose heartbeat is older than
+    stale_seconds belongs to a worker that exited and is failed.
+    """
+
+    def __init__(
+        self, db: Database, heartbeat_seconds: int = 30, stale_seconds: int = 120
+    ) -> None:
+        if db is None:
+            raise ValueError("db cannot be None")
+        self.db = db
+        self.heartbeat_seconds = heartbeat_seconds
+        self.stale_seconds = stale_seconds
+        # jobs run inside the process that queued them; host and pid are
+        # only informative, since pids repeat after a container restart
+        self.worker = {"host": socket.gethostname(), "pid": os.getpid()}
+        self._active = set()
+        self._lock = threading.Lock()
+        self._heartbeat = None
+
+    def _track(self, job_id: ObjectId) -> None:
+        with self._lock:
+            self._active.add(job_id)
+            # started on first use so forked workers each run their own
+            if self._heartbeat is None:
+                self._heartbeat = threading.Thread(
+                    target=self._beat, name="job-heartbeat", daemon=True
+                )
+                self._heartbeat.start()
+
+    def _untrack(self, job_id: str) -> None:
+        with self._lock:
+            self._active.discard(ObjectId(job_id))
+
+    def _beat(self) -> None:
+        while True:
+            time.sleep(self.heartbeat_seconds)
+            with self._lock:
+                active = list(self._active)
+            if not active:
+                continue
+            try:
+                self.db.jobs.update_many(
+                    {"_id": {"$in": active}, "status": {"$in": [QUEUED, RUNNING]}},
+                    {"$set": {"heartbeat_at": datetime.now()}},
+                )
+            except PyMongoError:
+                # the next beat retries; a job is only failed once it missed
+                # several
+                pass
+
+    def create_job(self, kind: str, params: dict = None) -> str:
+        job_id = ObjectId()
+        self.db.jobs.insert_one(
+            {
+                "_id": job_id,
+                "kind": kind,
+                "status": QUEUED,
+                "params": params or {},
+                "progress": {},
+                "worker": self.worker,
+                "created_at": datetime.now(),
+                "updated_at": datetime.now(),
+                "heartbeat_at": datetime.now(),
+            }
+        )
+        self._track(job_id)
+        return str(job_id)
+
+    def start_job(self, job_id: str) -> None:
+        self.db.jobs.update_one(
+            {"_id": ObjectId(job_id)},
+            {
+                "$set": {
+                    "status": RUNNING,
+                    "started_at": datetime.now(),
+                    "updated_at": datetime.now(),
+                }
+            },
+        )
+
+    def update_progress(self, job_id: str, progress: dict) -> None:
+        self.db.jobs.update_one(
+            {"_id": ObjectId(job_id)},
+            {
+                "$set": {
+                    "progress": progress,
+                    "updated_at": datetime.now(),
+                    "heartbeat_at": datetime.now(),
+                }
+            },
+        )
+
+    def finish_job(self, job_id: str, result: dict) -> None:
+        self._untrack(job_id)
+        self.db.jobs.update_one(
+            {"_id": ObjectId(job_id)},
+            {
+                "$set": {
+                    "status": SUCCEEDED,
+                    "result": result,
+                    "finished_at": datetime.now(),
+                    "updated_at": datetime.now(),
+                }
+            },
+        )
+
+    def fail_job(self, job_id: str, error: str) -> None:
+        self._untrack(job_id)
+        self.db.jobs.update_one(
+            {"_id": ObjectId(job_id)},
+            {
+                "$set": {
+                    "status": FAILED,
+                    "error": error,
+                    "finished_at": datetime.now(),
+                    "updated_at": datetime.now(),
+                }
+            },
+        )
+
+    def get_job(self, job_id: str) -> dict:
+        try:
+            job = self.db.jobs.find_one({"_id": ObjectId(job_id)}, {"worker": 0})
+        except InvalidId:
+            job = None
+
+        if job is None:
+            raise NotFoundError("Job not found")
+
+        return {"data": {**job, "_id": str(job["_id"])}}
+
+    def fail_orphaned_jobs(self) -> list:
+        # jobs whose worker stopped refreshing their heartbeat can never
+        # finish, so they are failed instead of staying queued forever
+        cutoff = datetime.now() - timedelta(seconds=self.stale_seconds)
+        orphaned = list(
+            self.db.jobs.find(
+                {
+                    "status": {"$in": [QUEUED, RUNNING]},
+                    "$or": [
+                        {"heartbeat_at": {"$lt": cutoff}},
+                        # jobs queued before heartbeats existed
+                        {"heartbeat_at": None, "updated_at": {"$lt": cutoff}},
+                    ],
+                },
+                {"kind": 1, "params": 1},
+            )
+        )
+
+        if orphaned:
+            self.db.jobs.update_many(
+                {
+                    "_id": {"$in": [job["_id"] for job in orphaned]},
+                    "status": {"$in": [QUEUED, RUNNING]},
+                },
+                {
+                    "$set": {
+                        "status": FAILED,
+                        "error": "The worker running the job exited",
+                        "finished_at": datetime.now(),
+                        "updated_at": datetime.now(),
+                    }
+                },
+            )
+        return orphaned
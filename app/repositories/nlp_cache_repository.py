@@ -0,0 +1,156 @@
+import hashlib
+import json
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.database import Database
+from pymongo.errors import PyMongoError
+
+
+class NlpCacheRepository:
+    """Results of nlp tasks in db.nlp_cache, shared by every app worker.
+
+    Entries are keyed by the task's model and parameters and the hash of the
+    text. Mongo's TTL monitor removes them once expired, and the least
+    recently used ones are evicted past max_entries. The cache never fails
+    a request: a database error is treated as a miss. Hit and miss counts
+    are kept per worker and added to db.nlp_cache_stats every
+    stats_flush_seconds.
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        ttl_seconds: int,
+        max_entries: int,
+        stats_flush_seconds: float = 10,
+    ) -> None:
+        if db is None:
+            raise ValueError("db cannot be None")
+        self.db = db
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.stats_flush_seconds = stats_flush_seconds
+        self._counts = {}
+        self._counts_lock = threading.Lock()
+        self._flushed_at = time.monotonic()
+
+    def key(self, task: str, model: dict, text: str) -> str:
+        # sorted keys make equal parameters hash the same however they were
+        # written
+        canonical = json.dumps(
+            {
+                "task": task,
+                **model,
+                "text": hashlib.sha256(text.encode()).hexdigest(),
+            },
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def get_many(self, task: str, model: dict, texts: list) -> dict:
+        """Returns the cached result of every text found, by text."""
+        keys = {self.key(task, model, text): text for text in set(texts)}
+        try:
+            entries = list(
+                self.db.nlp_cache.find(
+                    {
+                        "_id": {"$in": list(keys)},
+                        "expires_at": {"$gt": datetime.now(timezone.utc)},
+                    },
+                    {"result": 1},
+                )
+            )
+            if entries:
+                self.db.nlp_cache.update_many(
+                    {"_id": {"$in": [entry["_id"] for entry in entries]}},
+                    {"$set": {"last_used_at": datetime.now(timezone.utc)}},
+                )
+            found = {keys[entry["_id"]]: entry["result"] for entry in entries}
+        except PyMongoError:
+            return {}
+        self._count(task, hits=len(found), misses=len(keys) - len(found))
+        return found
+
+    def put_many(self, task: str, model: dict, results: dict) -> None:
+        if not results:
+            return
+        # mongo's TTL monitor compares expires_at with the time in utc
+        now = datetime.now(timezone.utc)
+        expires_at = now + timedelta(seconds=self.ttl_seconds)
+        try:
+            self.db.nlp_cache.bulk_write(
+                [
+                    ReplaceOne(
+                        {"_id": self.key(task, model, text)},
+                        {
+                            "task": task,
+                            "result": result,
+                            "created_at": now,
+                            "last_used_at": now,
+                            "expires_at": expires_at,
+                        },
+                        upsert=True,
+                    )
+                    for text, result in results.items()
+                ],
+                ordered=False,
+            )
+            self._evict()
+        except PyMongoError:
+            pass
+
+    def _count(self, task: str, hits: int, misses: int) -> None:
+        with self._counts_lock:
+            counts = self._counts.setdefault(task, {"hits": 0, "misses": 0})
+            counts["hits"] += hits
+            counts["misses"] += misses
+            due = time.monotonic() - self._flushed_at >= self.stats_flush_seconds
+        if due:
+            self._flush_counts()
+
+    def _flush_counts(self) -> None:
+        with self._counts_lock:
+            counts, self._counts = self._counts, {}
+            self._flushed_at = time.monotonic()
+        if not counts:
+            return
+        try:
+            self.db.nlp_cache_stats.bulk_write(
+                [
+                    UpdateOne({"_id": task}, {"$inc": task_counts}, upsert=True)
+                    for task, task_counts in counts.items()
+                ],
+                ordered=False,
+            )
+        except PyMongoError:
+            pass
+
+    def _evict(self) -> None:
+        excess = self.db.nlp_cache.estimated_document_count() - self.max_entries
+        if excess <= 0:
+            return
+        oldest = [
+            entry["_id"]
+            for entry in self.db.nlp_cache.find({}, {"_id": 1})
+            .sort("last_used_at", 1)
+            .limit(excess)
+        ]
+        self.db.nlp_cache.delete_many({"_id": {"$in": oldest}})
+
+    def stats(self) -> dict:
+        self._flush_counts()
+        try:
+            tasks = {
+                stats["_id"]: {"hits": stats["hits"], "misses": stats["misses"]}
+                for stats in self.db.nlp_cache_stats.find()
+            }
+            entries = self.db.nlp_cache.estimated_document_count()
+        except PyMongoError:
+            return {}
+        for counts in tasks.values():
+            lookups = counts["hits"] + counts["misses"]
+            counts["hit_rate"] = round(counts["hits"] / lookups, 4) if lookups else 0
+        return {"entries": entries, "max_entries": self.max_entries, "tasks": tasks}
@@ -0,0 +1,35 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from bson import ObjectId
+from app.errors import ValidationError
+
+
+def encode_cursor(data: dict) -> str:
+    payload = json.dumps(data, separators=(",", ":"), default=str).encode()
+    return urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+def decode_cursor(token: str) -> dict:
+    try:
+        payload = urlsafe_b64decode((token + "=" * (-len(token) % 4)).encode())
+        data = json.loads(payload)
+    except ValueError:
+        raise ValidationError("Invalid cursor")
+
+    if not isinstance(data, dict) or not ObjectId.is_valid(data.get("id")):
+        raise ValidationError("Invalid cursor")
+
+    return data
+
+
+def cursor_id(token: str) -> str:
+    return decode_cursor(token)["id"]
+
+
+def keyset_page(rows: list, page_size: int) -> tuple:
+    # callers fetch page_size + 1 rows so the last page has no next cursor
+    if len(rows) <= page_size:
+        return rows, None
+
+    rows = rows[:page_size]
+    return rows, encode_cursor({"id": str(rows[-1]["_id"])})
@@ -0,0 +1,109 @@
+import fcntl
+import os
+from contextlib import contextmanager
+import numpy as np
+from bson import ObjectId
+from app.repositories.image_ops import PERCEPTUAL_HASHES
+
+# one fixed size record per image: its id and each of its 64-bit hashes
+RECORD = np.dtype([("id", "u1", (12,)), *((kind, ">u8") for kind in PERCEPTUAL_HASHES)])
+
+# records scanned per step, bounding the temporary arrays of a search
+SCAN_ROWS = 1 << 20
+
+
+class PerceptualHashIndex:
+    """Packed perceptual hashes of every image, searched by Hamming distance.
+
+    The index is an append-only file of fixed size records that every app
+    worker memory-maps, so a search is a vectorized xor and popcount over
+    8 bytes per image instead of a database scan. Deleted images have their
+    record zeroed and are skipped.
+    """
+
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+        self.path = os.path.join(folder, "index.bin")
+        os.makedirs(folder, exist_ok=True)
+
+    @contextmanager
+    def _lock(self):
+        with open(os.path.join(self.folder, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _records(self, mode: str = "r") -> np.ndarray:
+        if not os.path.exists(self.path):
+            return np.zeros(0, RECORD)
+        # a record being appended by another worker is not counted yet
+        count = os.path.getsize(self.path) // RECORD.itemsize
+        if count == 0:
+            return np.zeros(0, RECORD)
+        return np.memmap(self.path, RECORD, mode, shape=(count,))
+
+    def add(self, images: list) -> None:
+        """Appends (image_id, hashes) pairs, hashes being hex strings."""
+        records = np.zeros(len(images), RECORD)
+        for record, (image_id, hashes) in zip(records, images):
+            record["id"] = np.frombuffer(ObjectId(image_id).binary, np.uint8)
+            for kind in PERCEPTUAL_HASHES:
+                record[kind] = int(hashes[kind], 16)
+
+        with self._lock():
+            with open(self.path, "ab") as f:
+                # records torn by an interrupted append are cut off first
+                f.truncate(f.tell() - f.tell() % RECORD.itemsize)
+                f.write(records.tobytes())
+
+    def remove(self, image_id: str) -> None:
+        target = np.frombuffer(ObjectId(image_id).binary, np.uint8)
+        with self._lock():
+            records = self._records("r+")
+            for start in range(0, len(records), SCAN_ROWS):
+                chunk = records[start : start + SCAN_ROWS]
+                matches = np.flatnonzero((chunk["id"] == target).all(axis=1))
+                if len(matches):
+                    chunk[matches] = np.zeros(1, RECORD)
+            if len(records):
+                records.flush()
+
+    def nearest(
+        self, kind: str, value: str, k: int, max_distance: int = 64, exclude=None
+    ) -> list:
+        """Returns up to k (image_id, distance) pairs, closest first."""
+        records = self._records()
+        target = np.uint64(int(value, 16))
+        excluded = (
+            np.frombuffer(ObjectId(exclude).binary, np.uint8) if exclude else None
+        )
+
+        # the best k of every chunk are kept, then merged
+        distances, positions = [], []
+        for start in range(0, len(records), SCAN_ROWS):
+            chunk = records[start : start + SCAN_ROWS]
+            distance = np.bitwise_count(chunk[kind].astype(np.uint64) ^ target)
+            keep = (distance <= max_distance) & chunk["id"].any(axis=1)
+            if excluded is not None:
+                keep &= ~(chunk["id"] == excluded).all(axis=1)
+
+            candidates = np.flatnonzero(keep)
+            if len(candidates) > k:
+                candidates = candidates[
+                    np.argpartition(distance[candidates], k - 1)[:k]
+                ]
+            distances.append(distance[candidates])
+            positions.append(candidates + start)
+
+        if not distances:
+            return []
+        distances = np.concatenate(distances)
+        positions = np.concatenate(positions)
+        order = np.argsort(distances, kind="stable")[:k]
+
+        return [
+            (str(ObjectId(records[position]["id"].tobytes())), int(distance))
+            for position, distance in zip(positions[order], distances[order])
+        ]
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+from datetime import datetime
+from PIL import Image
+from pymongo import ReturnDocument
+from pymongo.database import Database
+
+# pillow format name: file extension
+EXTENSIONS = {"JPEG": "jpg", "PNG": "png"}
+
+# db.rendition_stats document holding the bytes of every cached rendition
+TOTAL = "total"
+
+
+class RenditionRepository:
+    """Stores derived versions of images, keyed by image id and operation.
+
+    Renditions are written once and reused by every later request for the
+    same operation. The least recently used ones are evicted when the cache
+    grows past max_bytes.
+    """
+
+    def __init__(self, db: Database, folder: str, max_bytes: int) -> None:
+        if db is None:
+            raise ValueError("db cannot be None")
+        self.db = db
+        self.folder = folder
+        self.max_bytes = max_bytes
+        os.makedirs(folder, exist_ok=True)
+        # caches filled before the running total existed are counted once
+        if self.db.rendition_stats.find_one({"_id": TOTAL}) is None:
+            self.db.rendition_stats.update_one(
+                {"_id": TOTAL},
+                {"$setOnInsert": {"size": self._scan_total()}},
+                upsert=True,
+            )
+
+    def key(self, image_id: str, operation: dict) -> str:
+        # sorted keys make equal operations hash the same however they
+        # were written
+        canonical = json.dumps(
+            {"image_id": str(image_id), **operation},
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def get(self, image_id: str, operation: dict) -> dict:
+        key = self.key(image_id, operation)
+        rendition = self.db.renditions.find_one_and_update(
+            {"_id": key}, {"$set": {"last_used_at": datetime.now()}}
+        )
+        if rendition is None:
+            return None
+
+        if not os.path.exists(os.path.join(self.folder, rendition["filename"])):
+            # evicted by another worker between the lookup and now
+            self._forget(rendition)
+            return None
+
+        return rendition
+
+    def put(
+        self, image_id: str, operation: dict, img: Image.Image, image_format: str
+    ) -> dict:
+        key = self.key(image_id, operation)
+        filename = f"{key}.{EXTENSIONS.get(image_format, image_format.lower())}"
+        path = os.path.join(self.folder, filename)
+
+        # concurrent renders of the same key write identical files, and the
+        # rename keeps readers from seeing a partial one
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        img.save(tmp_path, format=image_format)
+        os.replace(tmp_path, path)
+
+        rendition = {
+            "_id": key,
+            "image_id": str(image_id),
+            "operation": operation,
+            "filename": filename,
+            "size": os.path.getsize(path),
+            "created_at": datetime.now(),
+            "last_used_at": datetime.now(),
+        }
+        previous = self.db.renditions.find_one_and_replace(
+            {"_id": key}, rendition, {"size": 1}, upsert=True
+        )
+        total = self._add_bytes(rendition["size"] - (previous or {}).get("size", 0))
+        if total > self.max_bytes:
+            self._evict(total)
+
+        return rendition
+
+    def _scan_total(self) -> int:
+        return next(
+            self.db.renditions.aggregate(
+                [{"$group": {"_id": None, "size": {"$sum": "$size"}}}]
+            ),
+            {"size": 0},
+        )["size"]
+
+    def _add_bytes(self, size: int) -> int:
+        return self.db.rendition_stats.find_one_and_update(
+            {"_id": TOTAL},
+            {"$inc": {"size": size}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )["size"]
+
+    def _forget(self, rendition: dict) -> bool:
+        # only the worker that deleted the document takes its bytes off
+        deleted = self.db.renditions.find_one_and_delete(
+            {"_id": rendition["_id"]}, {"size": 1}
+        )
+        if deleted is not None:
+            self._add_bytes(-deleted.get("size", 0))
+        return deleted is not None
+
+    def _remove(self, rendition: dict) -> None:
+        # only the worker that deleted the document removes the file
+        if self._forget(rendition):
+            try:
+                os.remove(os.path.join(self.folder, rendition["filename"]))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self, total: int) -> None:
+        for rendition in self.db.renditions.find({}, {"filename": 1, "size": 1}).sort(
+            "last_used_at", 1
+        ):
+            self._remove(rendition)
+            total -= rendition["size"]
+            if total <= self.max_bytes:
+                break
+
+    def purge(self, image_id: str) -> None:
+        for rendition in self.db.renditions.find(
+            {"image_id": str(image_id)}, {"filename": 1}
+        ):
+            self._remove(rendition)
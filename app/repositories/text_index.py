@@ -0,0 +1,349 @@
+import fcntl
+import json
+import os
+import shutil
+from contextlib import contextmanager
+import numpy as np
+from bson import ObjectId
+from sklearn.feature_extraction.text import HashingVectorizer
+
+# terms are hashed, so the index needs no vocabulary that grows and has to
+# be rewritten as texts are added
+N_FEATURES = 1 << 20
+
+# segments above this count are merged into fewer, larger ones
+MAX_SEGMENTS = 8
+
+SEGMENT_ARRAYS = ("terms", "indptr", "docs", "counts", "norms", "ids")
+
+# tokenizes like TfidfVectorizer and counts the terms of every text
+_vectorizer = HashingVectorizer(n_features=N_FEATURES, alternate_sign=False, norm=None)
+
+
+def _idf(df: np.ndarray, n_docs: int) -> np.ndarray:
+    # the smoothed idf TfidfVectorizer uses
+    return np.log((1 + n_docs) / (1 + df)) + 1
+
+
+class Segment:
+    """An immutable, memory-mapped slice of the index.
+
+    Postings are stored term by term: terms holds the sorted hashed terms
+    present, and docs[indptr[i]:indptr[i + 1]] the positions of the texts
+    that contain terms[i], with their counts alongside.
+    """
+
+    def __init__(self, folder: str, name: str, deleted: list) -> None:
+        self.name = name
+        for array in SEGMENT_ARRAYS:
+            path = os.path.join(folder, name, f"{array}.npy")
+            setattr(self, array, np.load(path, mmap_mode="r"))
+        self.deleted = np.array(sorted(deleted), np.int64)
+
+    @property
+    def size(self) -> int:
+        return len(self.ids)
+
+    @property
+    def live(self) -> int:
+        return self.size - len(self.deleted)
+
+    def lookup(self, terms: np.ndarray) -> tuple:
+        """Returns, per term, whether it is present and its postings range."""
+        if len(self.terms) == 0:
+            empty = np.zeros(len(terms), np.int64)
+            return np.zeros(len(terms), bool), empty, empty
+        positions = np.searchsorted(self.terms, terms)
+        clipped = np.minimum(positions, len(self.terms) - 1)
+        found = (positions < len(self.terms)) & (self.terms[clipped] == terms)
+        return found, self.indptr[clipped], self.indptr[clipped + 1]
+
+    def postings(self) -> tuple:
+        """Every live (term, position, count) posting, term by term."""
+        terms = np.repeat(np.asarray(self.terms), np.diff(self.indptr))
+        docs = np.asarray(self.docs)
+        keep = ~np.isin(docs, self.deleted)
+        return terms[keep], docs[keep], np.asarray(self.counts)[keep]
+
+
+class TextSearchIndex:
+    """A persistent tf-idf index searched by cosine similarity.
+
+    Texts are added as new segments and removed by marking them deleted, so
+    no write rewrites the whole index; small segments are merged as they
+    accumulate. A search only reads the postings of the query's terms, so
+    its cost follows the query rather than the size of the corpus.
+    """
+
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+        self.manifest_path = os.path.join(folder, "manifest.json")
+        os.makedirs(folder, exist_ok=True)
+        self._manifest_mtime = None
+        self._segments = []
+
+    @contextmanager
+    def _lock(self):
+        with open(os.path.join(self.folder, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.manifest_path)
+
+    def _read_manifest(self) -> dict:
+        if not self.exists():
+            return {"next": 0, "segments": []}
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def _write_manifest(self, manifest: dict) -> None:
+        # segments this write drops stay on disk for one more generation,
+        # for readers that read the previous manifest but have not loaded
+        # its segments yet
+        names = {segment["name"] for segment in manifest["segments"]}
+        previous = {segment["name"] for segment in self._read_manifest()["segments"]}
+        manifest["retired"] = sorted(previous - names)
+
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+        # readers that still map a deleted segment keep a valid view of it
+        for entry in os.listdir(self.folder):
+            if (
+                entry.startswith("seg-")
+                and entry not in names
+                and entry not in manifest["retired"]
+            ):
+                shutil.rmtree(os.path.join(self.folder, entry), ignore_errors=True)
+
+    def _load(self, manifest: dict = None) -> list:
+        if manifest is not None:
+            self._segments = self._open(manifest)
+            return self._segments
+
+        # segments are reloaded only when another worker changed them
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        if mtime == self._manifest_mtime:
+            return self._segments
+        try:
+            self._segments = self._open(self._read_manifest())
+        except FileNotFoundError:
+            # the manifest read was two generations behind by the time its
+            # segments were opened; the current one names only live segments
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+            self._segments = self._open(self._read_manifest())
+        self._manifest_mtime = mtime
+        return self._segments
+
+    def _open(self, manifest: dict) -> list:
+        return [
+            Segment(self.folder, segment["name"], segment["deleted"])
+            for segment in manifest["segments"]
+        ]
+
+    def _document_frequencies(self, segments: list, terms: np.ndarray) -> np.ndarray:
+        # texts deleted since their segment was written still count until
+        # it is merged
+        df = np.zeros(len(terms), np.int64)
+        for segment in segments:
+            found, starts, ends = segment.lookup(terms)
+            df += np.where(found, ends - starts, 0)
+        return df
+
+    def _write_segment(
+        self, manifest: dict, segments: list, terms, docs, counts, ids
+    ) -> dict:
+        # postings arrive sorted by term and then by position
+        unique_terms, term_postings = np.unique(terms, return_counts=True)
+        n_docs = sum(segment.live for segment in segments) + len(ids)
+        df = self._document_frequencies(segments, unique_terms) + term_postings
+        weights = counts * np.repeat(_idf(df, n_docs), term_postings)
+
+        # text norms use the idf of when the segment was written, and are
+        # refreshed whenever the segment is merged
+        norms = np.sqrt(np.bincount(docs, weights**2, minlength=len(ids)))
+        norms[norms == 0] = 1
+
+        name = f"seg-{manifest['next']:06d}"
+        manifest["next"] += 1
+        arrays = {
+            "terms": unique_terms.astype(np.int32),
+            "indptr": np.concatenate([[0], np.cumsum(term_postings)]).astype(np.int64),
+            "docs": np.asarray(docs, np.int32),
+            "counts": np.asarray(counts, np.float32),
+            "norms": norms.astype(np.float32),
+            "ids": np.frombuffer(
+                b"".join(ObjectId(i).binary for i in ids), np.uint8
+            ).reshape(-1, 12),
+        }
+        tmp_folder = os.path.join(self.folder, f"tmp-{name}")
+        os.makedirs(tmp_folder, exist_ok=True)
+        for array, values in arrays.items():
+            np.save(os.path.join(tmp_folder, f"{array}.npy"), values)
+        os.replace(tmp_folder, os.path.join(self.folder, name))
+
+        return {"name": name, "deleted": []}
+
+    def _add_segment(self, manifest: dict, segments: list, ids, texts) -> None:
+        csc = _vectorizer.transform(texts).tocsc()
+        csc.sort_indices()
+        terms = np.repeat(np.arange(N_FEATURES), np.diff(csc.indptr))
+        manifest["segments"].append(
+            self._write_segment(manifest, segments, terms, csc.indices, csc.data, ids)
+        )
+        segments.append(Segment(self.folder, manifest["segments"][-1]["name"], []))
+
+    def _merge(self, manifest: dict, segments: list, merged: list) -> None:
+        terms, docs, counts, ids = [], [], [], []
+        offset = 0
+        for segment in merged:
+            segment_terms, segment_docs, segment_counts = segment.postings()
+            alive = np.ones(segment.size, bool)
+            alive[segment.deleted] = False
+            # positions shift down past the deleted texts
+            renumbered = np.cumsum(alive) - 1 + offset
+            terms.append(segment_terms)
+            docs.append(renumbered[segment_docs])
+            counts.append(segment_counts)
+            ids.extend(ObjectId(row.tobytes()) for row in segment.ids[alive])
+            offset += int(alive.sum())
+
+        terms, docs, counts = (np.concatenate(a) for a in (terms, docs, counts))
+        order = np.lexsort((docs, terms))
+        kept = [segment for segment in segments if segment not in merged]
+        entry = self._write_segment(
+            manifest, kept, terms[order], docs[order], counts[order], ids
+        )
+
+        names = {segment.name for segment in merged}
+        manifest["segments"] = [
+            segment for segment in manifest["segments"] if segment["name"] not in names
+        ] + [entry]
+
+    def _compact(self, manifest: dict, segments: list) -> None:
+        if len(segments) <= MAX_SEGMENTS:
+            return
+        # the smallest segments are merged until half the limit remains, so
+        # every text is rewritten only a logarithmic number of times
+        smallest = sorted(segments, key=lambda segment: segment.live)
+        self._merge(
+            manifest, segments, smallest[: len(segments) - MAX_SEGMENTS // 2 + 1]
+        )
+
+    def add(self, ids: list, texts: list) -> None:
+        if not ids:
+            return
+        with self._lock():
+            manifest = self._read_manifest()
+            segments = self._load(manifest)
+            self._add_segment(manifest, segments, ids, texts)
+            self._compact(manifest, segments)
+            self._write_manifest(manifest)
+
+    def remove(self, ids: list) -> int:
+        targets = np.frombuffer(
+            b"".join(ObjectId(i).binary for i in ids), np.uint8
+        ).reshape(-1, 12)
+        removed = 0
+        with self._lock():
+            manifest = self._read_manifest()
+            for entry, segment in zip(manifest["segments"], self._load(manifest)):
+                stored = np.ascontiguousarray(segment.ids).view("V12").ravel()
+                positions = np.flatnonzero(np.isin(stored, targets.view("V12").ravel()))
+                new = set(positions.tolist()) - set(entry["deleted"])
+                entry["deleted"] = sorted(set(entry["deleted"]) | new)
+                removed += len(new)
+            if removed:
+                self._write_manifest(manifest)
+        return removed
+
+    def _rebuild(self, chunks) -> int:
+        manifest = {"next": self._read_manifest()["next"], "segments": []}
+        segments = []
+        total = 0
+        for ids, texts in chunks:
+            self._add_segment(manifest, segments, ids, texts)
+            total += len(ids)
+        # one final merge gives every text its norm over the whole corpus
+        if len(segments) > 1:
+            self._merge(manifest, segments, segments)
+        self._write_manifest(manifest)
+        return total
+
+    def rebuild(self, chunks) -> int:
+        """Replaces the index with the (ids, texts) chunks given."""
+        with self._lock():
+            return self._rebuild(chunks)
+
+    def ensure(self, chunks) -> None:
+        """Builds the index from the chunks given when it does not exist;
+        they are only read when it has to be built.
+        """
+        if self.exists():
+            return
+        with self._lock():
+            # another worker may have built it while this one waited
+            if not self.exists():
+                self._rebuild(chunks)
+
+    def search(self, query: str, k: int) -> list:
+        """Returns up to k (text_id, score) pairs, most similar first."""
+        segments = self._load()
+        row = _vectorizer.transform([query])
+        terms, query_counts = row.indices.astype(np.int32), row.data
+        if not segments or len(terms) == 0:
+            return []
+
+        n_docs = sum(segment.live for segment in segments)
+        idf = _idf(self._document_frequencies(segments, terms), n_docs)
+        query_weights = query_counts * idf
+        query_weights /= np.linalg.norm(query_weights)
+
+        scores, segment_ids, positions = [], [], []
+        for s, segment in enumerate(segments):
+            found, starts, ends = segment.lookup(terms)
+            docs, values = [], []
+            for i in np.flatnonzero(found):
+                postings = slice(starts[i], ends[i])
+                docs.append(segment.docs[postings])
+                values.append(query_weights[i] * idf[i] * segment.counts[postings])
+            if not docs:
+                continue
+
+            docs, values = np.concatenate(docs), np.concatenate(values)
+            candidates, inverse = np.unique(docs, return_inverse=True)
+            candidate_scores = np.bincount(inverse, values) / segment.norms[candidates]
+            live = ~np.isin(candidates, segment.deleted)
+
+            scores.append(candidate_scores[live])
+            positions.append(candidates[live])
+            segment_ids.append(np.full(int(live.sum()), s))
+
+        if not scores:
+            return []
+        scores = np.concatenate(scores)
+        positions = np.concatenate(positions)
+        segment_ids = np.concatenate(segment_ids)
+
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+
+        return [
+            (
+                str(ObjectId(segments[segment_ids[i]].ids[positions[i]].tobytes())),
+                float(scores[i]),
+            )
+            for i in top
+        ]
@@ -0,0 +1,79 @@
+from datetime import datetime
+from bson import ObjectId
+from pymongo.database import Database
+from app.errors import NotFoundError
+from app.repositories.text_index import TextSearchIndex
+
+# texts read from db.text per segment when the index is rebuilt
+REBUILD_CHUNK_SIZE = 20000
+
+
+class TextRepository:
+    def __init__(self, db: Database, index: TextSearchIndex) -> None:
+        if db is None:
+            raise ValueError("db cannot be None")
+        if index is None:
+            raise ValueError("index cannot be None")
+        self.db = db
+        self.index = index
+
+    def _ensure_index(self) -> None:
+        # an index missing on a deployment that already has texts is built
+        # from db.text before any write, so those texts stay searchable and
+        # the ones being written are indexed exactly once
+        self.index.ensure(self._chunks())
+
+    def add_texts(self, texts: list) -> dict:
+        self._ensure_index()
+        documents = [
+            {"_id": ObjectId(), "text": text, "created_at": datetime.now()}
+            for text in texts
+        ]
+        self.db.text.insert_many(documents)
+        ids = [str(document["_id"]) for document in documents]
+        self.index.add(ids, texts)
+
+        return {"message": "Texts added successfully", "ids": ids}
+
+    def delete_text(self, text_id: str) -> dict:
+        self._ensure_index()
+        result = self.db.text.delete_one({"_id": ObjectId(text_id)})
+        if result.deleted_count == 0:
+            raise NotFoundError("Text not found")
+        self.index.remove([text_id])
+
+        return {"message": "Text deleted successfully"}
+
+    def _chunks(self):
+        ids, texts = [], []
+        for document in self.db.text.find({}, {"text": 1}).sort("_id", 1):
+            if not isinstance(document.get("text"), str):
+                continue
+            ids.append(str(document["_id"]))
+            texts.append(document["text"])
+            if len(ids) == REBUILD_CHUNK_SIZE:
+                yield ids, texts
+                ids, texts = [], []
+        if ids:
+            yield ids, texts
+
+    def rebuild_index(self) -> dict:
+        # picks up texts written to db.text without going through the api
+        count = self.index.rebuild(self._chunks())
+
+        return {"message": "Text index rebuilt successfully", "count": count}
+
+    def search(self, query: str, k: int) -> list:
+        self._ensure_index()
+        matches = self.index.search(query, k)
+        texts = {
+            str(document["_id"]): document["text"]
+            for document in self.db.text.find(
+                {"_id": {"$in": [ObjectId(text_id) for text_id, _ in matches]}},
+                {"text": 1},
+            )
+        }
+
+        return [
+            (texts[text_id], score) for text_id, score in matches if text_id in texts
+        ]
@@ -1,55 +1,84 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, request, jsonify
 import os
 from app.db.db import db
-from bson import ObjectId
 from app.config import config
 from app.repositories.csv_repository import CsvRepository
+from app.repositories.job_repository import JobRepository
 from app.services.csv_services import CsvService
 
 csv_routes = Blueprint("csv", __name__)
 
-csv_respository = CsvRepository(db)
-csv_service = CsvService(csv_respository)
-
 UPLOAD_FOLDER = config["csv_upload_folder"]
 # Create the uploads folder if it doesn't exist
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
+csv_respository = CsvRepository(
+    db,
+    data_folder=UPLOAD_FOLDER,
+    storage_backend=config["csv_storage_backend"],
+    chunk_size=config["csv_chunk_size"],
+    insert_batch_size=config["csv_insert_batch_size"],
+    summary_max_distinct=config["csv_summary_max_distinct"],
+    pushdown_min_rows=config["csv_statistics_pushdown_rows"],
+    export_batch_size=config["csv_export_batch_size"],
+    max_column_indexes=config["csv_max_column_indexes"],
+)
+csv_service = CsvService(
+    csv_respository,
+    bulk_max_operations=config["csv_bulk_max_operations"],
+    job_repository=JobRepository(
+        db, config["jobs_heartbeat_seconds"], config["jobs_stale_seconds"]
+    ),
+    ingest_workers=config["csv_ingest_workers"],
+    max_page_size=config["csv_max_page_size"],
+)
+
 
 @csv_routes.route("/csv/upload", methods=["POST"])
 def csv_upload():
     file = request.files.get("file")
-    return jsonify(csv_service.process_and_upload_csv(file, UPLOAD_FOLDER)), 200
+    chunk_size = request.args.get("chunk_size", type=int)
+    storage_backend = request.args.get("storage")
+
+    if request.args.get("async", "false").lower() == "true":
+        return (
+            jsonify(
+                csv_service.queue_csv_upload(
+                    file, UPLOAD_FOLDER, chunk_size, storage_backend
+                )
+            ),
+            202,
+        )
+
+    return (
+        jsonify(
+            csv_service.process_and_upload_csv(
+                file, UPLOAD_FOLDER, chunk_size, storage_backend
+            )
+        ),
+        200,
+    )
 
 
-@csv_routes.route("/csv, methods=['POST']")
-def post_csv():
-    new_row = request.json
+@csv_routes.route("/csv/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    return jsonify(csv_service.get_job(job_id)), 200
 
-    # validate data
-    if not new_row:
-        return jsonify({"message": "No data found"}), 400
 
-    try:
-        db.csv.insert_one(new_row)
-        return jsonify({"message": "CSV data inserted successfully"}), 200
-    except Exception as e:
-        return jsonify({"message": str(e)}), 500
+@csv_routes.route("/csv", methods=["POST"])
+def post_csv():
+    new_row = dict(request.json or {})
+    csv_id = new_row.pop("csv_id", None)
+
+    return jsonify(csv_service.insert_csv_record(csv_id, new_row)), 200
 
 
 @csv_routes.route("/csv/<csv_id>", methods=["PATCH"])
 def update_csv(csv_id):
     updated_row = request.json
 
-    if not updated_row:
-        return jsonify({"message": "No data found"}), 400
-
-    try:
-        db.csv.update_one({"_id": ObjectId(csv_id)}, {"$set": updated_row})
-        return jsonify({"message": "CSV data updated successfully"}), 200
-    except Exception as e:
-        return jsonify({"message": str(e)}), 500
+    return jsonify(csv_service.update_csv_record(csv_id, updated_row)), 200
 
 
 @csv_routes.route("/csv/<csv_id>", methods=["DELETE"])
@@ -62,12 +91,35 @@ def delete_csv(csv_id):
     return jsonify(csv_service.delete_csv_record(csv_id)), 200
 
 
+@csv_routes.route("/csv/<csv_id>/records/bulk", methods=["POST"])
+def bulk_write_csv_records(csv_id):
+    operations = (request.json or {}).get("operations")
+
+    return jsonify(csv_service.bulk_write_csv_records(csv_id, operations)), 200
+
+
+@csv_routes.route("/csv/<csv_id>/records/<record_id>", methods=["PATCH"])
+def update_csv_record(csv_id, record_id):
+    updated_row = request.json
+
+    return (
+        jsonify(csv_service.update_csv_record(record_id, updated_row, csv_id)),
+        200,
+    )
+
+
+@csv_routes.route("/csv/<csv_id>/records/<record_id>", methods=["DELETE"])
+def delete_csv_record(csv_id, record_id):
+    return jsonify(csv_service.delete_csv_record(record_id, csv_id)), 200
+
+
 @csv_routes.route("/csv", methods=["GET"])
 def get_csv():
-    page = request.args.get("page", default=1, type=int)
+    page = request.args.get("page", type=int)
     page_size = request.args.get("page_size", default=10, type=int)
+    after = request.args.get("after")
 
-    return jsonify(csv_service.get_csv(page, page_size)), 200
+    return jsonify(csv_service.get_csv(page, page_size, after)), 200
 
 
 @csv_routes.route("/csv/<csv_id>", methods=["GET"])
@@ -77,42 +129,82 @@ def get_csv_by_id(csv_id):
 
 @csv_routes.route("/csv/<csv_id>/data", methods=["GET"])
 def get_csv_data_by_id(csv_id):
-    page = request.args.get("page", default=1, type=int)
+    page = request.args.get("page", type=int)
     page_size = request.args.get("page_size", default=10, type=int)
+    after = request.args.get("after")
+
+    return (
+        jsonify(csv_service.get_csv_data_by_id(csv_id, page, page_size, after)),
+        200,
+    )
+
 
-    return jsonify(csv_service.get_csv_data_by_id(csv_id, page, page_size)), 200
+@csv_routes.route("/csv/<csv_id>/export", methods=["GET"])
+def export_csv_data(csv_id):
+    export_format = request.args.get("format", default="csv")
+    columns = request.args.get("columns")
+
+    export = csv_service.export_csv_data(
+        csv_id, export_format, columns.split(",") if columns else None
+    )
+
+    # no content length, so the body is sent with chunked transfer encoding
+    return Response(
+        export["chunks"],
+        mimetype=export["mimetype"],
+        headers={
+            "Content-Disposition": f'attachment; filename="{export["filename"]}"',
+            "X-Accel-Buffering": "no",
+        },
+    )
 
 
 @csv_routes.route("/csv/<csv_id>/statistics", methods=["GET"])
 def get_csv_statistics(csv_id):
-    return jsonify(csv_service.get_csv_statistics(csv_id)), 200
+    engine = request.args.get("engine", default="summary")
+
+    return jsonify(csv_service.get_csv_statistics(csv_id, engine)), 200
 
 
 @csv_routes.route("/csv/query", methods=["GET"])
 def query_csv():
     column = request.args.get("column")
     value = request.args.get("value")
-    page = request.args.get("page", default=1, type=int)
+    page = request.args.get("page", type=int)
     page_size = request.args.get("page_size", default=10, type=int)
+    after = request.args.get("after")
+    with_total = request.args.get("with_total", "false").lower() == "true"
+    csv_id = request.args.get("csv_id")
+
+    return (
+        jsonify(
+            csv_service.query_csv(
+                column, value, page, page_size, after, with_total, csv_id
+            )
+        ),
+        200,
+    )
 
-    skip = (page - 1) * page_size
-    limit = page_size
 
-    if not column or not value:
-        return jsonify({"message": "Missing column or value"}), 400
+@csv_routes.route("/csv/<csv_id>/query", methods=["POST"])
+def query_dataset(csv_id):
+    query = request.json or {}
 
-    query = {column: value}
-    csv_data = db.csv.aggregate(
-        [
-            {"$match": query},
-            {"$skip": skip},
-            {"$limit": limit},
-            {"$addFields": {"_id": {"$toString": "$_id"}}},
-        ]
-    )
-    csv_count = db.csv.count_documents(query)
+    return jsonify(csv_service.query_dataset(csv_id, query)), 200
+
+
+@csv_routes.route("/csv/<csv_id>/indexes", methods=["GET"])
+def get_dataset_indexes(csv_id):
+    return jsonify(csv_service.get_dataset_indexes(csv_id)), 200
+
+
+@csv_routes.route("/csv/<csv_id>/indexes", methods=["POST"])
+def create_dataset_index(csv_id):
+    columns = (request.json or {}).get("columns")
+
+    return jsonify(csv_service.create_dataset_index(csv_id, columns)), 200
 
-    if not csv_data:
-        return jsonify({"message": "CSV data not found"}), 404
 
-    return jsonify({"data": list(csv_data), "total": csv_count}), 200
+@csv_routes.route("/csv/<csv_id>/indexes/<name>", methods=["DELETE"])
+def drop_dataset_index(csv_id, name):
+    return jsonify(csv_service.drop_dataset_index(csv_id, name)), 200
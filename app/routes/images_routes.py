@@ -1,16 +1,52 @@
 from flask import Blueprint, request, jsonify
 import os
+import shutil
 from app.db.db import db
 from app.config import config
 from app.repositories.images_repository import ImagesRepository
+from app.repositories.job_repository import JobRepository
+from app.repositories.phash_index import PerceptualHashIndex
+from app.repositories.rendition_repository import RenditionRepository
+from app.routes.static_files import send_upload
 from app.services.images_services import ImagesService
 
 images_routes = Blueprint("images", __name__)
 
 UPLOAD_FOLDER = config.get("images_upload_folder")
 
-images_repository = ImagesRepository(db, UPLOAD_FOLDER)
-images_service = ImagesService(images_repository)
+RENDITION_FOLDER = config["images_rendition_folder"]
+
+PHASH_FOLDER = config["images_phash_folder"]
+# indexes built inside the publicly served uploads folder are moved out
+LEGACY_PHASH_FOLDER = os.path.join(UPLOAD_FOLDER, "phash")
+if os.path.isdir(LEGACY_PHASH_FOLDER) and not os.path.exists(PHASH_FOLDER):
+    os.makedirs(os.path.dirname(PHASH_FOLDER), exist_ok=True)
+    shutil.move(LEGACY_PHASH_FOLDER, PHASH_FOLDER)
+
+rendition_repository = RenditionRepository(
+    db, RENDITION_FOLDER, config["images_rendition_cache_bytes"]
+)
+images_repository = ImagesRepository(
+    db,
+    UPLOAD_FOLDER,
+    rendition_repository,
+    job_repository=JobRepository(
+        db, config["jobs_heartbeat_seconds"], config["jobs_stale_seconds"]
+    ),
+    process_workers=config["images_process_workers"],
+    upload_workers=config["images_upload_workers"],
+    allowed_extensions=config["allowed_images_extensions"],
+    batch_workers=config["images_batch_workers"],
+    batch_chunk_size=config["images_batch_chunk_size"],
+    phash_index=PerceptualHashIndex(PHASH_FOLDER),
+    max_decode_bytes=config["images_max_decode_bytes"],
+)
+images_service = ImagesService(
+    images_repository,
+    batch_max_ids=config["images_batch_max_ids"],
+    segmentation_max_side=config["images_segmentation_max_side"],
+    batch_job_max_images=config["images_batch_job_max_images"],
+)
 
 # create the uploads folder if it doesn't exist
 if not os.path.exists(UPLOAD_FOLDER):
@@ -19,30 +55,17 @@ if not os.path.exists(UPLOAD_FOLDER):
 
 @images_routes.route("/images", methods=["GET"])
 def get_images():
-    page = request.args.get("page", default=1, type=int)
+    page = request.args.get("page", type=int)
     page_size = request.args.get("page_size", default=10, type=int)
+    after = request.args.get("after")
+    fields = request.args.get("fields")
 
-    if page < 1:
-        return jsonify({"message": "Invalid page number"}), 400
-
-    if page_size < 1:
-        return jsonify({"message": "Invalid page size"}), 400
-
-    skip = (page - 1) * page_size
-    limit = page_size
-    try:
-        data_cursor = db.images.aggregate(
-            [
-                {"$skip": skip},
-                {"$limit": limit},
-                {"$addFields": {"_id": {"$toString": "$_id"}}},
-            ]
-        )
-        data = list(data_cursor)
-        total = db.images.count_documents({})
-        return jsonify({"data": data, "total": total}), 200
-    except Exception as e:
-        return jsonify({"message": str(e)}), 500
+    return jsonify(images_service.get_images(page, page_size, after, fields)), 200
+
+
+@images_routes.route("/images/renditions/<filename>", methods=["GET"])
+def get_rendition(filename):
+    return send_upload(RENDITION_FOLDER, filename)
 
 
 @images_routes.route("/images/upload", methods=["POST"])
@@ -53,7 +76,9 @@ def upload_images():
 
 @images_routes.route("/images/<image_id>", methods=["GET"])
 def get_image(image_id):
-    return jsonify({"data": images_service.get_image(image_id)}), 200
+    fields = request.args.get("fields")
+
+    return jsonify({"data": images_service.get_image(image_id, fields)}), 200
 
 
 @images_routes.route("/images/<image_id>", methods=["DELETE"])
@@ -63,12 +88,75 @@ def delete_image(image_id):
 
 @images_routes.route("/images/<image_id>/histogram", methods=["POST"])
 def generate_color_histogram(image_id):
-    return jsonify(images_service.generate_image_histogram(image_id)), 200
+    options = request.get_json(silent=True) or {}
+    bins = options.get("bins", 256)
+    normalize = options.get("normalize", False)
+
+    return (
+        jsonify(images_service.generate_image_histogram(image_id, bins, normalize)),
+        200,
+    )
+
+
+@images_routes.route("/images/histograms", methods=["POST"])
+def generate_color_histograms():
+    options = request.json or {}
+    image_ids = options.get("ids")
+    bins = options.get("bins", 256)
+    normalize = options.get("normalize", False)
+
+    return (
+        jsonify(images_service.generate_image_histograms(image_ids, bins, normalize)),
+        200,
+    )
+
+
+@images_routes.route("/images/<image_id>/similar", methods=["GET"])
+def find_similar_images(image_id):
+    kind = request.args.get("hash", default="phash")
+    k = request.args.get("k", default=10, type=int)
+    max_distance = request.args.get("max_distance", default=10, type=int)
+
+    return (
+        jsonify(images_service.find_similar_images(image_id, kind, k, max_distance)),
+        200,
+    )
 
 
 @images_routes.route("/images/<image_id>/segmentation", methods=["POST"])
 def generate_segmentation_mask(image_id):
-    return jsonify(images_service.generate_segmentation_mask(image_id)), 200
+    options = request.get_json(silent=True) or {}
+    result = images_service.generate_segmentation_mask(image_id, options)
+
+    # cached masks are returned straight away, new ones run as a job
+    return jsonify(result), 202 if result["status"] == "queued" else 200
+
+
+@images_routes.route("/images/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    return jsonify(images_service.get_job(job_id)), 200
+
+
+@images_routes.route("/images/batch", methods=["POST"])
+def queue_image_batch():
+    options = request.json or {}
+    result = images_service.queue_image_batch(
+        options.get("ids"), options.get("filter"), options.get("operations")
+    )
+
+    return jsonify(result), 202
+
+
+@images_routes.route("/images/jobs/<job_id>/results", methods=["GET"])
+def get_batch_results(job_id):
+    page_size = request.args.get("page_size", default=100, type=int)
+    after = request.args.get("after")
+    status = request.args.get("status")
+
+    return (
+        jsonify(images_service.get_batch_results(job_id, page_size, after, status)),
+        200,
+    )
 
 
 @images_routes.route("/images/<image_id>/resize", methods=["POST"])
@@ -94,3 +182,10 @@ def convert_image(image_id):
     format = request.json.get("format")
 
     return jsonify(images_service.convert_image(image_id, format)), 200
+
+
+@images_routes.route("/images/<image_id>/pipeline", methods=["POST"])
+def pipeline_image(image_id):
+    operations = (request.json or {}).get("operations")
+
+    return jsonify(images_service.pipeline_image(image_id, operations)), 200
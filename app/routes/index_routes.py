@@ -0,0 +1,24 @@
+from flask import Blueprint, request, jsonify
+from app.db.db import db
+from app.repositories.index_repository import IndexRepository
+
+index_routes = Blueprint("indexes", __name__)
+
+index_repository = IndexRepository(db)
+
+
+@index_routes.route("/indexes", methods=["GET"])
+def get_indexes():
+    return jsonify(index_repository.get_indexes()), 200
+
+
+@index_routes.route("/indexes/reconcile", methods=["POST"])
+def reconcile_indexes():
+    return jsonify(index_repository.reconcile()), 200
+
+
+@index_routes.route("/indexes/report", methods=["GET"])
+def slow_query_report():
+    limit = request.args.get("limit", default=1000, type=int)
+
+    return jsonify(index_repository.slow_query_report(limit)), 200
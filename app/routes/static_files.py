@@ -0,0 +1,80 @@
+import mimetypes
+import os
+import re
+from flask import Response, request, send_file
+from werkzeug.security import safe_join
+from app.config import config
+from app.errors import NotFoundError
+
+# files whose name carries a hash of their content or an id that is never
+# reused: the name's hex part is a strong etag and the url never changes
+IMMUTABLE_FILES = (
+    # image renditions, named by the hash of their operation
+    re.compile(r"^(?P<key>[0-9a-f]{64})\.\w+$"),
+    # segmentation masks, named by the hash of their content and parameters
+    re.compile(r"^segmentation_(?P<key>[0-9a-f]{64})\.png$"),
+    # uploaded images, which are never modified once stored
+    re.compile(r"^(?P<key>[0-9a-f]{24})\.(png|jpg|jpeg)$"),
+)
+
+YEAR = 365 * 24 * 60 * 60
+
+
+def _immutable_key(filename: str) -> str:
+    for pattern in IMMUTABLE_FILES:
+        match = pattern.match(os.path.basename(filename))
+        if match:
+            return match.group("key")
+    return None
+
+
+def _offload(path: str, key: str) -> Response:
+    # the front server sends the bytes and answers range requests itself
+    stat = os.stat(path)
+    response = Response(
+        mimetype=mimetypes.guess_type(path)[0] or "application/octet-stream"
+    )
+    response.last_modified = stat.st_mtime
+    response.set_etag(key or f"{stat.st_mtime}-{stat.st_size}")
+
+    if config["static_sendfile"] == "x-accel-redirect":
+        relative = os.path.relpath(path, config["uploads_folder"])
+        response.headers["X-Accel-Redirect"] = (
+            config["static_accel_prefix"].rstrip("/") + "/" + relative
+        )
+    else:
+        response.headers["X-Sendfile"] = path
+
+    response = response.make_conditional(request)
+    if response.status_code == 304:
+        # some front servers send the file anyway when the header is set
+        response.headers.pop("X-Accel-Redirect", None)
+        response.headers.pop("X-Sendfile", None)
+    return response
+
+
+def send_upload(directory: str, filename: str) -> Response:
+    path = safe_join(directory, filename)
+    if path is None or not os.path.isfile(path):
+        raise NotFoundError("File not found")
+
+    key = _immutable_key(filename)
+
+    if config["static_sendfile"]:
+        response = _offload(path, key)
+    else:
+        # conditional answers 304 for a matching If-None-Match or
+        # If-Modified-Since and serves Range requests with a 206
+        response = send_file(path, etag=key or True, conditional=True)
+
+    if key:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = YEAR
+        response.cache_control.immutable = True
+    else:
+        # stored in caches but revalidated with the etag on every use
+        response.cache_control.public = True
+        response.cache_control.no_cache = True
+
+    return response
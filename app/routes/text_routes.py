@@ -5,13 +5,38 @@ import matplotlib.pyplot as plt
 import io
 import base64
 from app.db.db import db
-from sklearn.metrics.pairwise import cosine_similarity
-from app.services.text_services import TextProcessingService
+from app.config import config
+from app.repositories.nlp_cache_repository import NlpCacheRepository
+from app.repositories.text_index import TextSearchIndex
+from app.repositories.text_repository import TextRepository
+from app.services.text_services import TextProcessingService, TextSearchService
 
 
 text_routes = Blueprint("text", __name__)
 
-text_processing_service = TextProcessingService()
+text_processing_service = TextProcessingService(
+    batch_max_texts=config["text_batch_max_texts"],
+    cache=(
+        NlpCacheRepository(
+            db,
+            config["text_cache_ttl_seconds"],
+            config["text_cache_max_entries"],
+            config["text_cache_stats_flush_seconds"],
+        )
+        if config["text_cache_enabled"]
+        else None
+    ),
+)
+text_search_service = TextSearchService(
+    TextRepository(db, TextSearchIndex(config["text_index_folder"])),
+    max_k=config["text_search_max_k"],
+    batch_max_texts=config["text_batch_max_texts"],
+)
+
+
+def _use_cache() -> bool:
+    # ?cache=false recomputes the results instead of reading them cached
+    return request.args.get("cache", "true").lower() == "true"
 
 
 @text_routes.route("/text/tsne", methods=["POST"])
@@ -62,34 +87,27 @@ def tsne_visualization():
 @text_routes.route("/text/search", methods=["POST"])
 def search_text():
     query = request.json.get("query")
+    k = request.json.get("k", 3)
 
-    if not query:
-        return jsonify({"message": "Text and query are required"}), 400
-
-    try:
-        texts_cursor = db.text.aggregate(
-            [{"$group": {"_id": 0, "texts": {"$push": "$text"}}}]
-        )
+    # [text, similarity] pairs, most similar first
+    return jsonify(text_search_service.search(query, k)), 200
 
-        texts = list(texts_cursor)[0]["texts"]
 
-        tfidf_vectorizer = TfidfVectorizer()
-        tfidf_matrix = tfidf_vectorizer.fit_transform(texts)
+@text_routes.route("/text", methods=["POST"])
+def add_texts():
+    texts = (request.json or {}).get("texts")
 
-        query_vec = tfidf_vectorizer.transform([query])
+    return jsonify(text_search_service.add_texts(texts)), 201
 
-        similarities = cosine_similarity(query_vec, tfidf_matrix).flatten()
 
-        similar_texts = sorted(
-            [(texts[i], sim) for i, sim in enumerate(similarities)],
-            key=lambda x: x[1],
-            reverse=True,
-        )[:3]
+@text_routes.route("/text/<text_id>", methods=["DELETE"])
+def delete_text(text_id):
+    return jsonify(text_search_service.delete_text(text_id)), 200
 
-        return jsonify(similar_texts), 200
 
-    except Exception as e:
-        return jsonify({"message": str(e)}), 500
+@text_routes.route("/text/index/rebuild", methods=["POST"])
+def rebuild_text_index():
+    return jsonify(text_search_service.rebuild_index()), 200
 
 
 @text_routes.route("/text/categorize", methods=["POST"])
@@ -98,7 +116,7 @@ def categorize_text():
     if not text:
         return jsonify({"message": "Text is required"}), 400
 
-    categories = text_processing_service.categorize_text(text)
+    categories = text_processing_service.categorize_text(text, _use_cache())
     return jsonify(categories), 200
 
 
@@ -108,7 +126,7 @@ def analyze_sentiment():
     if not text:
         return jsonify({"message": "Text is required"}), 400
 
-    sentiment = text_processing_service.analyze_sentiment(text)
+    sentiment = text_processing_service.analyze_sentiment(text, _use_cache())
     return jsonify(sentiment), 200
 
 
@@ -119,7 +137,7 @@ def extract_keywords():
     if not text:
         return jsonify({"message": "Text is required"}), 400
 
-    keywords = text_processing_service.get_text_keywords(text)
+    keywords = text_processing_service.get_text_keywords(text, _use_cache())
     return jsonify({"keywords": keywords}), 200
 
 
@@ -129,5 +147,38 @@ def summarize_text():
     if not text:
         return jsonify({"message": "Text is required"}), 400
 
-    summary = text_processing_service.summarize_text(text)
+    summary = text_processing_service.summarize_text(text, _use_cache())
     return jsonify({"summary": summary}), 200
+
+
+@text_routes.route("/text/metrics", methods=["GET"])
+def get_metrics():
+    return jsonify(text_processing_service.get_metrics()), 200
+
+
+@text_routes.route("/text/keywords/batch", methods=["POST"])
+def extract_keywords_batch():
+    texts = (request.json or {}).get("texts")
+
+    return jsonify(text_processing_service.get_texts_keywords(texts, _use_cache())), 200
+
+
+@text_routes.route("/text/sentiment/batch", methods=["POST"])
+def analyze_sentiment_batch():
+    texts = (request.json or {}).get("texts")
+
+    return jsonify(text_processing_service.analyze_sentiments(texts, _use_cache())), 200
+
+
+@text_routes.route("/text/categorize/batch", methods=["POST"])
+def categorize_text_batch():
+    texts = (request.json or {}).get("texts")
+
+    return jsonify(text_processing_service.categorize_texts(texts, _use_cache())), 200
+
+
+@text_routes.route("/text/summarize/batch", methods=["POST"])
+def summarize_text_batch():
+    texts = (request.json or {}).get("texts")
+
+    return jsonify(text_processing_service.summarize_texts(texts, _use_cache())), 200
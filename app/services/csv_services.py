@@ -1,53 +1,348 @@
+from app.repositories.csv_export import FORMATS as EXPORT_FORMATS
+from concurrent.futures import ThreadPoolExecutor
+from bson import ObjectId
 from app.repositories.csv_repository import CsvRepository
+from app.repositories.job_repository import JobRepository
+from app.repositories.pagination import cursor_id
 from app.errors import NotFoundError, ValidationError
 
+# summary: stored column summaries, mongo: aggregation push-down,
+# pandas: in-process over the full columns, auto: mongo or pandas by size
+STATISTICS_ENGINES = ("summary", "auto", "mongo", "pandas")
+
+BULK_OPERATIONS = ("insert", "update", "delete")
+
 
 class CsvService:
-    def __init__(self, csv_repository: CsvRepository) -> None:
+    def __init__(
+        self,
+        csv_repository: CsvRepository,
+        bulk_max_operations: int = 10000,
+        job_repository: JobRepository = None,
+        ingest_workers: int = 2,
+        max_page_size: int = 1000,
+    ) -> None:
         if csv_repository is None:
             raise ValueError("csv_repository cannot be None")
         self.csv_repository = csv_repository
+        self.bulk_max_operations = bulk_max_operations
+        self.job_repository = job_repository
+        self.ingest_workers = ingest_workers
+        self.max_page_size = max_page_size
+        self._executor = None
+
+    def _check_page_size(self, page_size) -> None:
+        if not isinstance(page_size, int) or page_size < 1:
+            raise ValidationError("Invalid page size")
+
+        if page_size > self.max_page_size:
+            raise ValidationError(f"Pages are limited to {self.max_page_size} rows")
+
+    def process_and_upload_csv(
+        self,
+        file: object,
+        upload_folder: str,
+        chunk_size: int = None,
+        storage_backend: str = None,
+    ) -> dict:
+        if not file:
+            raise NotFoundError("No file found")
 
-    def process_and_upload_csv(self, file: object, upload_folder: str) -> dict:
+        if chunk_size is not None and chunk_size < 1:
+            raise ValidationError("Invalid chunk size")
+
+        return self.csv_repository.upload_csv(
+            file, upload_folder, chunk_size, storage_backend
+        )
+
+    def queue_csv_upload(
+        self,
+        file: object,
+        upload_folder: str,
+        chunk_size: int = None,
+        storage_backend: str = None,
+    ) -> dict:
         if not file:
             raise NotFoundError("No file found")
 
-        return self.csv_repository.upload_csv(file, upload_folder)
+        if chunk_size is not None and chunk_size < 1:
+            raise ValidationError("Invalid chunk size")
+
+        if self.job_repository is None:
+            raise ValidationError("Background ingestion is not enabled")
+
+        csv_id = self.csv_repository.create_csv_upload(
+            file, upload_folder, storage_backend
+        )
+        job_id = self.job_repository.create_job(
+            "csv_ingest", {"csv_id": csv_id, "chunk_size": chunk_size}
+        )
+
+        # the pool is created on first use so forked workers each get their
+        # own threads
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.ingest_workers, thread_name_prefix="csv-ingest"
+            )
+        self._executor.submit(self._run_ingest_job, job_id, csv_id, chunk_size)
+
+        return {
+            "message": "CSV upload queued",
+            "_id": csv_id,
+            "job_id": job_id,
+            "status": "queued",
+        }
+
+    def _run_ingest_job(self, job_id: str, csv_id: str, chunk_size: int) -> None:
+        try:
+            self.job_repository.start_job(job_id)
+            ingest = self.csv_repository.ingest_csv(
+                csv_id,
+                chunk_size,
+                lambda progress: self.job_repository.update_progress(job_id, progress),
+            )
+            self.job_repository.finish_job(job_id, {"_id": csv_id, **ingest})
+        except Exception as e:
+            # nothing waits on the future, so errors are only kept on the job
+            self.job_repository.fail_job(job_id, getattr(e, "message", str(e)))
+
+    def get_job(self, job_id: str) -> dict:
+        if self.job_repository is None:
+            raise NotFoundError("Job not found")
+
+        return self.job_repository.get_job(job_id)
+
+    def fail_orphaned_jobs(self) -> list:
+        if self.job_repository is None:
+            return []
+
+        jobs = self.job_repository.fail_orphaned_jobs()
+        csv_ids = [
+            job["params"]["csv_id"] for job in jobs if job["kind"] == "csv_ingest"
+        ]
+        if csv_ids:
+            self.csv_repository.mark_csv_failed(
+                csv_ids, "The worker ingesting the file exited"
+            )
+        return jobs
 
     def delete_csv_file(self, csv_id: str) -> dict:
         return self.csv_repository.delete_csv_file(csv_id)
 
-    def delete_csv_record(self, record_id: str) -> dict:
-        return self.csv_repository.delete_csv_record(record_id)
+    def insert_csv_record(self, csv_id: str, row: dict) -> dict:
+        if not csv_id:
+            raise ValidationError("csv_id is required")
+
+        if not row:
+            raise ValidationError("No data found")
+
+        return self.csv_repository.insert_csv_record(csv_id, row)
+
+    def update_csv_record(
+        self, record_id: str, updated_row: dict, csv_id: str = None
+    ) -> dict:
+        if not updated_row:
+            raise ValidationError("No data found")
+
+        if "_id" in updated_row or "csv_id" in updated_row:
+            raise ValidationError("_id and csv_id cannot be updated")
+
+        return self.csv_repository.update_csv_record(record_id, updated_row, csv_id)
+
+    def delete_csv_record(self, record_id: str, csv_id: str = None) -> dict:
+        return self.csv_repository.delete_csv_record(record_id, csv_id)
+
+    def _bulk_operation_error(self, operation: object, seen: set) -> str:
+        if not isinstance(operation, dict):
+            return "Operations must be objects"
+
+        op = operation.get("op")
+        if op not in BULK_OPERATIONS:
+            return f"Invalid op, expected one of: {', '.join(BULK_OPERATIONS)}"
+
+        if op != "delete":
+            row = operation.get("row")
+            if not row or not isinstance(row, dict):
+                return "No data found"
+            if "_id" in row or "csv_id" in row:
+                return "_id and csv_id cannot be updated"
+
+        if op != "insert":
+            record_id = operation.get("_id")
+            if not isinstance(record_id, str) or not ObjectId.is_valid(record_id):
+                return "Invalid record id"
+            if record_id in seen:
+                return "A record can only be changed once per batch"
+            seen.add(record_id)
+
+        return None
+
+    def bulk_write_csv_records(self, csv_id: str, operations: list) -> dict:
+        if not csv_id:
+            raise NotFoundError("CSV not found")
+
+        if not operations or not isinstance(operations, list):
+            raise ValidationError("A list of operations is required")
+
+        if len(operations) > self.bulk_max_operations:
+            raise ValidationError(
+                f"Batches are limited to {self.bulk_max_operations} operations"
+            )
+
+        # invalid items are reported in place instead of failing the batch
+        results = {}
+        valid = []
+        seen = set()
+        for index, operation in enumerate(operations):
+            error = self._bulk_operation_error(operation, seen)
+            if error:
+                results[index] = {"index": index, "status": "invalid", "error": error}
+            else:
+                valid.append({**operation, "index": index})
+
+        if valid:
+            for result in self.csv_repository.bulk_write_csv_records(csv_id, valid):
+                results[result["index"]] = result
 
-    def get_csv_statistics(self, csv_id: str) -> dict:
-        return self.csv_repository.get_csv_statistics(csv_id)
+        results = [results[index] for index in range(len(operations))]
+        counts = {}
+        for result in results:
+            counts[result["status"]] = counts.get(result["status"], 0) + 1
+
+        return {"results": results, "counts": counts}
+
+    def get_csv_statistics(self, csv_id: str, engine: str = "summary") -> dict:
+        if engine not in STATISTICS_ENGINES:
+            raise ValidationError(
+                f"Invalid engine, expected one of: {', '.join(STATISTICS_ENGINES)}"
+            )
+
+        return self.csv_repository.get_csv_statistics(csv_id, engine)
 
     def get_csv_by_id(self, csv_id: str) -> dict:
         return self.csv_repository.get_csv_by_id(csv_id)
 
     def get_csv_data_by_id(
-        self, csv_id: str, page: int = 1, page_size: int = 10
+        self,
+        csv_id: str,
+        page: int = None,
+        page_size: int = 10,
+        after: str = None,
     ) -> dict:
-        if page < 1:
+        if page is not None and page < 1:
             raise ValidationError("Invalid page number")
 
-        if page_size < 1:
-            raise ValidationError("Invalid page size")
+        self._check_page_size(page_size)
 
         if not csv_id:
             raise NotFoundError("CSV not found")
 
-        if not self.csv_repository.get_csv_by_id(csv_id):
-            raise NotFoundError("CSV not found")
+        return self.csv_repository.get_csv_data_by_id(
+            csv_id, page_size, cursor_id(after) if after else None, page
+        )
+
+    def get_csv(self, page: int = None, page_size: int = 10, after: str = None) -> dict:
+        if page is not None and page < 1:
+            raise ValidationError("Invalid page number")
 
-        return self.csv_repository.get_csv_data_by_id(csv_id, page, page_size)
+        self._check_page_size(page_size)
 
-    def get_csv(self, page: int = 1, page_size: int = 10) -> dict:
-        if page < 1:
+        return self.csv_repository.get_csv(
+            page_size, cursor_id(after) if after else None, page
+        )
+
+    def query_csv(
+        self,
+        column: str,
+        value: str,
+        page: int = None,
+        page_size: int = 10,
+        after: str = None,
+        with_total: bool = False,
+        csv_id: str = None,
+    ) -> dict:
+        if not column or not value:
+            raise ValidationError("Missing column or value")
+
+        if csv_id:
+            # scoped queries compare the value with the column's type
+            return self.query_dataset(
+                csv_id,
+                {
+                    "filter": {"column": column, "op": "eq", "value": value},
+                    "page_size": page_size,
+                    "after": after,
+                    "with_total": with_total,
+                },
+            )
+
+        if page is not None and page < 1:
             raise ValidationError("Invalid page number")
 
-        if page_size < 1:
-            raise ValidationError("Invalid page size")
+        self._check_page_size(page_size)
+
+        return self.csv_repository.query_csv(
+            column,
+            value,
+            page_size,
+            cursor_id(after) if after else None,
+            page,
+            with_total,
+        )
+
+    def create_dataset_index(self, csv_id: str, columns: list) -> dict:
+        if not columns or not isinstance(columns, list):
+            raise ValidationError("A list of columns is required")
+
+        for column in columns:
+            if not isinstance(column, str) or not column or column.startswith("$"):
+                raise ValidationError(f"Invalid column: {column}")
+
+            if column in ("_id", "csv_id"):
+                raise ValidationError(f"{column} is already indexed")
+
+        return self.csv_repository.create_dataset_index(csv_id, columns)
+
+    def get_dataset_indexes(self, csv_id: str) -> dict:
+        return self.csv_repository.get_dataset_indexes(csv_id)
+
+    def drop_dataset_index(self, csv_id: str, name: str) -> dict:
+        return self.csv_repository.drop_dataset_index(csv_id, name)
+
+    def query_dataset(self, csv_id: str, query: dict) -> dict:
+        if not csv_id:
+            raise NotFoundError("CSV not found")
+
+        page_size = query.get("page_size", 10)
+        self._check_page_size(page_size)
+
+        columns = query.get("columns")
+        if columns is not None and not isinstance(columns, list):
+            raise ValidationError("columns must be a list")
+
+        sort = query.get("sort")
+        if sort is not None and not isinstance(sort, list):
+            raise ValidationError("sort must be a list")
+
+        return self.csv_repository.query_dataset(
+            csv_id,
+            query.get("filter"),
+            columns,
+            sort,
+            page_size,
+            query.get("after"),
+            bool(query.get("with_total", False)),
+        )
+
+    def export_csv_data(
+        self, csv_id: str, export_format: str = "csv", columns: list = None
+    ) -> dict:
+        if not csv_id:
+            raise NotFoundError("CSV not found")
+
+        if export_format not in EXPORT_FORMATS:
+            raise ValidationError(
+                f"Invalid format, expected one of: {', '.join(EXPORT_FORMATS)}"
+            )
 
-        return self.csv_repository.get_csv(page, page_size)
+        return self.csv_repository.export_csv_data(csv_id, export_format, columns)
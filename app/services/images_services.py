@@ -1,20 +1,60 @@
-from app.repositories.images_repository import ImagesRepository
-from app.config import config
+from datetime import datetime
+from bson import ObjectId
+from app.repositories.image_ops import PERCEPTUAL_HASHES
+from app.repositories.images_repository import (
+    HEAVY_FIELDS,
+    IMAGE_FIELDS,
+    IMAGE_FORMATS,
+    LISTING_FIELDS,
+    ImagesRepository,
+)
 from app.errors import DatabaseError, ValidationError, NotFoundError
+from app.repositories.pagination import cursor_id
 
+# bin counts that evenly divide the 256 channel values
+HISTOGRAM_BINS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
 
-ALLOWED_EXTENSIONS = config.get("allowed_images_extensions", {"png", "jpg", "jpeg"})
+# pipeline operation: its required integer fields
+PIPELINE_OPERATIONS = {
+    "resize": ("width", "height"),
+    "crop": ("left", "top", "right", "bottom"),
+    "convert": (),
+}
+MAX_PIPELINE_OPERATIONS = 20
 
+BATCH_OPERATIONS = ("histogram", "segmentation", "pipeline", "phash")
+MAX_BATCH_OPERATIONS = 10
 
-def allowed_file(filename):
-    return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
+# filter field: accepted value type
+BATCH_FILTERS = {
+    "uploaded_after": datetime,
+    "uploaded_before": datetime,
+    "min_width": int,
+    "max_width": int,
+    "min_height": int,
+    "max_height": int,
+    "missing": list,
+}
+BATCH_MISSING_FIELDS = ("color_histogram", "segmentation_mask", "perceptual_hash")
+BATCH_RESULT_STATUSES = ("succeeded", "failed")
+
+MAX_SIMILAR_IMAGES = 100
 
 
 class ImagesService:
-    def __init__(self, images_repository: ImagesRepository):
+    def __init__(
+        self,
+        images_repository: ImagesRepository,
+        batch_max_ids=500,
+        segmentation_max_side=1024,
+        batch_job_max_images=10000,
+    ):
         if images_repository is None:
             raise ValueError("images_repository cannot be None")
         self.images_repository = images_repository
+        self.batch_max_ids = batch_max_ids
+        self.segmentation_max_side = segmentation_max_side
+        self.batch_job_max_images = batch_job_max_images
 
     def upload_images(self, files):
         if not files:
@@ -23,17 +63,45 @@ class ImagesService:
         if len(files) == 0:
             raise ValidationError("No files found")
 
-        for file in files:
-            if not allowed_file(file.filename):
-                raise ValidationError("Invalid file type")
-
+        # the file type is checked from its content while it is stored
         return self.images_repository.upload_images(files)
 
-    def get_image(self, image_id):
+    def _parse_fields(self, fields, default):
+        # a comma separated list, e.g. ?fields=filename,width,height
+        if not fields:
+            return default
+
+        fields = list(dict.fromkeys(f.strip() for f in fields.split(",") if f.strip()))
+        for field in fields:
+            if field not in IMAGE_FIELDS:
+                raise ValidationError(
+                    f"Invalid field {field}, expected any of: {', '.join(IMAGE_FIELDS)}"
+                )
+        return tuple(fields)
+
+    def get_images(self, page=None, page_size=10, after=None, fields=None):
+        if page is not None and page < 1:
+            raise ValidationError("Invalid page number")
+
+        if page_size < 1:
+            raise ValidationError("Invalid page size")
+
+        return self.images_repository.get_images(
+            page_size,
+            cursor_id(after) if after else None,
+            page,
+            self._parse_fields(fields, LISTING_FIELDS),
+        )
+
+    def get_image(self, image_id, fields=None):
         if not image_id:
             raise NotFoundError("Image not found")
 
-        return self.images_repository.get_image_by_id(image_id)
+        # heavy derived data is only returned when asked for
+        default = tuple(field for field in IMAGE_FIELDS if field not in HEAVY_FIELDS)
+        return self.images_repository.get_image_by_id(
+            image_id, self._parse_fields(fields, default)
+        )
 
     def delete_image(self, image_id):
         if not image_id:
@@ -41,26 +109,120 @@ class ImagesService:
 
         return self.images_repository.delete_image(image_id)
 
-    def generate_image_histogram(self, image_id):
+    def _validate_histogram_options(self, bins, normalize):
+        if bins not in HISTOGRAM_BINS:
+            raise ValidationError(
+                f"Invalid bins, expected one of: {', '.join(map(str, HISTOGRAM_BINS))}"
+            )
+
+        if not isinstance(normalize, bool):
+            raise ValidationError("normalize must be a boolean")
+
+    def generate_image_histogram(self, image_id, bins=256, normalize=False):
+        if not image_id:
+            raise NotFoundError("Image not found")
+
+        self._validate_histogram_options(bins, normalize)
+
+        return self.images_repository.generate_image_histogram(
+            image_id, bins, normalize
+        )
+
+    def generate_image_histograms(self, image_ids, bins=256, normalize=False):
+        if not image_ids or not isinstance(image_ids, list):
+            raise ValidationError("A list of image ids is required")
+
+        if len(image_ids) > self.batch_max_ids:
+            raise ValidationError(f"Batches are limited to {self.batch_max_ids} images")
+
+        for image_id in image_ids:
+            if not isinstance(image_id, str) or not ObjectId.is_valid(image_id):
+                raise ValidationError(f"Invalid image id: {image_id}")
+
+        self._validate_histogram_options(bins, normalize)
+
+        return self.images_repository.generate_image_histograms(
+            list(dict.fromkeys(image_ids)), bins, normalize
+        )
+
+    def _segmentation_params(self, options):
+        params = {
+            "scale": options.get("scale", 100),
+            "sigma": options.get("sigma", 0.5),
+            "min_size": options.get("min_size", 50),
+            "max_side": None,
+        }
+
+        for name in ("scale", "sigma"):
+            value = params[name]
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValidationError(f"{name} must be a number")
+            if value < 0 or (name == "scale" and value == 0):
+                raise ValidationError(f"Invalid {name}")
+            params[name] = float(value)
+
+        min_size = params["min_size"]
+        if isinstance(min_size, bool) or not isinstance(min_size, int) or min_size < 1:
+            raise ValidationError("min_size must be a positive integer")
+
+        # downscale: true segments a copy whose longest side is max_side
+        # pixels and upsamples the mask
+        if options.get("downscale"):
+            max_side = options.get("max_side", self.segmentation_max_side)
+            if isinstance(max_side, bool) or not isinstance(max_side, int):
+                raise ValidationError("max_side must be an integer")
+            if max_side < 16:
+                raise ValidationError("max_side must be at least 16")
+            params["max_side"] = max_side
+
+        return params
+
+    def generate_segmentation_mask(self, image_id, options=None):
         if not image_id:
             raise NotFoundError("Image not found")
 
-        return self.images_repository.generate_image_histogram(image_id)
+        params = self._segmentation_params(options or {})
+
+        return self.images_repository.generate_segmentation_mask(image_id, params)
 
-    def generate_segmentation_mask(self, image_id):
+    def find_similar_images(self, image_id, kind="phash", k=10, max_distance=10):
         if not image_id:
             raise NotFoundError("Image not found")
 
-        return self.images_repository.generate_segmentation_mask(image_id)
+        if kind not in PERCEPTUAL_HASHES:
+            raise ValidationError(
+                f"Invalid hash, expected one of: {', '.join(PERCEPTUAL_HASHES)}"
+            )
+
+        if k is None or k < 1 or k > MAX_SIMILAR_IMAGES:
+            raise ValidationError(f"k must be between 1 and {MAX_SIMILAR_IMAGES}")
+
+        if max_distance is None or max_distance < 0 or max_distance > 64:
+            raise ValidationError("max_distance must be between 0 and 64")
+
+        return self.images_repository.find_similar_images(
+            image_id, kind, k, max_distance
+        )
+
+    def get_job(self, job_id):
+        return self.images_repository.get_job(job_id)
+
+    def _validate_integers(self, **values):
+        # floats and strings would only fail inside pillow
+        for name, value in values.items():
+            if isinstance(value, bool) or not isinstance(value, int):
+                raise ValidationError(f"{name} must be an integer")
 
     def resize_image(self, image_id, width, height):
         if not image_id:
             raise NotFoundError("Image not found")
 
-        if not width or not height:
+        if width is None or height is None:
             raise ValidationError("Width and height are required")
 
-        if width < 0 or height < 0:
+        self._validate_integers(width=width, height=height)
+
+        if width <= 0 or height <= 0:
             raise ValidationError("Width and height must be greater than 0")
 
         return self.images_repository.resize_image(image_id, width, height)
@@ -69,11 +231,16 @@ class ImagesService:
         if not image_id:
             raise NotFoundError("Image not found")
 
-        if not left or not top or not right or not bottom:
+        if left is None or top is None or right is None or bottom is None:
             raise ValidationError(
                 "Left, top, right, and bottom coordinates are required"
             )
 
+        self._validate_integers(left=left, top=top, right=right, bottom=bottom)
+
+        if left < 0 or top < 0 or right <= left or bottom <= top:
+            raise ValidationError("Invalid crop box")
+
         return self.images_repository.crop_image(image_id, left, top, right, bottom)
 
     def convert_image(self, image_id, format):
@@ -83,7 +250,162 @@ class ImagesService:
         if not format:
             raise ValidationError("Format is required")
 
-        if format not in {"png", "jpg", "jpeg"}:
+        if format not in IMAGE_FORMATS:
             raise ValidationError("Invalid format")
 
         return self.images_repository.convert_image(image_id, format)
+
+    def _validate_operation(self, operation):
+        if not isinstance(operation, dict):
+            raise ValidationError("Operations must be objects")
+
+        op = operation.get("op")
+        if op not in PIPELINE_OPERATIONS:
+            raise ValidationError(
+                f"Invalid op, expected one of: {', '.join(PIPELINE_OPERATIONS)}"
+            )
+
+        for field in PIPELINE_OPERATIONS[op]:
+            value = operation.get(field)
+            if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+                raise ValidationError(f"{op} requires a non-negative integer {field}")
+
+        if op == "resize" and (operation["width"] == 0 or operation["height"] == 0):
+            raise ValidationError("Width and height must be greater than 0")
+
+        if op == "crop" and (
+            operation["right"] <= operation["left"]
+            or operation["bottom"] <= operation["top"]
+        ):
+            raise ValidationError("Invalid crop box")
+
+        if op == "convert":
+            if operation.get("format") not in IMAGE_FORMATS:
+                raise ValidationError("Invalid format")
+            return {"op": op, "format": IMAGE_FORMATS[operation["format"]]}
+
+        return {
+            "op": op,
+            **{field: operation[field] for field in PIPELINE_OPERATIONS[op]},
+        }
+
+    def _validate_pipeline(self, operations):
+        if not operations or not isinstance(operations, list):
+            raise ValidationError("A list of operations is required")
+
+        if len(operations) > MAX_PIPELINE_OPERATIONS:
+            raise ValidationError(
+                f"Pipelines are limited to {MAX_PIPELINE_OPERATIONS} operations"
+            )
+
+        return [self._validate_operation(operation) for operation in operations]
+
+    def pipeline_image(self, image_id, operations):
+        if not image_id:
+            raise NotFoundError("Image not found")
+
+        operations = self._validate_pipeline(operations)
+
+        return self.images_repository.pipeline_image(image_id, operations)
+
+    def _validate_batch_filter(self, image_filter):
+        if not isinstance(image_filter, dict):
+            raise ValidationError("filter must be an object")
+
+        validated = {}
+        for name, value in image_filter.items():
+            if name not in BATCH_FILTERS:
+                raise ValidationError(
+                    f"Invalid filter, expected any of: {', '.join(BATCH_FILTERS)}"
+                )
+
+            if BATCH_FILTERS[name] is datetime:
+                try:
+                    value = datetime.fromisoformat(value)
+                except (TypeError, ValueError):
+                    raise ValidationError(f"{name} must be an ISO 8601 date")
+            elif BATCH_FILTERS[name] is int:
+                if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+                    raise ValidationError(f"{name} must be a non-negative integer")
+            elif not isinstance(value, list) or any(
+                field not in BATCH_MISSING_FIELDS for field in value
+            ):
+                raise ValidationError(
+                    f"{name} must list any of: {', '.join(BATCH_MISSING_FIELDS)}"
+                )
+            validated[name] = value
+
+        return validated
+
+    def _validate_batch_operation(self, operation):
+        if not isinstance(operation, dict):
+            raise ValidationError("Operations must be objects")
+
+        op = operation.get("op")
+        if op not in BATCH_OPERATIONS:
+            raise ValidationError(
+                f"Invalid op, expected one of: {', '.join(BATCH_OPERATIONS)}"
+            )
+
+        if op == "histogram":
+            bins = operation.get("bins", 256)
+            normalize = operation.get("normalize", False)
+            self._validate_histogram_options(bins, normalize)
+            return {"op": op, "bins": bins, "normalize": normalize}
+
+        if op == "segmentation":
+            return {"op": op, "params": self._segmentation_params(operation)}
+
+        if op == "phash":
+            return {"op": op}
+
+        return {"op": op, "operations": self._validate_pipeline(operation.get("steps"))}
+
+    def queue_image_batch(self, image_ids=None, image_filter=None, operations=None):
+        if (image_ids is None) == (image_filter is None):
+            raise ValidationError("Either ids or filter is required")
+
+        if image_ids is not None:
+            if not image_ids or not isinstance(image_ids, list):
+                raise ValidationError("A list of image ids is required")
+
+            if len(image_ids) > self.batch_job_max_images:
+                raise ValidationError(
+                    f"Batches are limited to {self.batch_job_max_images} images"
+                )
+
+            for image_id in image_ids:
+                if not isinstance(image_id, str) or not ObjectId.is_valid(image_id):
+                    raise ValidationError(f"Invalid image id: {image_id}")
+            image_ids = list(dict.fromkeys(image_ids))
+        else:
+            image_filter = self._validate_batch_filter(image_filter)
+
+        if not operations or not isinstance(operations, list):
+            raise ValidationError("A list of operations is required")
+
+        if len(operations) > MAX_BATCH_OPERATIONS:
+            raise ValidationError(
+                f"Batches are limited to {MAX_BATCH_OPERATIONS} operations"
+            )
+
+        operations = [
+            self._validate_batch_operation(operation) for operation in operations
+        ]
+
+        return self.images_repository.queue_image_batch(
+            image_ids, image_filter, operations, self.batch_job_max_images
+        )
+
+    def get_batch_results(self, job_id, page_size=100, after=None, status=None):
+        if page_size < 1:
+            raise ValidationError("Invalid page size")
+
+        if status is not None and status not in BATCH_RESULT_STATUSES:
+            raise ValidationError(
+                f"Invalid status, expected one of: {', '.join(BATCH_RESULT_STATUSES)}"
+            )
+
+        return self.images_repository.get_batch_results(
+            job_id, page_size, cursor_id(after) if after else None, status
+        )
@@ -0,0 +1,111 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+# upper bounds of the batch size histogram buckets
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+
+class MicroBatcher:
+    """Coalesces concurrent calls into batches for one model.
+
+    Callers block on submit() while a single thread gathers queued items
+    until max_batch_size is reached or, once the queue is empty, max_wait_ms
+    has passed since the first one, runs them through run_batch at once and hands every caller
+    its own result.
+    """
+
+    def __init__(self, run_batch, max_batch_size: int, max_wait_ms: float) -> None:
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._metrics = {
+            "batches": 0,
+            "items": 0,
+            "errors": 0,
+            "max_batch_size": 0,
+            "batch_sizes": {str(bucket): 0 for bucket in BATCH_SIZE_BUCKETS},
+            "queue_wait_ms_total": 0.0,
+            "queue_wait_ms_max": 0.0,
+        }
+        threading.Thread(target=self._serve, name="micro-batcher", daemon=True).start()
+
+    def submit(self, item):
+        future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        return future.result()
+
+    def _gather(self) -> list:
+        # items already queued always join the batch; waiting for more only
+        # pays off where concurrent callers exist, so max_wait_ms of 0 sends
+        # the batch as soon as the queue is empty
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                if timeout <= 0:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _serve(self) -> None:
+        while True:
+            batch = self._gather()
+            started = time.perf_counter()
+            items = [item for item, _, _ in batch]
+            try:
+                results = self.run_batch(items)
+                errors = [None] * len(items)
+            except Exception:
+                # one bad input must not fail the requests batched with it
+                results, errors = [], []
+                for item in items:
+                    try:
+                        results.append(self.run_batch([item])[0])
+                        errors.append(None)
+                    except Exception as e:
+                        results.append(None)
+                        errors.append(e)
+
+            for (_, future, queued_at), result, error in zip(batch, results, errors):
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+            self._record(batch, started, sum(e is not None for e in errors))
+
+    def _record(self, batch: list, started: float, errors: int) -> None:
+        waits = [(started - queued_at) * 1000 for _, _, queued_at in batch]
+        bucket = next((b for b in BATCH_SIZE_BUCKETS if len(batch) <= b), None)
+        with self._lock:
+            metrics = self._metrics
+            metrics["batches"] += 1
+            metrics["items"] += len(batch)
+            metrics["errors"] += errors
+            metrics["max_batch_size"] = max(metrics["max_batch_size"], len(batch))
+            if bucket is not None:
+                metrics["batch_sizes"][str(bucket)] += 1
+            metrics["queue_wait_ms_total"] += sum(waits)
+            metrics["queue_wait_ms_max"] = max(metrics["queue_wait_ms_max"], *waits)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            metrics = {
+                **self._metrics,
+                "batch_sizes": dict(self._metrics["batch_sizes"]),
+            }
+        batches, items = metrics["batches"], metrics["items"]
+        metrics["mean_batch_size"] = round(items / batches, 2) if batches else 0
+        metrics["mean_queue_wait_ms"] = (
+            round(metrics["queue_wait_ms_total"] / items, 3) if items else 0
+        )
+        metrics["queue_wait_ms_total"] = round(metrics["queue_wait_ms_total"], 3)
+        metrics["queue_wait_ms_max"] = round(metrics["queue_wait_ms_max"], 3)
+        return metrics
@@ -0,0 +1,371 @@
+import gc
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing import AuthenticationError
+from multiprocessing.managers import BaseManager
+from app.config import config
+from app.errors import ServiceUnavailableError
+from app.services.micro_batcher import MicroBatcher
+
+SUMMARIZER_MODEL = "t5-small"
+# the model the sentiment-analysis pipeline defaults to
+SENTIMENT_MODEL = "distilbert/distilbert-base-uncased-finetuned-sst-2-english"
+CLASSIFIER_MODEL = "lxyuan/distilbert-base-multilingual-cased-sentiments-student"
+NLP_MODEL = "en_core_web_sm"
+
+SUMMARY_PARAMS = {"max_length": 100, "min_length": 10, "do_sample": False}
+KEYWORD_POS = ["NOUN", "PROPN"]
+
+# what the result of each task depends on besides the text; cached results
+# are keyed by it, so changing a model or its parameters starts afresh
+TASK_MODELS = {
+    "summarize": {"model": SUMMARIZER_MODEL, **SUMMARY_PARAMS},
+    "keywords": {"model": NLP_MODEL, "pos": KEYWORD_POS},
+    "sentiment": {"model": SENTIMENT_MODEL},
+    "categorize": {"model": CLASSIFIER_MODEL},
+}
+
+# models are imported and loaded on first use, so workers that never serve
+# text requests never pay for them
+
+
+def _load_summarizer():
+    from transformers import pipeline
+
+    return pipeline("summarization", model=SUMMARIZER_MODEL)
+
+
+def _load_sentiment_analyzer():
+    from transformers import pipeline
+
+    return pipeline("sentiment-analysis", model=SENTIMENT_MODEL)
+
+
+def _load_classifier():
+    from transformers import pipeline
+
+    return pipeline(model=CLASSIFIER_MODEL, return_all_scores=True)
+
+
+def _load_nlp():
+    import spacy
+
+    # keywords only need part of speech tags and stop words, so the parser,
+    # entity recognizer and lemmatizer are never loaded
+    return spacy.load(NLP_MODEL, exclude=["parser", "ner", "lemmatizer"])
+
+
+LOADERS = {
+    "summarizer": _load_summarizer,
+    "sentiment_analyzer": _load_sentiment_analyzer,
+    "classifier": _load_classifier,
+    "nlp": _load_nlp,
+}
+
+
+# tasks run next to the models and return plain picklable values
+
+
+def _by_length(run):
+    # batches are run shortest text first, so the pipelines' sub-batches
+    # pad to similar lengths, and the results are put back in order
+    def run_batch(models, texts):
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        results = run(models, [texts[i] for i in order])
+        ordered = [None] * len(texts)
+        for position, result in zip(order, results):
+            ordered[position] = result
+        return ordered
+
+    return run_batch
+
+
+@_by_length
+def _summarize(models, texts):
+    outputs = models.get("summarizer")(
+        texts, **SUMMARY_PARAMS, batch_size=models.batch_size
+    )
+    return [output["summary_text"] for output in outputs]
+
+
+def _doc_keywords(doc):
+    keywords = {
+        token.text for token in doc if token.pos_ in KEYWORD_POS and not token.is_stop
+    }
+    return list(keywords)
+
+
+def _keywords(models, text):
+    return _doc_keywords(models.get("nlp")(text))
+
+
+def _keywords_many(models, texts):
+    # large lists are split between several processes
+    n_process = models.pipe_processes if len(texts) >= models.pipe_process_min else 1
+    docs = models.get("nlp").pipe(texts, batch_size=256, n_process=n_process)
+    return [_doc_keywords(doc) for doc in docs]
+
+
+@_by_length
+def _sentiment(models, texts):
+    outputs = models.get("sentiment_analyzer")(texts, batch_size=models.batch_size)
+    return [{"label": result["label"], "score": result["score"]} for result in outputs]
+
+
+@_by_length
+def _categorize(models, texts):
+    outputs = models.get("classifier")(texts, batch_size=models.batch_size)
+    # the scores of each text, shaped as a single text call returns them
+    return [[scores] for scores in outputs]
+
+
+TASKS = {"keywords": _keywords}
+
+# tasks that take a list of texts and whose concurrent calls are batched
+BATCH_TASKS = {
+    "summarize": _summarize,
+    "sentiment": _sentiment,
+    "categorize": _categorize,
+}
+
+# tasks run over a list of texts at once
+MANY_TASKS = {"keywords": _keywords_many, **BATCH_TASKS}
+
+# the model each task runs
+TASK_LOADERS = {
+    "summarize": "summarizer",
+    "keywords": "nlp",
+    "sentiment": "sentiment_analyzer",
+    "categorize": "classifier",
+}
+
+
+class ModelRegistry:
+    """Loads models on first use and unloads the ones left idle.
+
+    Concurrent calls of a batch task are coalesced into one forward pass
+    of up to batch_size texts, waiting at most batch_wait_ms for them.
+    """
+
+    def __init__(
+        self,
+        idle_seconds: int = 0,
+        batch_size: int = 1,
+        batch_wait_ms: float = 0,
+        pipe_processes: int = 1,
+        pipe_process_min: int = 500,
+    ) -> None:
+        self.idle_seconds = idle_seconds
+        self.batch_size = batch_size
+        self.batch_wait_ms = batch_wait_ms
+        self.pipe_processes = pipe_processes
+        self.pipe_process_min = pipe_process_min
+        self._batchers = {}
+        self._batchers_lock = threading.Lock()
+        self._models = {}
+        self._last_used = {}
+        # tasks running on each model, which is never unloaded under them
+        self._in_use = {name: 0 for name in LOADERS}
+        self._locks = {name: threading.Lock() for name in LOADERS}
+        if idle_seconds:
+            threading.Thread(
+                target=self._unload_idle, name="model-unloader", daemon=True
+            ).start()
+
+    def get(self, name: str):
+        self._last_used[name] = time.monotonic()
+        model = self._models.get(name)
+        if model is None:
+            # concurrent first requests wait for a single load
+            with self._locks[name]:
+                model = self._models.get(name)
+                if model is None:
+                    model = LOADERS[name]()
+                    self._models[name] = model
+        return model
+
+    @contextmanager
+    def _using(self, task: str):
+        name = TASK_LOADERS[task]
+        with self._locks[name]:
+            self._in_use[name] += 1
+        try:
+            yield
+        finally:
+            with self._locks[name]:
+                self._in_use[name] -= 1
+                # idle time counts from the end of the last task
+                self._last_used[name] = time.monotonic()
+
+    def _run_tasks(self, tasks: dict, task: str, texts):
+        with self._using(task):
+            return tasks[task](self, texts)
+
+    def _batcher(self, task: str) -> MicroBatcher:
+        with self._batchers_lock:
+            if task not in self._batchers:
+                self._batchers[task] = MicroBatcher(
+                    lambda texts: self._run_tasks(BATCH_TASKS, task, texts),
+                    self.batch_size,
+                    self.batch_wait_ms,
+                )
+            return self._batchers[task]
+
+    def run(self, task: str, text):
+        if task in BATCH_TASKS:
+            if self.batch_size <= 1:
+                return self._run_tasks(BATCH_TASKS, task, [text])[0]
+            return self._batcher(task).submit(text)
+        return self._run_tasks(TASKS, task, text)
+
+    def run_many(self, task: str, texts: list) -> list:
+        return self._run_tasks(MANY_TASKS, task, texts)
+
+    def loaded(self) -> list:
+        return list(self._models)
+
+    def metrics(self) -> dict:
+        return {
+            "batch_size": self.batch_size,
+            "batch_wait_ms": self.batch_wait_ms,
+            "loaded_models": self.loaded(),
+            "tasks": {
+                task: batcher.metrics() for task, batcher in self._batchers.items()
+            },
+        }
+
+    def _unload_idle(self) -> None:
+        while True:
+            time.sleep(min(self.idle_seconds, 60))
+            now = time.monotonic()
+            for name in list(self._models):
+                with self._locks[name]:
+                    if self._in_use[name]:
+                        continue
+                    if now - self._last_used.get(name, now) > self.idle_seconds:
+                        self._models.pop(name, None)
+                        gc.collect()
+
+
+class ModelHostManager(BaseManager):
+    pass
+
+
+def _address(value: str):
+    # host:port, or the path of a unix socket
+    if value.startswith("/"):
+        return value
+    host, port = value.rsplit(":", 1)
+    return host, int(port)
+
+
+def _authkey() -> bytes:
+    authkey = os.environ.get("TEXT_MODEL_HOST_AUTHKEY")
+    if not authkey:
+        raise ServiceUnavailableError("TEXT_MODEL_HOST_AUTHKEY is not set")
+    return authkey.encode()
+
+
+_registry = None
+
+
+def _create_registry(hosted: bool = False) -> ModelRegistry:
+    # a sync gunicorn worker serves one request at a time, so waiting for
+    # more calls to batch with only pays off in the shared host
+    return ModelRegistry(
+        config["text_model_idle_seconds"],
+        config["text_batch_max_size"],
+        config["text_batch_wait_ms"] if hosted else 0,
+        config["text_pipe_processes"],
+        config["text_pipe_process_min"],
+    )
+
+
+def _host_registry() -> ModelRegistry:
+    global _registry
+    if _registry is None:
+        _registry = _create_registry(hosted=True)
+    return _registry
+
+
+ModelHostManager.register(
+    "models", callable=_host_registry, exposed=("run", "run_many", "loaded", "metrics")
+)
+
+_host = None
+
+
+def start_host() -> None:
+    """Starts the shared model host when TEXT_MODEL_HOST is set; called by
+    the gunicorn master before it forks the workers.
+    """
+    global _host
+    if not config["text_model_host"] or _host is not None:
+        return
+    # workers inherit the key through the environment
+    os.environ.setdefault("TEXT_MODEL_HOST_AUTHKEY", secrets.token_hex(16))
+    _host = ModelHostManager(_address(config["text_model_host"]), _authkey())
+    _host.start()
+
+
+def stop_host() -> None:
+    global _host
+    if _host is not None:
+        _host.shutdown()
+        _host = None
+
+
+class RemoteModels:
+    """Runs tasks in the shared model host, connecting on first use."""
+
+    def __init__(self, address: str) -> None:
+        self.address = address
+        self._proxy = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        with self._lock:
+            if self._proxy is None:
+                manager = ModelHostManager(_address(self.address), _authkey())
+                manager.connect()
+                self._proxy = manager.models()
+        return self._proxy
+
+    def run(self, task: str, text):
+        return self._call("run", task, text)
+
+    def run_many(self, task: str, texts: list) -> list:
+        return self._call("run_many", task, texts)
+
+    def metrics(self) -> dict:
+        return self._call("metrics")
+
+    def _call(self, method: str, *args):
+        try:
+            return getattr(self._connect(), method)(*args)
+        except (ConnectionError, EOFError, AuthenticationError) as e:
+            # the next request reconnects, e.g. after the host restarted
+            self._proxy = None
+            raise ServiceUnavailableError(
+                f"The model host is not available ({type(e).__name__})"
+            )
+
+
+def create_models():
+    """The shared host's models when TEXT_MODEL_HOST is set, otherwise
+    models loaded inside this worker.
+    """
+    if config["text_model_host"]:
+        return RemoteModels(config["text_model_host"])
+    return _create_registry()
+
+
+if __name__ == "__main__":
+    # a standalone host for deployments that do not start it from gunicorn;
+    # the workers need the same TEXT_MODEL_HOST and TEXT_MODEL_HOST_AUTHKEY
+    ModelHostManager(
+        _address(config["text_model_host"]), _authkey()
+    ).get_server().serve_forever()
@@ -1,40 +1,134 @@
-from transformers import pipeline
-import spacy
+from bson import ObjectId
+from app.errors import NotFoundError, ValidationError
+from app.repositories.text_repository import TextRepository
+from app.services.text_models import TASK_MODELS, create_models
 
 
-summarizer = pipeline("summarization", model="t5-small")
-sentiment_analyzer = pipeline("sentiment-analysis")
-classifier = pipeline(
-    model="lxyuan/distilbert-base-multilingual-cased-sentiments-student",
-    return_all_scores=True,
-)
-nlp = spacy.load("en_core_web_sm")
+class TextProcessingService:
+    def __init__(self, models=None, batch_max_texts=1000, cache=None):
+        # models run in this worker or in the shared model host
+        self.models = models or create_models()
+        self.batch_max_texts = batch_max_texts
+        self.cache = cache
 
+    def _cached(self, task: str, texts: list, use_cache: bool, run) -> list:
+        # only texts without a cached result are run, each once; a bypass
+        # skips the lookup but still stores the fresh results
+        if self.cache is None:
+            return run(texts)
+        model = TASK_MODELS[task]
+        found = self.cache.get_many(task, model, texts) if use_cache else {}
+        missing = [text for text in dict.fromkeys(texts) if text not in found]
+        if missing:
+            results = dict(zip(missing, run(missing)))
+            self.cache.put_many(task, model, results)
+            found.update(results)
+        return [found[text] for text in texts]
 
-class TextProcessingService:
-    @staticmethod
-    def summarize_text(text: str) -> str:
-        summary = summarizer(text, max_length=100, min_length=10, do_sample=False)[0][
-            "summary_text"
-        ]
-        return summary
-
-    @staticmethod
-    def get_text_keywords(text: str) -> list:
-        doc = nlp(text)
-        keywords = {
-            token.text
-            for token in doc
-            if token.pos_ in ["NOUN", "PROPN"] and not token.is_stop
-        }
-        return list(keywords)
-
-    @staticmethod
-    def analyze_sentiment(text: str) -> dict:
-        result = sentiment_analyzer(text)[0]
-        return {"label": result["label"], "score": result["score"]}
-
-    @staticmethod
-    def categorize_text(text: str) -> dict:
-        categories = classifier(text)
+    def _run(self, task: str, text: str, use_cache: bool):
+        return self._cached(
+            task, [text], use_cache, lambda texts: [self.models.run(task, texts[0])]
+        )[0]
+
+    def _run_many(self, task: str, texts: list, use_cache: bool) -> list:
+        return self._cached(
+            task, texts, use_cache, lambda texts: self.models.run_many(task, texts)
+        )
+
+    def summarize_text(self, text: str, use_cache=True) -> str:
+        return self._run("summarize", text, use_cache)
+
+    def get_text_keywords(self, text: str, use_cache=True) -> list:
+        return self._run("keywords", text, use_cache)
+
+    def analyze_sentiment(self, text: str, use_cache=True) -> dict:
+        return self._run("sentiment", text, use_cache)
+
+    def categorize_text(self, text: str, use_cache=True) -> dict:
+        categories = self._run("categorize", text, use_cache)
         return {"categories": categories}
+
+    def _validate_texts(self, texts):
+        if not texts or not isinstance(texts, list):
+            raise ValidationError("A list of texts is required")
+
+        if len(texts) > self.batch_max_texts:
+            raise ValidationError(
+                f"Batches are limited to {self.batch_max_texts} texts"
+            )
+
+        for i, text in enumerate(texts):
+            if not isinstance(text, str) or not text:
+                raise ValidationError(f"Text {i} must be a non-empty string")
+
+    # the list variants return one result per text, in order, shaped as
+    # the single text endpoints return theirs
+
+    def summarize_texts(self, texts: list, use_cache=True) -> dict:
+        self._validate_texts(texts)
+        summaries = self._run_many("summarize", texts, use_cache)
+        return {"data": [{"summary": summary} for summary in summaries]}
+
+    def get_texts_keywords(self, texts: list, use_cache=True) -> dict:
+        self._validate_texts(texts)
+        keywords = self._run_many("keywords", texts, use_cache)
+        return {"data": [{"keywords": words} for words in keywords]}
+
+    def analyze_sentiments(self, texts: list, use_cache=True) -> dict:
+        self._validate_texts(texts)
+        return {"data": self._run_many("sentiment", texts, use_cache)}
+
+    def categorize_texts(self, texts: list, use_cache=True) -> dict:
+        self._validate_texts(texts)
+        categories = self._run_many("categorize", texts, use_cache)
+        return {"data": [{"categories": scores} for scores in categories]}
+
+    def get_metrics(self) -> dict:
+        metrics = self.models.metrics()
+        if self.cache is not None:
+            metrics["cache"] = self.cache.stats()
+        return metrics
+
+
+class TextSearchService:
+    def __init__(
+        self, text_repository: TextRepository, max_k=100, batch_max_texts=1000
+    ):
+        if text_repository is None:
+            raise ValueError("text_repository cannot be None")
+        self.text_repository = text_repository
+        self.max_k = max_k
+        self.batch_max_texts = batch_max_texts
+
+    def add_texts(self, texts):
+        if not texts or not isinstance(texts, list):
+            raise ValidationError("A list of texts is required")
+
+        if len(texts) > self.batch_max_texts:
+            raise ValidationError(
+                f"Batches are limited to {self.batch_max_texts} texts"
+            )
+
+        for i, text in enumerate(texts):
+            if not isinstance(text, str) or not text:
+                raise ValidationError(f"Text {i} must be a non-empty string")
+
+        return self.text_repository.add_texts(texts)
+
+    def delete_text(self, text_id):
+        if not text_id or not ObjectId.is_valid(text_id):
+            raise NotFoundError("Text not found")
+
+        return self.text_repository.delete_text(text_id)
+
+    def rebuild_index(self):
+        return self.text_repository.rebuild_index()
+
+    def search(self, query, k=3):
+        if not query or not isinstance(query, str):
+            raise ValidationError("Query is required")
+
+        if isinstance(k, bool) or not isinstance(k, int) or not 1 <= k <= self.max_k:
+            raise ValidationError(f"k must be between 1 and {self.max_k}")
+
+        return self.text_repository.search(query, k)
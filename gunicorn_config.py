@@ -13,3 +13,17 @@ loglevel = "info"
 accesslog = "-"
 
 errorlog = "-"
+
+
+def on_starting(server):
+    # with TEXT_MODEL_HOST set, one process loads the nlp models for every
+    # worker instead of each worker loading its own copy
+    from app.services import text_models
+
+    text_models.start_host()
+
+
+def on_exit(server):
+    from app.services import text_models
+
+    text_models.stop_host()
@@ -0,0 +1,8 @@
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+
+@pytest.fixture
+def db():
+    return mongomock.MongoClient().flaskfusion
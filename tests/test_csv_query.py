@@ -0,0 +1,82 @@
+import json
+import pytest
+from app.errors import ValidationError
+from app.repositories.csv_repository import CsvRepository
+
+
+@pytest.fixture(params=["mongo", "arrow"])
+def dataset(request, db, tmp_path):
+    repository = CsvRepository(db, str(tmp_path), storage_backend=request.param)
+    path = tmp_path / "scores.csv"
+    path.write_text("name,score\na,3\nb,\nc,1\nd,2\n")
+
+    class Upload:
+        filename = "scores.csv"
+
+        def save(self, target):
+            with open(target, "w") as f:
+                f.write(path.read_text())
+
+    csv_id = repository.create_csv_upload(Upload(), str(tmp_path))
+    repository.ingest_csv(csv_id)
+    return repository, csv_id
+
+
+def _pages(repository, csv_id, sort):
+    names, after = [], None
+    while True:
+        page = repository.query_dataset(csv_id, sort=sort, page_size=1, after=after)
+        # pages must serialize as strict json, with missing cells as null
+        json.dumps(page, allow_nan=False)
+        names += [row["name"] for row in page["data"]]
+        after = page["next"]
+        if after is None:
+            return names
+
+
+@pytest.mark.parametrize(
+    "direction, expected",
+    [("asc", ["b", "c", "d", "a"]), ("desc", ["a", "d", "c", "b"])],
+)
+def test_paging_over_missing_values(dataset, direction, expected):
+    repository, csv_id = dataset
+    sort = [{"column": "score", "direction": direction}]
+
+    assert _pages(repository, csv_id, sort) == expected
+
+
+def test_missing_values_match_is_null(dataset):
+    repository, csv_id = dataset
+    page = repository.query_dataset(
+        csv_id, conditions={"column": "score", "op": "is_null", "value": True}
+    )
+
+    assert [row["name"] for row in page["data"]] == ["b"]
+    assert page["data"][0]["score"] is None
+
+
+def test_writes_are_coerced_to_column_types(dataset):
+    repository, csv_id = dataset
+    repository.insert_csv_record(csv_id, {"name": "e", "score": "5"})
+
+    page = repository.query_dataset(
+        csv_id, conditions={"column": "score", "op": "eq", "value": 5}
+    )
+    assert [row["name"] for row in page["data"]] == ["e"]
+
+    with pytest.raises(ValidationError):
+        repository.insert_csv_record(csv_id, {"name": "f", "score": "abc"})
+
+
+@pytest.mark.parametrize(
+    "conditions",
+    [
+        {"column": "score", "op": "ne", "value": 3},
+        {"not": {"column": "score", "op": "eq", "value": 3}},
+    ],
+)
+def test_negations_match_missing_values(dataset, conditions):
+    repository, csv_id = dataset
+    page = repository.query_dataset(csv_id, conditions=conditions)
+
+    assert sorted(row["name"] for row in page["data"]) == ["b", "c", "d"]
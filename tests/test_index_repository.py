@@ -0,0 +1,19 @@
+from pymongo import ASCENDING, IndexModel
+from app.repositories.index_repository import IndexRepository
+
+
+def test_reconcile_rebuilds_indexes_whose_options_changed(db):
+    key = [("expires_at", ASCENDING)]
+    repository = IndexRepository(
+        db, {"cache": [IndexModel(key, name="ff_expires_at", expireAfterSeconds=60)]}
+    )
+    repository.reconcile()
+
+    repository.indexes = {
+        "cache": [IndexModel(key, name="ff_expires_at", expireAfterSeconds=0)]
+    }
+    report = repository.reconcile()
+
+    assert report["dropped"] == ["cache.ff_expires_at"]
+    assert db.cache.index_information()["ff_expires_at"]["expireAfterSeconds"] == 0
+    assert repository.reconcile()["unchanged"] == ["cache.ff_expires_at"]
@@ -0,0 +1,38 @@
+import pytest
+from app.repositories.text_index import TextSearchIndex
+from app.repositories.text_repository import TextRepository
+
+pytest.importorskip("sklearn")
+
+
+@pytest.fixture
+def repository(db, tmp_path):
+    return TextRepository(db, TextSearchIndex(str(tmp_path / "text")))
+
+
+def test_add_before_first_search_keeps_existing_texts(db, repository):
+    db.text.insert_many(
+        [
+            {"text": "the quick brown fox jumps over the lazy dog"},
+            {"text": "a slow green turtle"},
+        ]
+    )
+
+    repository.add_texts(["an unrelated sentence about the weather"])
+    results = repository.search("quick brown fox", 3)
+
+    assert results[0][0] == "the quick brown fox jumps over the lazy dog"
+    # the added text is indexed once
+    assert len(repository.search("weather", 10)) == 1
+
+
+def test_delete_before_first_search_keeps_existing_texts(db, repository):
+    ids = db.text.insert_many(
+        [{"text": "the quick brown fox"}, {"text": "a slow green turtle"}]
+    ).inserted_ids
+
+    repository.delete_text(str(ids[1]))
+
+    assert [text for text, _ in repository.search("fox turtle", 3)] == [
+        "the quick brown fox"
+    ]